@@ -0,0 +1 @@
+"""Бенчмарки обработки инвойсов и деклараций (python -m benchmarks.run)"""
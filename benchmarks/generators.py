@@ -0,0 +1,166 @@
+"""
+Генераторы синтетических данных для бенчмарков.
+
+Все генераторы детерминированы по seed: одинаковые параметры дают
+файлы с одинаковым содержимым, поэтому результаты разных прогонов сравнимы.
+"""
+import io
+import random
+from datetime import datetime, timedelta
+from typing import List, Optional
+from xml.sax.saxutils import escape
+
+from openpyxl import Workbook
+
+from src.processors.unified import COLUMN_MAPPING
+
+PACKAGE_KINDS = ["CT", "BX", "PK", "PP", "NE", "PL"]
+CURRENCIES = ["USD", "CNY", "EUR"]
+DESCRIPTIONS = [
+    "Запчасти для автомобилей",
+    "Электродвигатели переменного тока",
+    "Посуда керамическая",
+    "Ткань хлопчатобумажная",
+    "Light fixtures LED",
+    "Steel fasteners M8",
+]
+
+
+def container_numbers(count: int, seed: int = 0) -> List[str]:
+    """Номера контейнеров в формате ISO 6346 (4 буквы + 7 цифр)."""
+    rnd = random.Random(seed)
+    return [f"{''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3))}U{rnd.randint(0, 9999999):07d}"
+            for _ in range(count)]
+
+
+def make_invoice_workbook(
+    rows: int = 1000,
+    containers: int = 5,
+    invoices_per_container: int = 1,
+    seed: int = 0,
+) -> bytes:
+    """
+    Инвойс (лист "PL") в 19-колоночном формате COLUMN_MAPPING:
+    1-я строка пустая (pandas дает колонкам имена "Unnamed: N"),
+    2-я - заголовки таблицы, дальше - товары.
+    """
+    rnd = random.Random(seed)
+    numbers = container_numbers(containers, seed)
+    base_date = datetime(2024, 1, 1)
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("PL")
+    sheet.append([None] * len(COLUMN_MAPPING))
+    sheet.append(list(COLUMN_MAPPING.values()))
+
+    for row in range(rows):
+        container = numbers[row % containers]
+        invoice_index = rnd.randrange(invoices_per_container)
+        invoice_number = f"INV-{seed}-{row % containers}-{invoice_index}"
+        netto = round(rnd.uniform(1, 2000), rnd.choice([0, 1, 2, 3]))
+        sheet.append([
+            row + 1,
+            rnd.choice([8471300000, 8501520009, 6911100000, 5208520000, 9405420039, 7318158100]),
+            rnd.choice(DESCRIPTIONS),
+            rnd.randint(1, 5000),
+            rnd.randint(1, 200),
+            rnd.choice(PACKAGE_KINDS),
+            netto,
+            round(netto * rnd.uniform(1.0, 1.2), 2),
+            rnd.choice(CURRENCIES),
+            round(rnd.uniform(10, 100000), 2),
+            container,
+            invoice_number,
+            (base_date + timedelta(days=row % containers)).strftime("%d.%m.%Y"),
+            "Xinjiang Trading Co., Ltd",
+            "Urumqi, Xinjiang, China",
+            rnd.choice(["", "Seller Ltd"]),
+            "ТОО Логистик",
+            "Алматы, Казахстан",
+            rnd.choice(["", "Buyer LLP"]),
+        ])
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def make_declaration_xml(
+    goods: int = 1000,
+    documents: int = 20,
+    containers: int = 5,
+    seed: int = 0,
+    invoice_number: Optional[str] = None,
+    invoice_date: str = "2024-01-01",
+) -> bytes:
+    """
+    Транзитная декларация с префиксами namespace (ns2/ns3), N товарными
+    позициями и M документами (часть документов - внутри товаров).
+    """
+    rnd = random.Random(seed)
+    numbers = container_numbers(containers, seed)
+    invoice_number = invoice_number or f"INV-{seed}-0-0"
+
+    def document(index: int) -> str:
+        kind = ["04021", "09034", "02013", "01011"][index % 4]
+        doc_id = invoice_number if kind == "04021" else f"DOC{index:05d}"
+        doc_date = "2011-05-31" if kind == "09034" else invoice_date
+        return (
+            "<ns3:TDPresentedDocDetails>"
+            f"<ns2:DocKindCode>{kind}</ns2:DocKindCode>"
+            f"<ns2:DocName>{'ИНВОЙС' if kind == '04021' else ''}</ns2:DocName>"
+            f"<ns2:DocId>{escape(doc_id)}</ns2:DocId>"
+            f"<ns2:DocCreationDate>{doc_date}</ns2:DocCreationDate>"
+            "</ns3:TDPresentedDocDetails>"
+        )
+
+    def party(tag: str, name: str, city: str) -> str:
+        return (
+            f"<ns3:{tag}><ns2:SubjectName>{escape(name)}</ns2:SubjectName>"
+            "<ns2:SubjectAddressDetails><ns2:AddressKindCode>1</ns2:AddressKindCode>"
+            f"<ns2:CountryCode>CN</ns2:CountryCode><ns2:CityName>{escape(city)}</ns2:CityName>"
+            "<ns2:StreetName>Main street 1</ns2:StreetName></ns2:SubjectAddressDetails>"
+            f"</ns3:{tag}>"
+        )
+
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<ns3:TransitDeclaration xmlns:ns2="urn:EEC:M:ComplexDataObjects:v0.4.6" '
+        'xmlns:ns3="urn:EEC:R:TransitDeclaration:v1.0.0">',
+        f"<ns3:TransportMeansRegId>{numbers[0]}</ns3:TransportMeansRegId>",
+        party("ConsignorDetails", "Xinjiang Trading Co., Ltd", "Urumqi"),
+        party("ConsigneeDetails", "ТОО Логистик", "Алматы"),
+        "<ns2:DepartureCountryCode>CN</ns2:DepartureCountryCode>",
+        "<ns2:DestinationCountryCode>KZ</ns2:DestinationCountryCode>",
+        f"<ns3:SealQuantity>{containers}</ns3:SealQuantity>",
+    ]
+    parts.extend(f"<ns3:CustomsIdentificationMeansId>SEAL{i:06d}</ns3:CustomsIdentificationMeansId>"
+                 for i in range(containers))
+
+    header_documents = documents // 2
+    parts.extend(document(i) for i in range(header_documents))
+    goods_documents = documents - header_documents
+
+    for index in range(goods):
+        item_document = document(header_documents + index) if index < goods_documents else ""
+        parts.append(
+            "<ns3:TransitGoodsItemDetails>"
+            f"<ns2:ConsignmentItemOrdinal>{index + 1}</ns2:ConsignmentItemOrdinal>"
+            f"<ns2:CommodityCode>{rnd.choice(['847130', '850152', '691110', '520852'])}</ns2:CommodityCode>"
+            f"<ns2:GoodsDescriptionText>{escape(rnd.choice(DESCRIPTIONS))}</ns2:GoodsDescriptionText>"
+            f'<ns2:UnifiedGrossMassMeasure measurementUnitCode="166">{round(rnd.uniform(1, 2000), 2)}</ns2:UnifiedGrossMassMeasure>'
+            "<ns2:GoodsProhibitionFreeCode>C</ns2:GoodsProhibitionFreeCode>"
+            "<ns3:PackageAvailabilityCode>1</ns3:PackageAvailabilityCode>"
+            "<ns3:CargoPackagePalletDetails>"
+            f"<ns2:CargoQuantity>{rnd.randint(1, 200)}</ns2:CargoQuantity>"
+            f"<ns3:PackagePalletDetails><ns2:PackageKindCode>{rnd.choice(PACKAGE_KINDS)}</ns2:PackageKindCode>"
+            f"<ns2:PackageQuantity>{rnd.randint(1, 200)}</ns2:PackageQuantity></ns3:PackagePalletDetails>"
+            "</ns3:CargoPackagePalletDetails>"
+            f"<ns3:TransportEquipmentDetails><ns2:ContainerId>{numbers[index % containers]}</ns2:ContainerId></ns3:TransportEquipmentDetails>"
+            f'<ns3:CAValueAmount currencyCode="{rnd.choice(CURRENCIES)}">{round(rnd.uniform(10, 100000), 2)}</ns3:CAValueAmount>'
+            f"{item_document}"
+            "</ns3:TransitGoodsItemDetails>"
+        )
+
+    parts.append("</ns3:TransitDeclaration>")
+    return "\n".join(parts).encode("utf-8")
@@ -0,0 +1,206 @@
+"""
+Бенчмарки основных этапов обработки: разбор инвойса и декларации,
+сравнение, подготовка данных (prepare_data) и сохранение в БД.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --rows 20000 --goods 20000
+    python -m benchmarks.run --compare benchmarks/results/<предыдущий>.json
+
+Сценарий db_save выполняется только с явным --database-url
+(используйте отдельную БД - данные в нее реально записываются).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.generators import make_invoice_workbook, make_declaration_xml
+from src.processors.unified import process_unified
+from src.compare.unified_compare import parse_declaration, unified_compare_handler
+from src.models import RawDataRequest
+from src.services import DataHandler
+
+SCENARIOS = [
+    "parse_streaming",
+    "parse_pandas",
+    "parse_xml_tree",
+    "parse_xml_stream",
+    "compare",
+    "prepare_data",
+    "db_save",
+]
+
+
+def upload_payload(storage) -> Dict[str, Any]:
+    """Данные в том виде, в каком их отправляет браузер на /save."""
+    return {
+        "containers": storage.containers,
+        "container_info": storage.container_info,
+        "totals": storage.totals.__dict__,
+        "calc": storage.calc.__dict__,
+        "sender_name": storage.sender_name,
+        "sender_address": storage.sender_address,
+        "recipient_name": storage.recipient_name,
+        "recipient_address": storage.recipient_address,
+        "invoice": storage.invoice,
+        "date_invoice": storage.date_invoice,
+        "client_name": "benchmark",
+        "order_number": f"bench-{datetime.now():%Y%m%d%H%M%S}",
+    }
+
+
+def measure(func: Callable[[], Any], repeat: int, warmup: int) -> List[float]:
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+def build_scenarios(args, invoice_bytes: bytes, xml_bytes: bytes) -> Dict[str, Callable[[], Any]]:
+    parsed = process_unified(invoice_bytes)
+    if "error" in parsed:
+        raise RuntimeError(f"Сгенерированный инвойс не обработан: {parsed['error']}")
+    payload = upload_payload(parsed["storage"])
+
+    def prepare():
+        handler = DataHandler()
+        result = handler.prepare_data(RawDataRequest(**payload))
+        if not result["success"]:
+            raise RuntimeError(result["error"])
+        return handler
+
+    scenarios = {
+        "parse_streaming": lambda: process_unified(invoice_bytes, engine="streaming"),
+        "parse_pandas": lambda: process_unified(invoice_bytes, engine="pandas"),
+        "parse_xml_tree": lambda: parse_declaration(xml_bytes, streaming=False),
+        "parse_xml_stream": lambda: parse_declaration(xml_bytes, streaming=True),
+        "compare": lambda: unified_compare_handler(invoice_bytes, xml_bytes, "invoice.xlsx", "declaration.xml"),
+        "prepare_data": prepare,
+    }
+
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+        from src.database import init_db_pool, save_data_to_db
+        init_db_pool()
+        prepared = prepare().prepared_data
+
+        def db_save():
+            result = save_data_to_db(prepared, client_name=payload["client_name"], order_number=payload["order_number"])
+            if not result["success"]:
+                raise RuntimeError(result["error"])
+
+        scenarios["db_save"] = db_save
+
+    return scenarios
+
+
+def compare_results(current: Dict[str, Any], baseline_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {result["scenario"]: result for result in baseline.get("results", [])}
+    print(f"\nСравнение с {baseline_path} (медиана):")
+    for result in current["results"]:
+        old = previous.get(result["scenario"])
+        if not old:
+            continue
+        ratio = result["median"] / old["median"] if old["median"] else float("inf")
+        print(f"  {result['scenario']:<18} {old['median']:>9.3f}s -> {result['median']:>9.3f}s  x{ratio:.2f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарки обработки инвойсов и деклараций")
+    parser.add_argument("--rows", type=int, default=5000, help="строк в листе PL")
+    parser.add_argument("--containers", type=int, default=5, help="контейнеров в инвойсе и декларации")
+    parser.add_argument("--invoices-per-container", type=int, default=1)
+    parser.add_argument("--goods", type=int, default=5000, help="товарных позиций в декларации")
+    parser.add_argument("--documents", type=int, default=40, help="документов в декларации")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="список сценариев через запятую: " + ", ".join(SCENARIOS))
+    parser.add_argument("--database-url", default=None, help="БД для сценария db_save")
+    parser.add_argument("--output", default=None, help="JSON с результатами (по умолчанию benchmarks/results/)")
+    parser.add_argument("--compare", default=None, help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    invoice_bytes = make_invoice_workbook(args.rows, args.containers, args.invoices_per_container, args.seed)
+    xml_bytes = make_declaration_xml(args.goods, args.documents, args.containers, args.seed)
+    scenarios = build_scenarios(args, invoice_bytes, xml_bytes)
+
+    params = {
+        "rows": args.rows,
+        "containers": args.containers,
+        "invoices_per_container": args.invoices_per_container,
+        "goods": args.goods,
+        "documents": args.documents,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "invoice_bytes": len(invoice_bytes),
+        "declaration_bytes": len(xml_bytes),
+    }
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "params": params,
+        "results": [],
+    }
+
+    for name in selected:
+        if name not in scenarios:
+            print(f"{name:<18} пропущен (нужен --database-url)")
+            continue
+        timings = measure(scenarios[name], args.repeat, args.warmup)
+        result = {
+            "scenario": name,
+            "timings": timings,
+            "min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.fmean(timings),
+            "max": max(timings),
+        }
+        report["results"].append(result)
+        print(f"{name:<18} min {result['min']:.3f}s  median {result['median']:.3f}s  max {result['max']:.3f}s")
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"bench_{datetime.now():%Y%m%d_%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены: {output}")
+
+    if args.compare:
+        compare_results(report, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
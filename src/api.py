@@ -1,16 +1,40 @@
-from fastapi import FastAPI, Request, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, Request, File, UploadFile, Form, HTTPException, Query
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 import os
+import asyncio
+from typing import List, Optional
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from src.processors import PROCESSORS
-from src.compare import COMPARE_HANDLERS
-from src.models import RawDataRequest
-from src.services import DataHandler
-from src.database import init_db_pool, save_data_to_db
+from src.compare.batch import BatchComparison, BatchError, BatchPair, MAX_PAIRS, pair_uploads, extract_archive
+from src.compare.diff import DiffTolerances, diff_compare_result
+from src.models import (
+    RawDataRequest,
+    SaveSessionRequest,
+    SaveChunkRequest,
+    SaveFinalizeRequest,
+    RowPatchRequest,
+    UploadSaveRequest,
+)
+from src.services import DataHandler, encode_compact
+from src.database import init_db_pool, close_db_pool, db_pool_stats, save_data_to_db_async
+from src import metrics
+from src.executor import (
+    init_executor,
+    shutdown_executor,
+    run_job,
+    job_executor_stats,
+    ExecutorSaturatedError,
+    ExecutorTimeoutError,
+)
+from src.cache import get_result_cache, make_key
+from src.ingest import spool_upload, max_upload_bytes, UploadTooLargeError
+from src.save_sessions import get_save_sessions, SaveSessionError
+from src.exports import cleanup_periodically, get_export_store, iter_gunzip
+from src.upload_sessions import get_upload_sessions, UploadSessionError, MAX_PAGE_SIZE
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -32,6 +56,8 @@ class No404Filter(logging.Filter):
 # Применяем фильтр к access логгеру
 logging.getLogger("uvicorn.access").addFilter(No404Filter())
 
+logger = logging.getLogger(__name__)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: инициализация БД
@@ -41,8 +67,18 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"Предупреждение: не удалось инициализировать БД: {e}")
         print("Приложение будет работать без сохранения в БД")
+    # Пул для тяжелой обработки файлов вне event loop
+    init_executor()
+    # Экспорты: очистка при старте и периодически (с учетом файлов других воркеров)
+    exports = get_export_store()
+    await asyncio.to_thread(exports.cleanup)
+    exports_cleanup = asyncio.create_task(cleanup_periodically(exports))
     yield
-    # Shutdown: закрытие соединений (если нужно)
+    # Shutdown: закрытие пулов и соединений
+    exports_cleanup.cancel()
+    shutdown_executor()
+    # Пул БД дожидается начатых сохранений - ждем вне event loop
+    await asyncio.to_thread(close_db_pool)
 
 app = FastAPI(title="Mapping Data API", version="1.0.0", lifespan=lifespan)
 
@@ -59,6 +95,60 @@ app.mount("/assets", StaticFiles(directory="assets"), name="assets")
 # Настройка шаблонов
 templates = Jinja2Templates(directory="templates")
 
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    """Длительность запросов по маршрутам (шаблон пути, а не фактический URL)"""
+    if not metrics.ENABLED:
+        return await call_next(request)
+    started = metrics.start()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.observe(
+        metrics.HTTP_DURATION,
+        metrics.start() - started,
+        method=request.method,
+        path=getattr(route, "path", "unmatched"),
+        status=str(response.status_code),
+    )
+    return response
+
+# Сколько файлов принимает маршрут: по Content-Length запрос отклоняется до разбора тела
+UPLOAD_ROUTES = {"/upload": 1, "/compare": 2, "/compare/batch": 2 * MAX_PAIRS}
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+@app.middleware("http")
+async def reject_oversize_uploads(request: Request, call_next):
+    """413 по заголовку Content-Length, пока тело запроса еще не принято"""
+    files = UPLOAD_ROUTES.get(request.url.path)
+    max_bytes = max_upload_bytes()
+    if files and max_bytes and request.method == "POST":
+        try:
+            content_length = int(request.headers.get("content-length", "0"))
+        except ValueError:
+            content_length = 0
+        if content_length > max_bytes * files + MULTIPART_OVERHEAD_BYTES:
+            return too_large_response(UploadTooLargeError(max_bytes))
+    return await call_next(request)
+
+def too_large_response(error: UploadTooLargeError) -> JSONResponse:
+    return JSONResponse(
+        content={"success": False, "error": str(error)},
+        status_code=413
+    )
+
+def busy_response(error: Exception) -> JSONResponse:
+    """Ответ при перегрузке пула или таймауте обработки"""
+    if isinstance(error, ExecutorSaturatedError):
+        return JSONResponse(
+            content={"success": False, "error": str(error)},
+            status_code=503,
+            headers={"Retry-After": str(error.retry_after)}
+        )
+    return JSONResponse(
+        content={"success": False, "error": str(error)},
+        status_code=504
+    )
+
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse(
@@ -67,33 +157,69 @@ async def home(request: Request):
     )
 
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), store: str = ""):
     # Используем только единый алгоритм
     processor = PROCESSORS["единый шаблон"]
     
-    contents = await file.read()
-    result = processor(contents)
+    # Файл не читается в память: в обработку уходят байты или путь к временному файлу Starlette
+    started = metrics.start()
+    try:
+        upload = await spool_upload(file)
+    except UploadTooLargeError as e:
+        return too_large_response(e)
+    metrics.stop("upload.read_body", started, upload.size)
+
+    try:
+        # Повторная загрузка того же файла берется из кэша (ключ: хэш файла + CON_NUMBER);
+        # pickle и дисковый уровень кэша работают вне event loop
+        cache = get_result_cache()
+        cache_key = make_key("process_unified", upload.sha256, None)
+        result = await asyncio.to_thread(cache.get, cache_key)
+        if result is None:
+            started = metrics.start()
+            try:
+                result = await run_job(processor, upload.source)
+            except (ExecutorSaturatedError, ExecutorTimeoutError) as e:
+                return busy_response(e)
+            metrics.stop("upload.process", started)
+            if "error" not in result:
+                await asyncio.to_thread(cache.put, cache_key, result)
+    finally:
+        upload.cleanup()
 
     if "error" in result:
         return result
 
-    # Возвращаем обработанные данные клиенту для сохранения в localStorage
+    # Обработанные данные: клиенту в localStorage или в серверное хранилище загрузок (?store=server)
     storage = result["storage"]
-    return {
-        "success": True,
-        "data": {
-            "containers": storage.containers,  # Основные данные в контейнерах
-            "container_info": storage.container_info,  # Информация об отправителе и получателе для каждого контейнера
-            "totals": storage.totals.__dict__,
-            "calc": storage.calc.__dict__,
-            "sender_name": storage.sender_name,
-            "sender_address": storage.sender_address,
-            "recipient_name": storage.recipient_name,
-            "recipient_address": storage.recipient_address, 
-            "invoice": storage.invoice,
-            "date_invoice": storage.date_invoice,
-        }
+    data = {
+        "containers": storage.containers,  # Основные данные в контейнерах
+        "container_info": storage.container_info,  # Информация об отправителе и получателе для каждого контейнера
+        "totals": storage.totals.__dict__,
+        "calc": storage.calc.__dict__,
+        "sender_name": storage.sender_name,
+        "sender_address": storage.sender_address,
+        "recipient_name": storage.recipient_name,
+        "recipient_address": storage.recipient_address, 
+        "invoice": storage.invoice,
+        "date_invoice": storage.date_invoice,
     }
+    uploads = get_upload_sessions()
+    if store == "server" and uploads is not None:
+        # Данные остаются на сервере - клиенту только id загрузки
+        upload_id = await asyncio.to_thread(uploads.create, data)
+        payload = {
+            "success": True,
+            "upload_id": upload_id,
+            "containers": len(storage.containers),
+            "rows": sum(len(rows) for rows in storage.containers.values()),
+        }
+    else:
+        payload = {"success": True, "data": data}
+    started = metrics.start()
+    response = JSONResponse(content=payload)
+    metrics.stop("upload.serialize", started, len(response.body))
+    return response
 
 @app.get("/table", response_class=HTMLResponse)
 async def table_page(request: Request):
@@ -106,20 +232,159 @@ async def compare_page(request: Request):
         {"request": request}
     )
 
+def diff_tolerances(view: str, places: Optional[float], weight: Optional[float],
+                    amount: Optional[float]) -> Optional[DiffTolerances]:
+    """Допуски режима расхождений (?view=diff) или None для полного ответа"""
+    if view != "diff":
+        return None
+    return DiffTolerances.from_env().with_overrides(places=places, weight=weight, amount=amount)
+
 @app.post("/compare")
 async def compare_files(
     invoice: UploadFile = File(...),
     declaration: UploadFile = File(...),
+    view: str = "",
+    places_tolerance: Optional[float] = None,
+    weight_tolerance: Optional[float] = None,
+    amount_tolerance: Optional[float] = None,
 ):
-    # Используем только единый алгоритм сравнения
-    handler = COMPARE_HANDLERS["единый шаблон"]
+    started = metrics.start()
+    uploads = []
+    try:
+        for upload_file in (invoice, declaration):
+            uploads.append(await spool_upload(upload_file))
+    except UploadTooLargeError as e:
+        for upload in uploads:
+            upload.cleanup()
+        return too_large_response(e)
+    invoice_upload, decl_upload = uploads
+    metrics.stop("compare.read_body", started, invoice_upload.size + decl_upload.size)
 
-    invoice_bytes = await invoice.read()
-    decl_bytes = await declaration.read()
+    # Единый алгоритм сравнения (unified_compare_handler), но инвойс обрабатывается целиком
+    # и кэшируется: сравнение той же книги с декларацией другого контейнера не читает файл заново
+    comparison = BatchComparison([BatchPair(0, invoice_upload, decl_upload)])
+    try:
+        started = metrics.start()
+        try:
+            result = await comparison.compare(comparison.pairs[0])
+        except (ExecutorSaturatedError, ExecutorTimeoutError) as e:
+            return busy_response(e)
+        metrics.stop("compare.process", started)
+    finally:
+        await comparison.close()
+        for upload in uploads:
+            upload.cleanup()
 
-    result = handler(invoice_bytes, decl_bytes, invoice.filename, declaration.filename)
+    # ?view=diff - только расхождения, итоги по контейнерам и счетчики вместо полных таблиц
+    tolerances = diff_tolerances(view, places_tolerance, weight_tolerance, amount_tolerance)
+    if tolerances is not None:
+        started = metrics.start()
+        result = await asyncio.to_thread(diff_compare_result, result, tolerances)
+        metrics.stop("compare.diff", started)
     return result
 
+@app.post("/compare/batch")
+async def compare_batch(
+    archive: Optional[UploadFile] = File(None),
+    invoices: Optional[List[UploadFile]] = File(None),
+    declarations: Optional[List[UploadFile]] = File(None),
+    view: str = "",
+    places_tolerance: Optional[float] = None,
+    weight_tolerance: Optional[float] = None,
+    amount_tolerance: Optional[float] = None,
+):
+    """
+    Пакетное сравнение: zip-архив (archive) или файлы invoices/declarations.
+    Ответ - NDJSON, по строке на пару по мере готовности и итоговая строка.
+    ?view=diff - результат каждой пары в режиме расхождений, как у /compare.
+    """
+    started = metrics.start()
+    uploads = []
+    try:
+        if archive is not None:
+            archive_upload = await spool_upload(archive, max_upload_bytes() * 2 * MAX_PAIRS)
+            uploads.append(archive_upload)
+            pairs, members = await asyncio.to_thread(extract_archive, archive_upload.source, max_upload_bytes())
+            uploads.extend(members)
+        else:
+            invoice_uploads = []
+            declaration_uploads = []
+            for upload_file in invoices or []:
+                invoice_uploads.append(await spool_upload(upload_file))
+                uploads.append(invoice_uploads[-1])
+            for upload_file in declarations or []:
+                declaration_uploads.append(await spool_upload(upload_file))
+                uploads.append(declaration_uploads[-1])
+            pairs = pair_uploads(invoice_uploads, declaration_uploads)
+    except UploadTooLargeError as e:
+        for upload in uploads:
+            upload.cleanup()
+        return too_large_response(e)
+    except BatchError as e:
+        for upload in uploads:
+            upload.cleanup()
+        return JSONResponse(
+            content={"success": False, "error": str(e)},
+            status_code=400
+        )
+    metrics.stop("compare.read_body", started, sum(upload.size for upload in uploads))
+
+    async def stream_results():
+        failed = 0
+        try:
+            tolerances = diff_tolerances(view, places_tolerance, weight_tolerance, amount_tolerance)
+            async for entry in BatchComparison(pairs, diff=tolerances).results():
+                if not entry["result"].get("success"):
+                    failed += 1
+                yield encode_compact(entry) + b"\n"
+            yield encode_compact({"done": True, "pairs": len(pairs), "failed": failed}) + b"\n"
+        finally:
+            # Временные файлы удаляются, когда все пары обработаны (или клиент отключился)
+            for upload in uploads:
+                upload.cleanup()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Счетчики кэша результатов (попадания/промахи/размер)"""
+    return get_result_cache().stats()
+
+@app.get("/db/stats")
+async def db_stats():
+    """Использование пула соединений с БД"""
+    return db_pool_stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Гистограммы этапов обработки и состояние пула/кэша в формате Prometheus"""
+    if not metrics.ENABLED:
+        return PlainTextResponse("# metrics disabled (METRICS_ENABLED=0)\n", status_code=404)
+    cache = get_result_cache().stats()
+    executor = job_executor_stats()
+    exports = get_export_store().stats()
+    gauges = {
+        "mappingdata_cache_hits": ("Попадания в кэш результатов", cache["hits"]),
+        "mappingdata_cache_misses": ("Промахи кэша результатов", cache["misses"]),
+        "mappingdata_cache_bytes": ("Размер кэша результатов в памяти, байт", cache["bytes"]),
+        "mappingdata_executor_pending": ("Задачи в работе и в очереди пула", executor.get("pending", 0)),
+        "mappingdata_executor_rejected": ("Задачи, отклоненные с 503", executor.get("rejected", 0)),
+        "mappingdata_executor_timed_out": ("Задачи, прерванные по таймауту", executor.get("timed_out", 0)),
+        "mappingdata_executor_broken": ("Задачи, прерванные падением воркера", executor.get("broken", 0)),
+        "mappingdata_exports_bytes": ("Размер файлов экспорта, байт", exports["size_bytes"]),
+        "mappingdata_exports_evictions": ("Экспорты, удаленные по возрасту или размеру", exports["evictions"]),
+    }
+    db_pool = db_pool_stats()
+    if db_pool:
+        gauges.update({
+            "mappingdata_db_pool_in_use": ("Соединения с БД, выданные из пула", db_pool["in_use"]),
+            "mappingdata_db_pool_max": ("Максимальный размер пула соединений", db_pool["max_size"]),
+            "mappingdata_db_pool_utilization": ("Доля занятых соединений пула", db_pool["utilization"]),
+            "mappingdata_db_pool_timeouts": ("Таймауты ожидания соединения", db_pool["timeouts"]),
+            "mappingdata_db_pool_discarded": ("Соединения, закрытые после неудачной проверки", db_pool["discarded"]),
+        })
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
 @app.get("/table/json")
 async def get_table_json():
     return JSONResponse(
@@ -137,14 +402,14 @@ async def save_data(request: RawDataRequest):
     Принимает сырые данные, преобразует их и сохраняет в БД
     """
     try:
-        # Отладочная информация
-        print(f"Получены данные: containers={len(request.containers)}, sender_name='{request.sender_name}', recipient_name='{request.recipient_name}'")
-        print(f"Адреса: sender_address='{request.sender_address}', recipient_address='{request.recipient_address}'")
-        print(f"Инвойс: invoice='{request.invoice}', date_invoice='{request.date_invoice}'")
+        # Только размеры: имена, адреса и номера инвойсов в лог не пишутся
+        logger.debug(f"/save: получено контейнеров: {len(request.containers)}")
         
         # Подготавливаем данные через DataHandler
         handler = DataHandler()
+        started = metrics.start()
         prepare_result = handler.prepare_data(request)
+        metrics.stop("save.prepare", started, len(request.containers))
         
         if not prepare_result["success"]:
             return JSONResponse(
@@ -162,73 +427,304 @@ async def save_data(request: RawDataRequest):
                 status_code=400
             )
         
-        # Сохраняем в БД
-        db_result = None
-        try:
-            db_result = save_data_to_db(
-                handler.prepared_data,
-                client_name=request.client_name,
-                order_number=request.order_number
-            )
-            if not db_result["success"]:
-                error_msg = db_result.get('error', 'Неизвестная ошибка')
-                print(f"Ошибка: не удалось сохранить в БД: {error_msg}")
-                return JSONResponse(
-                    content={
-                        "success": False,
-                        "error": f"Ошибка при сохранении в БД: {error_msg}"
-                    },
-                    status_code=500
-                )
-        except Exception as db_error:
-            error_msg = str(db_error)
-            print(f"Исключение при сохранении в БД: {error_msg}")
-            import traceback
-            traceback.print_exc()
+        return await persist_prepared_data(
+            handler.prepared_data,
+            request.client_name,
+            request.order_number,
+            prepare_result["containers_processed"]
+        )
+            
+    except Exception as e:
+        logger.exception("Критическая ошибка при обработке данных /save")
+        return JSONResponse(
+            content={"success": False, "error": f"Критическая ошибка: {str(e)}"},
+            status_code=500
+        )
+
+async def persist_prepared_data(prepared_data, client_name: str, order_number: str, containers_processed: int):
+    """Сохраняет подготовленные данные в БД и формирует ответ /save"""
+    db_result = None
+    try:
+        # Запросы к БД выполняются в пуле потоков БД, event loop не блокируется
+        db_result = await save_data_to_db_async(
+            prepared_data,
+            client_name=client_name,
+            order_number=order_number
+        )
+        if not db_result["success"]:
+            error_msg = db_result.get('error', 'Неизвестная ошибка')
+            logger.error(f"Не удалось сохранить в БД: {error_msg}")
             return JSONResponse(
                 content={
                     "success": False,
-                    "error": f"Критическая ошибка при сохранении в БД: {error_msg}"
+                    "error": f"Ошибка при сохранении в БД: {error_msg}"
                 },
                 status_code=500
             )
-        
-        # Формируем успешный ответ
-        response = {
-            "success": True,
-            "message": "Данные успешно сохранены в базу данных",
-            "containers_processed": prepare_result["containers_processed"],
-            "db_saved": True,
-            "containers_saved_to_db": db_result.get("containers_saved", 0)
-        }
-        
-        return response
-            
-    except Exception as e:
-        print(f"Критическая ошибка при обработке данных: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception as db_error:
+        error_msg = str(db_error)
+        logger.exception("Исключение при сохранении в БД")
         return JSONResponse(
-            content={"success": False, "error": f"Критическая ошибка: {str(e)}"},
+            content={
+                "success": False,
+                "error": f"Критическая ошибка при сохранении в БД: {error_msg}"
+            },
             status_code=500
         )
+    
+    # Формируем успешный ответ
+    return {
+        "success": True,
+        "message": "Данные успешно сохранены в базу данных",
+        "containers_processed": containers_processed,
+        "db_saved": True,
+        "containers_saved_to_db": db_result.get("containers_saved", 0),
+        "items_skipped": db_result.get("items_skipped", 0),
+        "db_unchanged": db_result.get("unchanged", False),
+        "containers_written_to_db": db_result.get("containers_written", 0)
+    }
 
-@app.get("/download/{filename}")
-async def download_file(filename: str):
+def session_not_found() -> JSONResponse:
+    return JSONResponse(
+        content={"success": False, "error": "Сессия сохранения не найдена или истекла"},
+        status_code=404
+    )
+
+@app.post("/save/sessions")
+async def open_save_session(request: SaveSessionRequest):
     """
-    Endpoint для скачивания JSON файла
+    Открывает сессию поэтапного сохранения большого заказа.
+    Дальше контейнеры отправляются пачками на /save/sessions/{id}/containers,
+    запись в БД - одной транзакцией на /save/sessions/{id}/finalize.
     """
+    if not request.client_name or not request.order_number:
+        return JSONResponse(
+            content={
+                "success": False,
+                "error": "client_name и order_number обязательны для сохранения в БД"
+            },
+            status_code=400
+        )
+    meta = await asyncio.to_thread(get_save_sessions().open, request.model_dump())
+    return {"success": True, "session_id": meta["session_id"], "expires_in": int(get_save_sessions().ttl)}
+
+@app.get("/save/sessions/{session_id}")
+async def get_save_session(session_id: str):
+    """Состояние сессии: какие контейнеры уже приняты (для докачки после обрыва)"""
+    session = await asyncio.to_thread(get_save_sessions().get, session_id)
+    if session is None:
+        return session_not_found()
+    return {"success": True, **session}
+
+@app.post("/save/sessions/{session_id}/containers")
+async def stage_save_containers(session_id: str, request: SaveChunkRequest):
+    """Принимает пачку контейнеров; повторная отправка контейнера заменяет прежнюю"""
+    started = metrics.start()
     try:
-        file_path = os.path.join("static", "downloads", filename)
-        
-        if not os.path.exists(file_path):
+        staged = await asyncio.to_thread(
+            get_save_sessions().stage, session_id, request.containers, request.container_info
+        )
+    except SaveSessionError as e:
+        return JSONResponse(content={"success": False, "error": str(e)}, status_code=400)
+    if staged is None:
+        return session_not_found()
+    metrics.stop("save.stage_batch", started, staged)
+    return {"success": True, "batch_containers": staged}
+
+@app.post("/save/sessions/{session_id}/finalize")
+async def finalize_save_session(session_id: str, request: SaveFinalizeRequest = SaveFinalizeRequest()):
+    """Записывает все принятые контейнеры в БД одной транзакцией и закрывает сессию"""
+    store = get_save_sessions()
+    session = await asyncio.to_thread(store.get, session_id)
+    if session is None:
+        return session_not_found()
+    if request.expected_containers is not None and session["containers_received"] != request.expected_containers:
+        return JSONResponse(
+            content={
+                "success": False,
+                "error": f"Приняты не все контейнеры: {session['containers_received']} из {request.expected_containers}",
+                "received": session["received"]
+            },
+            status_code=409
+        )
+    
+    prepared_data = await asyncio.to_thread(store.prepared_data, session_id)
+    response = await persist_prepared_data(
+        prepared_data, session["client_name"], session["order_number"], len(prepared_data)
+    )
+    # При ошибке сессия остается - финализацию можно повторить
+    if isinstance(response, dict):
+        await asyncio.to_thread(store.discard, session_id)
+    return response
+
+@app.delete("/save/sessions/{session_id}")
+async def discard_save_session(session_id: str):
+    """Отменяет сессию сохранения"""
+    store = get_save_sessions()
+    if await asyncio.to_thread(store.get, session_id) is None:
+        return session_not_found()
+    await asyncio.to_thread(store.discard, session_id)
+    return {"success": True}
+
+def upload_not_found() -> JSONResponse:
+    return JSONResponse(
+        content={"success": False, "error": "Загрузка не найдена или истекла, загрузите файл заново"},
+        status_code=404
+    )
+
+def upload_sessions_or_404():
+    uploads = get_upload_sessions()
+    if uploads is None:
+        raise HTTPException(status_code=404, detail="Серверное хранение загрузок выключено")
+    return uploads
+
+@app.get("/uploads/{upload_id}")
+async def get_upload(upload_id: str):
+    """Данные загрузки (формат data из /upload)"""
+    data = await asyncio.to_thread(upload_sessions_or_404().get, upload_id)
+    if data is None:
+        return upload_not_found()
+    return JSONResponse(content={"success": True, "upload_id": upload_id, "data": data})
+
+@app.get("/uploads/{upload_id}/containers")
+async def list_upload_containers(
+    upload_id: str,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    container: str = "",
+    code: str = "",
+    description: str = "",
+    search: str = "",
+):
+    """
+    Страница контейнеров загрузки с итогами и информацией об отправителе/получателе.
+    Фильтры: часть номера контейнера, начало кода ТН ВЭД, часть описания товара,
+    search - любое из трех.
+    """
+    result = await asyncio.to_thread(
+        upload_sessions_or_404().list_containers, upload_id, page, page_size, container, code, description, search
+    )
+    if result is None:
+        return upload_not_found()
+    return JSONResponse(content={"success": True, **result})
+
+@app.get("/uploads/{upload_id}/containers/{container_no}/rows")
+async def list_upload_rows(
+    upload_id: str,
+    container_no: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    code: str = "",
+    description: str = "",
+    search: str = "",
+):
+    """Строки контейнера постранично; index каждой строки - номер для PATCH"""
+    result = await asyncio.to_thread(
+        upload_sessions_or_404().list_rows, upload_id, container_no, offset, limit, code, description, search
+    )
+    if result is None:
+        return upload_not_found()
+    return JSONResponse(content={"success": True, **result})
+
+@app.patch("/uploads/{upload_id}/containers/{container_no}/rows/{row_index}")
+async def update_upload_row(upload_id: str, container_no: str, row_index: int, request: RowPatchRequest):
+    """Правка одной строки таблицы: меняются только переданные колонки"""
+    try:
+        row = await asyncio.to_thread(
+            upload_sessions_or_404().update_row, upload_id, container_no, row_index, request.values
+        )
+    except UploadSessionError as e:
+        return JSONResponse(content={"success": False, "error": str(e)}, status_code=400)
+    if row is None:
+        return upload_not_found()
+    return {"success": True, "row": row}
+
+@app.patch("/uploads/{upload_id}/containers/{container_no}")
+async def update_upload_container(upload_id: str, container_no: str, request: RowPatchRequest):
+    """Массовая правка: значения ставятся во все строки контейнера"""
+    try:
+        updated = await asyncio.to_thread(
+            upload_sessions_or_404().update_container, upload_id, container_no, request.values
+        )
+    except UploadSessionError as e:
+        return JSONResponse(content={"success": False, "error": str(e)}, status_code=400)
+    if updated is None:
+        return upload_not_found()
+    return {"success": True, "rows_updated": updated}
+
+@app.post("/uploads/{upload_id}/save")
+async def save_upload(upload_id: str, request: UploadSaveRequest):
+    """Сохраняет загрузку в БД: браузер передает только клиента и номер заказа"""
+    if not request.client_name or not request.order_number:
+        return JSONResponse(
+            content={
+                "success": False,
+                "error": "client_name и order_number обязательны для сохранения в БД"
+            },
+            status_code=400
+        )
+    data = await asyncio.to_thread(upload_sessions_or_404().get, upload_id)
+    if data is None:
+        return upload_not_found()
+    
+    # Загрузка на сервере - это большие заказы: подготовка всего заказа идет вне event loop
+    handler = DataHandler()
+    started = metrics.start()
+    prepare_result = await asyncio.to_thread(handler.prepare_data, RawDataRequest(
+        **data, client_name=request.client_name, order_number=request.order_number
+    ))
+    metrics.stop("save.prepare", started, len(data["containers"]))
+    if not prepare_result["success"]:
+        return JSONResponse(content=prepare_result, status_code=400)
+    
+    return await persist_prepared_data(
+        handler.prepared_data,
+        request.client_name,
+        request.order_number,
+        prepare_result["containers_processed"]
+    )
+
+@app.delete("/uploads/{upload_id}")
+async def delete_upload(upload_id: str):
+    """Удаляет загрузку с сервера"""
+    await asyncio.to_thread(upload_sessions_or_404().delete, upload_id)
+    return {"success": True}
+
+@app.get("/download/{filename}")
+async def download_file(filename: str, request: Request):
+    """
+    Endpoint для скачивания JSON файла (потоково, с поддержкой Range)
+    """
+    store = get_export_store()
+    entry = store.get(filename)
+    if entry is None and filename.endswith(".gz"):
+        # Прямая ссылка на сжатый файл - отдаем его как архив
+        entry = store.get(filename[:-3])
+        if entry is None or entry.encoding != "gzip":
             raise HTTPException(status_code=404, detail="Файл не найден")
-        
+        return FileResponse(path=entry.path, filename=filename, media_type='application/gzip')
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    
+    if entry.encoding is None:
+        return FileResponse(path=entry.path, filename=filename, media_type='application/json')
+    
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if "gzip" in accept_encoding.lower():
+        # Сжатый вариант отдается без перекодирования; Range - по сжатым байтам
         return FileResponse(
-            path=file_path,
+            path=entry.path,
             filename=filename,
-            media_type='application/json'
+            media_type='application/json',
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
         )
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Ошибка при скачивании файла: {str(e)}")
+    
+    # Клиент без gzip - распаковываем на лету
+    return StreamingResponse(
+        iter_gunzip(entry.path),
+        media_type='application/json',
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Vary": "Accept-Encoding"
+        }
+    )
@@ -0,0 +1,223 @@
+"""
+Кэш результатов обработки файлов по хэшу содержимого.
+
+Операторы часто загружают один и тот же инвойс повторно, поэтому результаты
+process_unified и сравнения кэшируются по SHA-256 загруженных байтов.
+Значения хранятся сериализованными (pickle): размер записи известен точно,
+а каждый get() возвращает независимую копию, которую можно менять.
+Настройка через переменные окружения:
+    RESULT_CACHE_MAX_BYTES       - бюджет памяти в байтах (по умолчанию 64 МБ, 0 - кэш выключен)
+    RESULT_CACHE_DIR             - папка для дискового уровня (по умолчанию выключен)
+    RESULT_CACHE_DISK_MAX_BYTES  - бюджет дискового уровня в байтах (по умолчанию 1 ГБ)
+"""
+import os
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# Версия формата значений кэша. Входит в ключ: увеличить при изменении структур
+# результатов (ExcelData, ответ сравнения и т.п.), чтобы не читать записи
+# старого формата с диска после обновления
+CACHE_VERSION = 1
+
+
+def make_key(*parts: Any) -> str:
+    """Ключ кэша из частей (хэши файлов, номер контейнера и т.п.) и версии формата"""
+    parts = (f"v{CACHE_VERSION}",) + parts
+    return hashlib.sha256("\x1f".join("" if p is None else str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """LRU-кэш с бюджетом в байтах и необязательным дисковым уровнем"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 1024 * 1024 * 1024):
+        self.max_bytes = max(0, max_bytes)
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = max(0, disk_max_bytes)
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        """Создает кэш по переменным окружения"""
+        return cls(
+            max_bytes=int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            disk_dir=os.getenv("RESULT_CACHE_DIR") or None,
+            disk_max_bytes=int(os.getenv("RESULT_CACHE_DISK_MAX_BYTES", str(1024 * 1024 * 1024))),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.disk_dir)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Возвращает копию значения или None; попадание учитывается, только если запись прочиталась"""
+        with self._lock:
+            blob = self._entries.get(key)
+            if blob is not None:
+                self._entries.move_to_end(key)
+        from_disk = blob is None
+        if from_disk:
+            blob = self._read_disk(key)
+            if blob is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+        try:
+            value = pickle.loads(blob)
+        except Exception as e:
+            # Поврежденная или несовместимая запись - считаем промахом и удаляем
+            logger.warning(f"Не удалось прочитать запись кэша, удаляем: {e}")
+            self._discard(key)
+            return None
+        with self._lock:
+            if from_disk:
+                self.disk_hits += 1
+                self._store(key, blob)
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        if not self.enabled:
+            return
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.warning(f"Не удалось сериализовать значение для кэша: {e}")
+            return
+        with self._lock:
+            self._store(key, blob)
+        self._write_disk(key, blob)
+
+    def _store(self, key: str, blob: bytes) -> None:
+        """Кладет запись в память и вытесняет самые старые (вызывать под _lock)"""
+        if len(blob) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = blob
+        self._size += len(blob)
+        while self._size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    def _discard(self, key: str) -> None:
+        """Удаляет нечитаемую запись из памяти и с диска, обращение учитывается как промах"""
+        with self._lock:
+            blob = self._entries.pop(key, None)
+            if blob is not None:
+                self._size -= len(blob)
+            self.misses += 1
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.pkl")
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            os.utime(path)  # отмечаем использование для вытеснения по давности
+            return blob
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ошибка чтения дискового кэша: {e}")
+            return None
+
+    def _write_disk(self, key: str, blob: bytes) -> None:
+        if not self.disk_dir or len(blob) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+            self._evict_disk()
+        except Exception as e:
+            logger.warning(f"Ошибка записи дискового кэша: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _evict_disk(self) -> None:
+        """Удаляет самые давно использованные файлы, пока не уложимся в бюджет"""
+        files = []
+        total = 0
+        with os.scandir(self.disk_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".pkl"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+        if total <= self.disk_max_bytes:
+            return
+        for _, size, path in sorted(files):
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.disk_evictions += 1
+            if total <= self.disk_max_bytes:
+                break
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "disk_evictions": self.disk_evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "disk_dir": self.disk_dir,
+            }
+
+
+# Глобальный кэш результатов
+result_cache = None
+
+
+def get_result_cache() -> ResultCache:
+    """Возвращает глобальный кэш, создавая его при первом обращении"""
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache.from_env()
+    return result_cache
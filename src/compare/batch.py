@@ -0,0 +1,266 @@
+"""
+Пакетное сравнение инвойсов и деклараций (POST /compare/batch).
+
+Пары собираются из zip-архива или из набора файлов multipart
+(один инвойс против N деклараций либо инвойсы и декларации попарно).
+Декларации разбираются в пуле исполнителей параллельно; инвойс
+обрабатывается один раз целиком (все контейнеры) и общий для всех
+ссылающихся на него деклараций (в том числе одинаковые по содержимому
+файлы), контейнер декларации выделяется из него без повторного чтения.
+Результаты отдаются по мере готовности пар.
+
+Настройка через переменные окружения:
+    COMPARE_BATCH_MAX_PAIRS   - максимум пар в одном запросе (по умолчанию 100)
+    COMPARE_BATCH_CONCURRENCY - сколько задач одного пакета одновременно в пуле
+                                (по умолчанию - число воркеров пула)
+"""
+import os
+import asyncio
+import zipfile
+import posixpath
+from collections import defaultdict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from src.cache import get_result_cache, make_key
+from src.executor import init_executor, run_job
+from src.ingest import Source, SpooledUpload, UploadTooLargeError, open_source, spool
+from src.processors.unified import select_container
+from src.compare.diff import DiffTolerances, diff_compare_result
+from src.compare.unified_compare import (
+    build_compare_result,
+    declaration_container,
+    parse_declaration,
+    process_invoice,
+)
+
+MAX_PAIRS = int(os.getenv("COMPARE_BATCH_MAX_PAIRS", "100"))
+
+INVOICE_EXTENSIONS = (".xlsx", ".xlsm", ".xls")
+DECLARATION_EXTENSIONS = (".xml",)
+
+
+class BatchError(Exception):
+    """Некорректный состав пакета (нет пары у файла, слишком много пар и т.п.)"""
+
+
+class BatchPair:
+    """Пара инвойс - декларация; index - порядковый номер пары в запросе"""
+
+    __slots__ = ("index", "invoice", "declaration")
+
+    def __init__(self, index: int, invoice: SpooledUpload, declaration: SpooledUpload):
+        self.index = index
+        self.invoice = invoice
+        self.declaration = declaration
+
+
+def _check_count(count: int) -> None:
+    if not count:
+        raise BatchError("Не найдено ни одной пары инвойс - декларация")
+    if count > MAX_PAIRS:
+        raise BatchError(f"Слишком много пар в пакете: {count} (максимум {MAX_PAIRS})")
+
+
+def pair_uploads(invoices: List[SpooledUpload], declarations: List[SpooledUpload]) -> List[BatchPair]:
+    """
+    Пары из файлов multipart: один инвойс сравнивается со всеми декларациями,
+    иначе инвойсы и декларации сопоставляются по порядку.
+    """
+    if len(invoices) == 1:
+        invoices = invoices * len(declarations)
+    elif len(invoices) != len(declarations):
+        raise BatchError(
+            f"Количество инвойсов ({len(invoices)}) и деклараций ({len(declarations)}) не совпадает"
+        )
+    _check_count(len(declarations))
+    return [BatchPair(index, invoice, declaration)
+            for index, (invoice, declaration) in enumerate(zip(invoices, declarations))]
+
+
+def _file_kind(name: str) -> Optional[str]:
+    lower = name.lower()
+    if lower.endswith(INVOICE_EXTENSIONS):
+        return "invoice"
+    if lower.endswith(DECLARATION_EXTENSIONS):
+        return "declaration"
+    return None
+
+
+def pair_archive_names(names: List[str]) -> List[Tuple[str, str]]:
+    """
+    Пары (инвойс, декларация) по именам файлов архива. Файлы группируются по папкам:
+    если в папке один инвойс, он сравнивается со всеми декларациями папки,
+    иначе инвойс и декларация сопоставляются по имени без расширения.
+    """
+    folders = defaultdict(lambda: {"invoice": [], "declaration": []})
+    for name in names:
+        kind = _file_kind(name)
+        if kind:
+            folders[posixpath.dirname(name)][kind].append(name)
+
+    pairs = []
+    unmatched = []
+    for folder in sorted(folders):
+        invoices = sorted(folders[folder]["invoice"])
+        declarations = sorted(folders[folder]["declaration"])
+        if len(invoices) == 1:
+            pairs.extend((invoices[0], declaration) for declaration in declarations)
+            if not declarations:
+                unmatched.extend(invoices)
+            continue
+        by_stem = {posixpath.splitext(name)[0]: name for name in invoices}
+        for declaration in declarations:
+            invoice = by_stem.pop(posixpath.splitext(declaration)[0], None)
+            if invoice is None:
+                unmatched.append(declaration)
+            else:
+                pairs.append((invoice, declaration))
+        unmatched.extend(by_stem.values())
+
+    if unmatched:
+        raise BatchError("Не найдена пара для файлов: " + ", ".join(sorted(unmatched)))
+    _check_count(len(pairs))
+    return pairs
+
+
+def extract_archive(source: Source, max_bytes: int) -> Tuple[List[BatchPair], List[SpooledUpload]]:
+    """
+    Распаковывает инвойсы и декларации из zip во временные файлы.
+
+    Returns:
+        (пары, все временные файлы для последующей очистки)
+    """
+    uploads: Dict[str, SpooledUpload] = {}
+    try:
+        with open_source(source) as f, zipfile.ZipFile(f) as archive:
+            members = {
+                info.filename: info
+                for info in archive.infolist()
+                if not info.is_dir() and not posixpath.basename(info.filename).startswith(".")
+                and not info.filename.startswith("__MACOSX/")
+            }
+            names = pair_archive_names(list(members))
+            for name in {name for pair in names for name in pair}:
+                info = members[name]
+                if max_bytes and info.file_size > max_bytes:
+                    raise UploadTooLargeError(max_bytes, name)
+                with archive.open(info) as stream:
+                    # Размер в заголовке архива может не совпадать с фактическим - spool проверяет сам
+                    uploads[name] = spool(stream, posixpath.basename(name), max_bytes)
+    except zipfile.BadZipFile:
+        _cleanup(uploads.values())
+        raise BatchError("Файл не является zip-архивом")
+    except BaseException:
+        _cleanup(uploads.values())
+        raise
+    pairs = [BatchPair(index, uploads[invoice], uploads[declaration])
+             for index, (invoice, declaration) in enumerate(names)]
+    return pairs, list(uploads.values())
+
+
+def _cleanup(uploads) -> None:
+    for upload in uploads:
+        upload.cleanup()
+
+
+class BatchComparison:
+    """
+    Выполняет сравнение пар пакета в пуле исполнителей.
+
+    Разбор деклараций идет параллельно с обработкой инвойсов. Инвойс
+    обрабатывается целиком один раз (или берется из кэша результатов /upload),
+    и все его декларации ждут одну и ту же задачу. Если целиком инвойс
+    не обработался (ошибка в строке другого контейнера), контейнер
+    обрабатывается отдельно - результат тот же, что у /compare.
+    """
+
+    def __init__(self, pairs: List[BatchPair], concurrency: Optional[int] = None,
+                 diff: Optional[DiffTolerances] = None):
+        self.pairs = pairs
+        self.diff = diff  # допуски режима расхождений (None - полный ответ)
+        if concurrency is None:
+            concurrency = int(os.getenv("COMPARE_BATCH_CONCURRENCY", "0")) or init_executor().max_workers
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._invoices: Dict[Tuple[str, Optional[str]], asyncio.Task] = {}
+        self._cache = get_result_cache()
+
+    async def _job(self, func, *args):
+        # Пакет не занимает больше concurrency слотов пула, остальные запросы не получают 503
+        async with self._semaphore:
+            return await run_job(func, *args)
+
+    async def _process_invoice(self, invoice: SpooledUpload, container_number: Optional[str]) -> Dict:
+        # Инвойс целиком кэшируется под тем же ключом, что и в /upload
+        cache_key = make_key("process_unified", invoice.sha256, None) if container_number is None else None
+        result = await asyncio.to_thread(self._cache.get, cache_key) if cache_key else None
+        if result is None:
+            result = await self._job(process_invoice, invoice.source, container_number)
+            if cache_key and "error" not in result:
+                await asyncio.to_thread(self._cache.put, cache_key, result)
+        return result
+
+    def _invoice(self, invoice: SpooledUpload, container_number: Optional[str] = None) -> asyncio.Task:
+        """Задача обработки инвойса (container_number=None - все контейнеры), общая для всех пар"""
+        key = (invoice.sha256, container_number)
+        task = self._invoices.get(key)
+        if task is None:
+            task = self._invoices[key] = asyncio.ensure_future(self._process_invoice(invoice, container_number))
+        return task
+
+    async def compare(self, pair: BatchPair) -> Dict:
+        """
+        Результат сравнения пары (как у unified_compare_handler).
+
+        Raises:
+            ExecutorSaturatedError, ExecutorTimeoutError: при перегрузке пула или таймауте
+        """
+        cache_key = make_key("compare", pair.invoice.sha256, pair.declaration.sha256)
+        result = await asyncio.to_thread(self._cache.get, cache_key)
+        if result is not None:
+            return result
+
+        # Инвойс обрабатывается одновременно с разбором декларации
+        invoice_task = self._invoice(pair.invoice)
+        declaration = await self._job(parse_declaration, pair.declaration.source)
+        container_number = declaration_container(declaration[0], declaration[2])
+        # shield: отмена одной пары не должна отменять общий для других пар инвойс
+        invoice_result = select_container(await asyncio.shield(invoice_task), container_number)
+        if invoice_result is None:
+            invoice_result = await asyncio.shield(self._invoice(pair.invoice, container_number))
+        result = await asyncio.to_thread(build_compare_result, declaration, invoice_result)
+        if result.get("success"):
+            await asyncio.to_thread(self._cache.put, cache_key, result)
+        return result
+
+    async def _compare(self, pair: BatchPair) -> Dict:
+        entry = {
+            "index": pair.index,
+            "invoice": pair.invoice.filename,
+            "declaration": pair.declaration.filename,
+        }
+        try:
+            entry["result"] = await self.compare(pair)
+            if self.diff is not None:
+                entry["result"] = await asyncio.to_thread(diff_compare_result, entry["result"], self.diff)
+        except Exception as e:
+            entry["result"] = {"success": False, "error": str(e)}
+        return entry
+
+    async def close(self) -> None:
+        """Снимает незавершенные задачи обработки инвойсов"""
+        for task in self._invoices.values():
+            task.cancel()
+        await asyncio.gather(*self._invoices.values(), return_exceptions=True)
+
+    async def results(self) -> AsyncIterator[Dict]:
+        """Результаты пар по мере готовности (в порядке завершения, а не в порядке пар)"""
+        tasks = [asyncio.ensure_future(self._compare(pair)) for pair in self.pairs]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Клиент отключился - снимаем оставшиеся задачи
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.close()
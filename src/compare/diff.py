@@ -0,0 +1,411 @@
+"""
+Построчное сравнение инвойса и декларации на сервере (режим расхождений).
+
+Строки сопоставляются внутри одного контейнера через хэш-ключи на номере
+контейнера, коде ТН ВЭД (первые 6 цифр), количестве мест, весе брутто и
+сумме: сначала по полному ключу, затем по все более коротким (код + часть
+чисел), поэтому пара находится за O(n), а не попарным перебором. Декларация
+сравнивается только по контейнерам, которые есть в инвойсе (инвойс отобран
+по контейнеру декларации), остальные ее контейнеры не считаются
+расхождениями. В ответе - только расхождения (строки с отличиями и
+строки без пары), итоги по контейнерам с разницей и счетчики; совпавшие
+строки только считаются.
+
+Правила сравнения повторяют compare.html: код - по первым 6 цифрам, сумма
+меньше 0.01 и вес меньше 0.000001 считаются нулевыми, описание совпадает,
+если каждое слово более короткого описания входит в слово другого.
+
+Допуски (абсолютные, по умолчанию 0 - точное совпадение):
+    DIFF_PLACES_TOLERANCE - по количеству грузовых мест
+    DIFF_WEIGHT_TOLERANCE - по весу брутто
+    DIFF_AMOUNT_TOLERANCE - по сумме
+"""
+import os
+import re
+import math
+from collections import deque
+from itertools import product
+from decimal import Decimal, InvalidOperation
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
+
+CODE_FIELD = "Код ТН ВЭД"
+DESCRIPTION_FIELD = "Коммерческое описание товара"
+CONTAINER_FIELD = "Номер контейнера"
+
+# Числовые поля строки (в этом порядке хранятся в _Line.numbers), их допуски и пороги "нулевого" значения
+NUMERIC_FIELDS = ("Количество грузовых мест", "Вес брутто", "Сумма")
+TOLERANCE_NAMES = ("places", "weight", "amount")
+ZERO_FLOORS = (None, Decimal("0.000001"), Decimal("0.01"))
+_FLOAT_FLOORS = tuple(float(floor) if floor is not None else None for floor in ZERO_FLOORS)
+PLACES, WEIGHT, AMOUNT = range(3)
+
+# Уровни сопоставления (номера числовых полей в ключе вместе с кодом): от полного ключа к коду ТН ВЭД
+MATCH_LEVELS = (
+    (PLACES, WEIGHT, AMOUNT),
+    (PLACES, WEIGHT),
+    (PLACES, AMOUNT),
+    (WEIGHT, AMOUNT),
+    (PLACES,),
+    (),
+)
+
+_NON_DIGITS = re.compile(r"\D")
+_NON_WORD = re.compile(r"[^a-zA-Zа-яА-Я0-9\s]")
+_ZERO = Decimal(0)
+
+
+class DiffTolerances:
+    """Абсолютные допуски при сравнении чисел"""
+
+    __slots__ = ("places", "weight", "amount")
+
+    def __init__(self, places: float = 0, weight: float = 0, amount: float = 0):
+        self.places = Decimal(str(max(0.0, places)))
+        self.weight = Decimal(str(max(0.0, weight)))
+        self.amount = Decimal(str(max(0.0, amount)))
+
+    @classmethod
+    def from_env(cls) -> "DiffTolerances":
+        return cls(
+            places=float(os.getenv("DIFF_PLACES_TOLERANCE", "0")),
+            weight=float(os.getenv("DIFF_WEIGHT_TOLERANCE", "0")),
+            amount=float(os.getenv("DIFF_AMOUNT_TOLERANCE", "0")),
+        )
+
+    def with_overrides(self, places: Optional[float] = None, weight: Optional[float] = None,
+                       amount: Optional[float] = None) -> "DiffTolerances":
+        """Копия с допусками из запроса (None - оставить как есть)"""
+        return DiffTolerances(
+            places=float(self.places) if places is None else places,
+            weight=float(self.weight) if weight is None else weight,
+            amount=float(self.amount) if amount is None else amount,
+        )
+
+    def values(self) -> Tuple[Decimal, Decimal, Decimal]:
+        """Допуски в порядке NUMERIC_FIELDS"""
+        return self.places, self.weight, self.amount
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"places": float(self.places), "weight": float(self.weight), "amount": float(self.amount)}
+
+
+def _decimal(value: Any) -> Decimal:
+    """Точное десятичное значение поля (пустое и некорректное - 0), как new Decimal(value || 0)"""
+    if value.__class__ is float:
+        return Decimal(repr(value)) if math.isfinite(value) else _ZERO
+    if value is None or value == "":
+        return _ZERO
+    try:
+        number = Decimal(str(value).strip())
+    except InvalidOperation:
+        return _ZERO
+    return number if number.is_finite() else _ZERO
+
+
+def _number(value: Any) -> float:
+    """
+    Значение поля для сопоставления. Равенство float совпадает с равенством Decimal
+    по кратчайшей записи числа, поэтому Decimal нужен только на границе допуска.
+    """
+    if value.__class__ is float:
+        return value if math.isfinite(value) else 0.0
+    if value.__class__ is int:
+        return float(value)
+    return float(_decimal(value))
+
+
+def _differs(first: float, second: float, tolerance: Decimal) -> bool:
+    """Числа отличаются больше чем на допуск (сравнение в Decimal, без погрешности float)"""
+    if first == second:
+        return False
+    return not tolerance or abs(_decimal(first) - _decimal(second)) > tolerance
+
+
+def _code(value: Any) -> str:
+    return _NON_DIGITS.sub("", "" if value is None else str(value).strip())[:6]
+
+
+def _words(value: Any) -> List[str]:
+    text = "" if value is None else str(value).strip()
+    return _NON_WORD.sub("", text).lower().split()
+
+
+def descriptions_match(first: Any, second: Any) -> bool:
+    """Каждое слово более короткого описания входит в какое-то слово другого (или наоборот)"""
+    if first == second:
+        return True
+    words1, words2 = _words(first), _words(second)
+    if not words1 or not words2:
+        return True
+    shorter, longer = (words1, words2) if len(words1) <= len(words2) else (words2, words1)
+    return all(any(long in short or short in long for long in longer) for short in shorter)
+
+
+class _Line:
+    """
+    Строка одной из сторон: нормализованные код и числа + положение в контейнере.
+    group - номер контейнера из записи (если пуст - ключ контейнера в ответе).
+    """
+
+    __slots__ = ("container", "row", "record", "code", "group", "numbers")
+
+    def __init__(self, container: str, row: int, record: dict, code: str):
+        self.container = container
+        self.row = row
+        self.record = record
+        self.code = code
+        self.group = str(record.get(CONTAINER_FIELD) or container or "").strip()
+        places = _number(record.get(NUMERIC_FIELDS[PLACES]))
+        weight = _number(record.get(NUMERIC_FIELDS[WEIGHT]))
+        amount = _number(record.get(NUMERIC_FIELDS[AMOUNT]))
+        # Значения ниже порога считаются нулевыми (оба "нулевые" - совпадают)
+        self.numbers = (
+            places,
+            0.0 if weight < _FLOAT_FLOORS[WEIGHT] else weight,
+            0.0 if amount < _FLOAT_FLOORS[AMOUNT] else amount,
+        )
+
+    def ref(self) -> Dict[str, Any]:
+        return {"container": self.container, "row": self.row, "values": self.record}
+
+
+def _key_function(fields: Tuple[int, ...], tolerances: DiffTolerances):
+    """Ключ строки для уровня сопоставления: номер контейнера, код ТН ВЭД и числа fields"""
+    steps = [float(tolerances.values()[field]) for field in fields]
+    if not fields:
+        return lambda line: (line.group, line.code)
+    if not any(steps):
+        numbers = itemgetter(*fields)
+        return lambda line: (line.group, line.code, numbers(line.numbers))
+
+    def key(line: _Line) -> tuple:
+        # С допуском число заменяется номером интервала шириной в допуск: числа одного
+        # интервала отличаются меньше чем на допуск, пары из соседних ищет _pop_nearby
+        return (line.group, line.code, *(
+            line.numbers[field] // step if step else line.numbers[field]
+            for field, step in zip(fields, steps)
+        ))
+    return key
+
+
+def _nearby_shifts(fields: Tuple[int, ...], tolerances: DiffTolerances) -> List[Tuple[int, ...]]:
+    """Сдвиги номеров интервалов к соседним (по полям с допуском), без нулевого сдвига"""
+    values = tolerances.values()
+    shifts = product(*((-1, 0, 1) if values[field] else (0,) for field in fields))
+    return [shift for shift in shifts if any(shift)]
+
+
+def _pop_nearby(line: _Line, line_key: tuple, candidates: Dict[tuple, deque], fields: Tuple[int, ...],
+                shifts: List[Tuple[int, ...]], tolerances: DiffTolerances) -> Optional[_Line]:
+    """
+    Пара из соседних интервалов: числа по разные стороны границы интервала
+    (0.99999 и 1.00001 при допуске 1) тоже могут быть в пределах допуска.
+    """
+    values = tolerances.values()
+    prefix, buckets = line_key[:2], line_key[2:]
+    for shift in shifts:
+        queue = candidates.get((*prefix, *(bucket + offset for bucket, offset in zip(buckets, shift))))
+        if not queue:
+            continue
+        for index, other in enumerate(queue):
+            if not any(_differs(line.numbers[field], other.numbers[field], values[field]) for field in fields):
+                del queue[index]
+                return other
+    return None
+
+
+def _lines(containers: Dict[str, List[dict]]) -> List[_Line]:
+    codes = {}  # коды ТН ВЭД повторяются - нормализуются один раз
+    lines = []
+    for container, records in containers.items():
+        for row, record in enumerate(records):
+            raw_code = record.get(CODE_FIELD)
+            code = codes.get(raw_code)
+            if code is None:
+                code = codes[raw_code] = _code(raw_code)
+            lines.append(_Line(container, row, record, code))
+    return lines
+
+
+def _in_scope(declaration_lines: List[_Line], invoice_lines: List[_Line]) -> List[_Line]:
+    """Строки декларации из контейнеров инвойса (без инвойса - все строки)"""
+    groups = {line.group for line in invoice_lines}
+    if not groups:
+        return declaration_lines
+    return [line for line in declaration_lines if line.group in groups]
+
+
+def _field_deltas(declaration: _Line, invoice: _Line, tolerances: DiffTolerances) -> Dict[str, Dict[str, Any]]:
+    """Поля пары, отличающиеся сверх допуска (код ТН ВЭД у пары всегда общий - он входит в ключ)"""
+    fields = {}
+    for field, first, second, tolerance in zip(NUMERIC_FIELDS, declaration.numbers, invoice.numbers,
+                                                tolerances.values()):
+        if _differs(first, second, tolerance):
+            declaration_value = declaration.record.get(field)
+            invoice_value = invoice.record.get(field)
+            fields[field] = {
+                "declaration": declaration_value,
+                "invoice": invoice_value,
+                "delta": float(_decimal(invoice_value) - _decimal(declaration_value)),
+            }
+    if not descriptions_match(declaration.record.get(DESCRIPTION_FIELD), invoice.record.get(DESCRIPTION_FIELD)):
+        fields[DESCRIPTION_FIELD] = {
+            "declaration": declaration.record.get(DESCRIPTION_FIELD),
+            "invoice": invoice.record.get(DESCRIPTION_FIELD),
+        }
+    return fields
+
+
+def _totals(lines: List[_Line]) -> Dict[str, List[Decimal]]:
+    """Точные (Decimal) суммы числовых полей по номеру контейнера из записи"""
+    totals = {}
+    decimals = {}  # одинаковые значения переводятся в Decimal один раз
+    for line in lines:
+        record = line.record
+        sums = totals.get(line.group)
+        if sums is None:
+            sums = totals[line.group] = [_ZERO, _ZERO, _ZERO]
+        for field, name in enumerate(NUMERIC_FIELDS):
+            value = record.get(name)
+            number = decimals.get(value)
+            if number is None:
+                number = decimals[value] = _decimal(value)
+            sums[field] += number
+    return totals
+
+
+def _totals_delta(declaration: List[Decimal], invoice: List[Decimal], tolerances: DiffTolerances) -> Dict[str, Any]:
+    equal = True
+    for first, second, floor, tolerance in zip(declaration, invoice, ZERO_FLOORS, tolerances.values()):
+        both_zero = floor is not None and first < floor and second < floor
+        if not both_zero and abs(second - first) > tolerance:
+            equal = False
+    return {
+        "declaration": {field: float(value) for field, value in zip(NUMERIC_FIELDS, declaration)},
+        "invoice": {field: float(value) for field, value in zip(NUMERIC_FIELDS, invoice)},
+        "delta": {field: float(second - first) for field, first, second in zip(NUMERIC_FIELDS, declaration, invoice)},
+        "equal": equal,
+    }
+
+
+def diff_containers(declaration_containers: Dict[str, List[dict]], invoice_containers: Dict[str, List[dict]],
+                    tolerances: Optional[DiffTolerances] = None) -> Dict[str, Any]:
+    """
+    Сравнивает строки декларации и инвойса по контейнерам. Контейнеры декларации,
+    которых нет в инвойсе, не сравниваются (их строки - в summary["out_of_scope_lines"]).
+
+    Returns:
+        {"summary": счетчики, "mismatches": расхождения, "containers": итоги по контейнерам,
+         "totals": общие итоги, "tolerances": допуски}; строки в расхождениях - ссылки
+        {"container", "row", "values"} на исходные контейнеры
+    """
+    tolerances = tolerances or DiffTolerances.from_env()
+    all_declaration_lines = _lines(declaration_containers)
+    invoice_lines = _lines(invoice_containers)
+    declaration_lines = _in_scope(all_declaration_lines, invoice_lines)
+
+    pairs: List[Tuple[_Line, _Line]] = []
+    pending_declaration = declaration_lines
+    pending_invoice = invoice_lines
+    for fields in MATCH_LEVELS:
+        if not pending_declaration or not pending_invoice:
+            break
+        key = _key_function(fields, tolerances)
+        shifts = _nearby_shifts(fields, tolerances)
+        candidates: Dict[tuple, deque] = {}
+        for line in pending_invoice:
+            queue = candidates.get(key(line))
+            if queue is None:
+                queue = candidates[key(line)] = deque()
+            queue.append(line)
+        unmatched = []
+        for line in pending_declaration:
+            line_key = key(line)
+            queue = candidates.get(line_key)
+            if queue:
+                pairs.append((line, queue.popleft()))
+                continue
+            other = _pop_nearby(line, line_key, candidates, fields, shifts, tolerances) if shifts else None
+            if other is None:
+                unmatched.append(line)
+            else:
+                pairs.append((line, other))
+        pending_declaration = unmatched
+        pending_invoice = [line for queue in candidates.values() for line in queue]
+
+    mismatches = []
+    matched = 0
+    for declaration, invoice in pairs:
+        fields = _field_deltas(declaration, invoice, tolerances)
+        if not fields:
+            matched += 1
+            continue
+        mismatches.append({
+            "type": "mismatch",
+            "declaration": declaration.ref(),
+            "invoice": invoice.ref(),
+            "fields": fields,
+        })
+    mismatched = len(mismatches)
+    mismatches.extend({"type": "missing_in_invoice", "declaration": line.ref()} for line in pending_declaration)
+    # Порядок строк инвойса без пары - как в исходных контейнерах
+    pending_invoice.sort(key=lambda line: (line.container, line.row))
+    mismatches.extend({"type": "missing_in_declaration", "invoice": line.ref()} for line in pending_invoice)
+
+    declaration_totals = _totals(declaration_lines)
+    invoice_totals = _totals(invoice_lines)
+    empty = [_ZERO, _ZERO, _ZERO]
+    containers = {
+        container: _totals_delta(declaration_totals.get(container, empty), invoice_totals.get(container, empty),
+                                 tolerances)
+        for container in list(declaration_totals) + [c for c in invoice_totals if c not in declaration_totals]
+    }
+    overall_declaration = [sum(values, _ZERO) for values in zip(empty, *declaration_totals.values())]
+    overall_invoice = [sum(values, _ZERO) for values in zip(empty, *invoice_totals.values())]
+
+    return {
+        "summary": {
+            "declaration_lines": len(declaration_lines),
+            "out_of_scope_lines": len(all_declaration_lines) - len(declaration_lines),
+            "invoice_lines": len(invoice_lines),
+            "matched": matched,
+            "mismatched": mismatched,
+            "missing_in_invoice": len(pending_declaration),
+            "missing_in_declaration": len(pending_invoice),
+            "containers_with_delta": sum(1 for totals in containers.values() if not totals["equal"]),
+        },
+        "mismatches": mismatches,
+        "containers": containers,
+        "totals": _totals_delta(overall_declaration, overall_invoice, tolerances),
+        "tolerances": tolerances.to_dict(),
+    }
+
+
+def diff_compare_result(result: Dict, tolerances: Optional[DiffTolerances] = None) -> Dict:
+    """
+    Ответ сравнения в режиме расхождений: шапки XML и инвойса и документы как
+    в полном ответе, но вместо списков строк контейнеров - результат diff_containers.
+    """
+    if not result.get("success"):
+        return result
+    data = result["data"]
+    xml_data = data["xml_data"]
+    invoice_data = data.get("invoice_data")
+    diff = diff_containers(
+        xml_data.get("containers") or {},
+        (invoice_data or {}).get("containers") or {},
+        tolerances,
+    )
+    return {
+        "success": True,
+        "data": {
+            "xml_data": {key: value for key, value in xml_data.items() if key != "containers"},
+            "xml_documents": data.get("xml_documents", []),
+            "invoice_data": (
+                {key: value for key, value in invoice_data.items() if key != "containers"}
+                if invoice_data else None
+            ),
+            "diff": diff,
+        },
+    }
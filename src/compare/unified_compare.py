@@ -1,7 +1,11 @@
-from typing import Dict, List
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional
 import xml.etree.ElementTree as ET
 from src.models import ExcelData, Totals, Calc, DocumentInfo
 from src.processors.unified import process_unified
+from src import metrics
+from src.ingest import Source, open_source, source_size
 
 
 def sort_records_by_criteria(records: List[dict]) -> List[dict]:
@@ -22,111 +26,280 @@ def sort_records_by_criteria(records: List[dict]) -> List[dict]:
     return sorted(records, key=sort_key)
 
 
-def extract_xml_data_and_documents(
-    xml_bytes: bytes,
-    invoice_data=None,
-    debug_container_transport: bool = False,
-) -> tuple[ExcelData, List[DocumentInfo], str]:
-    """Извлекает данные из XML в формате ExcelData и отдельно документы."""
-    try:
-        root = ET.fromstring(xml_bytes)
-        # Транспортный рег. идентификатор (берем из "шапки" XML)
-        # Используем endswith() чтобы не зависеть от префиксов namespace (ns2/ns3/и т.п.)
-        transport_means_reg_id = ""
-        for ch in root.iter():
-            if ch.tag.endswith("TransportMeansRegId") and (ch.text or "").strip():
-                transport_means_reg_id = (ch.text or "").strip()
-                break
-
-        # Находим все блоки с деталями товарных позиций
-        goods_items = []
-        for elem in root.iter():
-            if elem.tag.endswith("TransitGoodsItemDetails") or elem.tag.endswith("GoodsItemDetails"):
-                goods_items.append(elem)
-
-        if not goods_items:
-            return (
-                ExcelData(
-                    containers={},
-                    totals=Totals(),
-                    calc=Calc(),
-                    sender_name="",
-                    sender_address="",
-                    recipient_name="",
-                    recipient_address="",
-                ),
-                [],
-                transport_means_reg_id,
-            )
-
-        # Извлекаем данные отправителя из XML
-        sender_name = ""
-        sender_address_parts = []
-        
-        # Ищем данные отправителя в XML - ищем блок ns3:ConsignorDetails
-        for elem in root.iter():
-            if elem.tag.endswith("ConsignorDetails"):
-                # Находим название отправителя внутри ConsignorDetails
-                for child in elem:
-                    if child.tag.endswith("SubjectName") and (child.text or "").strip():
-                        sender_name = (child.text or "").strip()
-                    
-                    # Находим блок адреса внутри ConsignorDetails
-                    if child.tag.endswith("SubjectAddressDetails"):
-                        # Проходим по всем дочерним элементам адреса
-                        for address_child in child:
-                            # Пропускаем AddressKindCode
-                            if not address_child.tag.endswith("AddressKindCode") and (address_child.text or "").strip():
-                                sender_address_parts.append((address_child.text or "").strip())
-        
-        # Объединяем компоненты адреса в одну строку
-        sender_address = ", ".join(sender_address_parts) if sender_address_parts else ""
-        
-        # Извлекаем данные получателя из XML
-        recipient_name = ""
-        recipient_address_parts = []
-        
-        # Ищем данные получателя в XML - ищем блок ns3:ConsigneeDetails
-        for elem in root.iter():
-            if elem.tag.endswith("ConsigneeDetails"):
-                # Находим название получателя внутри ConsigneeDetails
-                for child in elem:
-                    if child.tag.endswith("SubjectName") and (child.text or "").strip():
-                        recipient_name = (child.text or "").strip()
-                    
-                    # Находим блок адреса внутри ConsigneeDetails
-                    if child.tag.endswith("SubjectAddressDetails"):
-                        # Проходим по всем дочерним элементам адреса
-                        for address_child in child:
-                            # Пропускаем AddressKindCode
-                            if not address_child.tag.endswith("AddressKindCode") and (address_child.text or "").strip():
-                                recipient_address_parts.append((address_child.text or "").strip())
-        
-        # Объединяем компоненты адреса получателя в одну строку
-        recipient_address = ", ".join(recipient_address_parts) if recipient_address_parts else ""
-        
-        # Определяем коды стран отправления и назначения
-        departure_country_code = ""
-        destination_country_code = ""
-        for elem in root.iter():
-            if elem.tag.endswith("DepartureCountryCode") and (elem.text or "").strip():
-                departure_country_code = (elem.text or "").strip()
-            if elem.tag.endswith("DestinationCountryCode") and (elem.text or "").strip():
-                destination_country_code = (elem.text or "").strip()
-
-        # Пломбы (количество и номера)
-        seal_quantity = 0
-        seal_ids: List[str] = []
-        for elem in root.iter():
-            if elem.tag.endswith("SealQuantity") and (elem.text or "").strip():
-                try:
-                    seal_quantity = int((elem.text or "").strip())
-                except Exception:
-                    pass
-            if elem.tag.endswith("CustomsIdentificationMeansId") and (elem.text or "").strip():
-                seal_ids.append((elem.text or "").strip())
-
-        # Создаем ExcelData
+# Элементы шапки/документов декларации: вид -> суффикс тега.
+# Сравнение по endswith(), чтобы не зависеть от префиксов namespace (ns2/ns3/и т.п.)
+DECLARATION_TAG_SUFFIXES = (
+    ("transport_means_reg_id", "TransportMeansRegId"),
+    ("goods_item", "TransitGoodsItemDetails"),
+    ("goods_item", "GoodsItemDetails"),
+    ("consignor", "ConsignorDetails"),
+    ("consignee", "ConsigneeDetails"),
+    ("departure_country_code", "DepartureCountryCode"),
+    ("destination_country_code", "DestinationCountryCode"),
+    ("seal_quantity", "SealQuantity"),
+    ("seal_id", "CustomsIdentificationMeansId"),
+    ("document", "TDPresentedDocDetails"),
+)
+
+# Текстовые поля товарной позиции: поле -> суффикс тега (первое непустое значение)
+GOODS_TEXT_SUFFIXES = (
+    ("commodity_code", "CommodityCode"),
+    ("goods_description", "GoodsDescriptionText"),
+    ("gross_mass", "UnifiedGrossMassMeasure"),
+    ("goods_prohibition_free_code", "GoodsProhibitionFreeCode"),
+    ("package_availability_code", "PackageAvailabilityCode"),
+    ("cargo_quantity", "CargoQuantity"),
+    ("package_quantity", "PackageQuantity"),
+    ("value_amount", "CAValueAmount"),
+    ("package_kind", "PackageKindCode"),
+)
+
+# Текстовые поля документа: поле -> суффикс тега
+DOCUMENT_TEXT_SUFFIXES = (
+    ("DocKindCode", "DocKindCode"),
+    ("DocName", "DocName"),
+    ("DocId", "DocId"),
+    ("DocCreationDate", "DocCreationDate"),
+)
+
+# Элементы, поддерево которых нужно целиком на момент закрытия тега
+RETAINED_KINDS = frozenset({"goods_item", "document", "consignor", "consignee"})
+
+# Декларации больше этого размера (в байтах) разбираются потоково через iterparse
+STREAMING_THRESHOLD_BYTES = int(os.getenv("XML_STREAMING_THRESHOLD", str(32 * 1024 * 1024)))
+
+# Кэши "тег -> виды/поля": каждый уникальный тег сравнивается с суффиксами один раз.
+# Теги (с namespace) приходят из загруженных файлов, поэтому размер кэшей ограничен
+TAG_CACHE_SIZE = 1024
+
+
+def _local_name(tag: str) -> str:
+    return tag.split("}", 1)[1] if "}" in tag else tag
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def _declaration_kinds(tag: str) -> tuple:
+    return tuple(dict.fromkeys(kind for kind, suffix in DECLARATION_TAG_SUFFIXES if tag.endswith(suffix)))
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def _goods_fields(tag: str) -> tuple:
+    fields = [field for field, suffix in GOODS_TEXT_SUFFIXES if tag.endswith(suffix)]
+    # Контейнер берем по точному local-name, валюту - из атрибута CAValueAmount
+    if _local_name(tag) == "ContainerId":
+        fields.append("container_id")
+    if tag.endswith("CAValueAmount"):
+        fields.append("currency")
+    return tuple(fields)
+
+
+@lru_cache(maxsize=TAG_CACHE_SIZE)
+def _document_fields(tag: str) -> tuple:
+    return tuple(field for field, suffix in DOCUMENT_TEXT_SUFFIXES if tag.endswith(suffix))
+
+
+def extract_goods_item(item: ET.Element) -> Dict[str, str]:
+    """
+    Извлекает поля товарной позиции за один проход по ее поддереву.
+    Для каждого поля берется первое непустое значение в порядке документа.
+    """
+    values = {}
+    wanted = len(GOODS_TEXT_SUFFIXES) + 2
+    for ch in item.iter():
+        fields = _goods_fields(ch.tag)
+        if not fields:
+            continue
+        text = None
+        for field in fields:
+            if field in values:
+                continue
+            if field == "currency":
+                if "currencyCode" in ch.attrib:
+                    values[field] = ch.attrib["currencyCode"]
+                continue
+            if text is None:
+                text = (ch.text or "").strip()
+            if text:
+                values[field] = text
+        if len(values) == wanted:
+            break
+    return values
+
+
+def extract_document(elem: ET.Element) -> Dict[str, str]:
+    """Извлекает поля документа TDPresentedDocDetails за один проход."""
+    values = {}
+    for ch in elem.iter():
+        fields = _document_fields(ch.tag)
+        if not fields:
+            continue
+        text = (ch.text or "").strip()
+        if not text:
+            continue
+        for field in fields:
+            if field not in values:
+                values[field] = text
+        if len(values) == len(DOCUMENT_TEXT_SUFFIXES):
+            break
+    return values
+
+
+def _party_details(elem: ET.Element, address_parts: List[str]) -> str:
+    """
+    Разбирает ConsignorDetails/ConsigneeDetails: возвращает название (последнее непустое)
+    и дописывает компоненты адреса (кроме AddressKindCode) в address_parts.
+    """
+    name = ""
+    for child in elem:
+        if child.tag.endswith("SubjectName") and (child.text or "").strip():
+            name = (child.text or "").strip()
+        if child.tag.endswith("SubjectAddressDetails"):
+            for address_child in child:
+                if not address_child.tag.endswith("AddressKindCode") and (address_child.text or "").strip():
+                    address_parts.append((address_child.text or "").strip())
+    return name
+
+
+def _goods_record(fields: Dict[str, str]) -> dict:
+    """Строит запись товара в формате ExcelData из полей товарной позиции."""
+    commodity_code = fields.get("commodity_code", "")
+    cargo_quantity = fields.get("cargo_quantity", "")
+    package_quantity = fields.get("package_quantity", "")
+    gross_mass = fields.get("gross_mass", "")
+    value_amount = fields.get("value_amount", "")
+    package_kind = fields.get("package_kind", "")
+    currency = fields.get("currency", "")
+    return {
+        "Код ТН ВЭД": int(commodity_code) if commodity_code and commodity_code.isdigit() else 0,
+        "Коммерческое описание товара": fields.get("goods_description", ""),
+        "Признак товара, свободного от применения запретов и ограничений (всегда 1)": 1 if fields.get("goods_prohibition_free_code", "") == "C" else 0,
+        "Информация об упаковке (0-БЕЗ, 1 С)": fields.get("package_availability_code", ""),
+        "Количество грузовых мест": float(cargo_quantity) if cargo_quantity else 0,
+        "Вид информации об упаковке (всегда 0)": 0,
+        "Вид упаковки ": package_kind if package_kind else "PK",
+        "Количество упаковок": float(package_quantity) if package_quantity else 0,
+        "Номер контейнера": fields.get("container_id") or "Без номера контейнера",
+        "Вес брутто": float(gross_mass) if gross_mass else 0,
+        "Валюта": currency if currency else "USD",
+        "Сумма": float(value_amount) if value_amount else 0
+    }
+
+
+def _raw_document(fields: Dict[str, str]):
+    """Документ без проверок по инвойсу или None, если документ пропускается."""
+    doc_kind = fields.get("DocKindCode", "")
+    doc_name = fields.get("DocName", "")
+    # Документы без кода не выводим
+    if not doc_kind:
+        return None
+    # Устанавливаем специальное название для документов с кодом 02013
+    if doc_kind == "02013" and doc_name == "":
+        doc_name = "ЖД НАКЛАДНАЯ"
+    return {
+        "DocKindCode": doc_kind,
+        "DocName": doc_name,
+        "DocId": fields.get("DocId", ""),
+        "DocCreationDate": fields.get("DocCreationDate", ""),
+    }
+
+
+def _empty_declaration(transport_means_reg_id: str = "") -> tuple[ExcelData, List[dict], str]:
+    return (
+        ExcelData(
+            containers={},
+            totals=Totals(),
+            calc=Calc(),
+            sender_name="",
+            sender_address="",
+            recipient_name="",
+            recipient_address="",
+        ),
+        [],
+        transport_means_reg_id,
+    )
+
+
+class DeclarationCollector:
+    """
+    Накапливает данные декларации по мере обхода элементов.
+
+    Каждый элемент передается с порядковым номером в порядке документа
+    (как в root.iter()), поэтому результат не зависит от того, в каком
+    порядке элементы были обработаны: при обходе дерева или по событиям
+    закрытия тегов iterparse.
+    """
+
+    def __init__(self):
+        self.transport_means_reg_ids = []  # [(order, text)]
+        self.goods_records = []  # [(order, record)]
+        self.consignors = []  # [(order, name, address_parts)]
+        self.consignees = []
+        self.departure_country_codes = []
+        self.destination_country_codes = []
+        self.seal_quantities = []
+        self.seal_ids = []
+        self.documents = []  # [(order, raw_document)]
+        self.unordered = False  # элементы могли прийти не в порядке документа
+
+    def add(self, order: int, elem: ET.Element, kinds: tuple) -> None:
+        for kind in kinds:
+            if kind == "goods_item":
+                self.goods_records.append((order, _goods_record(extract_goods_item(elem))))
+            elif kind == "document":
+                doc = _raw_document(extract_document(elem))
+                if doc is not None:
+                    self.documents.append((order, doc))
+            elif kind == "consignor":
+                parts = []
+                self.consignors.append((order, _party_details(elem, parts), parts))
+            elif kind == "consignee":
+                parts = []
+                self.consignees.append((order, _party_details(elem, parts), parts))
+            else:
+                text = (elem.text or "").strip()
+                if not text:
+                    continue
+                if kind == "transport_means_reg_id":
+                    self.transport_means_reg_ids.append((order, text))
+                elif kind == "departure_country_code":
+                    self.departure_country_codes.append((order, text))
+                elif kind == "destination_country_code":
+                    self.destination_country_codes.append((order, text))
+                elif kind == "seal_quantity":
+                    try:
+                        self.seal_quantities.append((order, int(text)))
+                    except Exception:
+                        pass
+                elif kind == "seal_id":
+                    self.seal_ids.append((order, text))
+
+    def _ordered(self, entries: list) -> list:
+        if self.unordered:
+            entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def result(self, debug_container_transport: bool = False) -> tuple[ExcelData, List[dict], str]:
+        # Транспортный рег. идентификатор - первый непустой (из "шапки" XML)
+        transport_means_reg_id = self._ordered(self.transport_means_reg_ids)[0][1] if self.transport_means_reg_ids else ""
+
+        goods_records = [record for _, record in self._ordered(self.goods_records)]
+        if not goods_records:
+            return _empty_declaration(transport_means_reg_id)
+
+        def party(entries):
+            name = ""
+            address_parts = []
+            for _, entry_name, parts in self._ordered(entries):
+                name = entry_name or name
+                address_parts.extend(parts)
+            return name, ", ".join(address_parts) if address_parts else ""
+
+        def last(entries, default):
+            return self._ordered(entries)[-1][1] if entries else default
+
+        sender_name, sender_address = party(self.consignors)
+        recipient_name, recipient_address = party(self.consignees)
+
         excel_data = ExcelData(
             containers={},
             totals=Totals(),
@@ -135,222 +308,17 @@ def extract_xml_data_and_documents(
             sender_address=sender_address,
             recipient_name=recipient_name,
             recipient_address=recipient_address,
-            departure_country_code=departure_country_code,
-            destination_country_code=destination_country_code,
-            seal_quantity=seal_quantity,
-            seal_ids=seal_ids,
+            departure_country_code=last(self.departure_country_codes, ""),
+            destination_country_code=last(self.destination_country_codes, ""),
+            seal_quantity=last(self.seal_quantities, 0),
+            seal_ids=[text for _, text in self._ordered(self.seal_ids)],
         )
-        
-        documents = []
+
         total_quantity = 0
         total_weight = 0
         total_amount = 0
-
-        def find_first_text(parent: ET.Element, local_name: str) -> str:
-            for ch in parent.iter():
-                if ch.tag.endswith(local_name) and (ch.text or "").strip():
-                    return (ch.text or "").strip()
-            return ""
-
-        def find_first_text_exact(parent: ET.Element, local_name: str) -> str:
-            """Ищет тег по точному local-name (без namespace)."""
-            for ch in parent.iter():
-                tag = ch.tag
-                parsed_local_name = tag.split("}", 1)[1] if "}" in tag else tag
-                if parsed_local_name == local_name and (ch.text or "").strip():
-                    return (ch.text or "").strip()
-            return ""
-        
-        def find_first_attribute(parent: ET.Element, local_name: str, attr_name: str) -> str:
-            for ch in parent.iter():
-                if ch.tag.endswith(local_name) and attr_name in ch.attrib:
-                    return ch.attrib[attr_name]
-            return ""
-
-        # Массив значений ns2:ContainerId из каждого товара + TransportMeansRegId из шапки
-        container_transport_array: List[dict] = []
-
-        # Извлекаем все документы из всего XML (один раз, без дубликатов)
-        for elem in root.iter():
-            if elem.tag.endswith("TDPresentedDocDetails"):
-                doc_kind = find_first_text(elem, "DocKindCode")
-                doc_name = find_first_text(elem, "DocName")
-                doc_id = find_first_text(elem, "DocId")
-                doc_date = find_first_text(elem, "DocCreationDate")
-                
-                # Добавляем документ если есть данные и код не в списке исключений
-                if doc_kind or doc_name or doc_id or doc_date:
-                    # Исключаем документы с кодами 02013, 11002, 09021
-                    if doc_kind not in [""]:
-                        # Проверяем документы с кодом 09034 на соответствие дате 31.05.2011
-                        has_error = False
-                        error_message = ""
-                        
-                        if doc_kind == "09034":
-                            # Проверяем различные форматы даты
-                            expected_date_formats = [
-                                "31.05.2011",
-                                "2011-05-31",
-                                "2011/05/31",
-                                "31/05/2011",
-                                "2011-05-31T00:00:00",
-                                "2011-05-31T00:00:00Z"
-                            ]
-                            
-                            # Нормализуем дату для сравнения
-                            normalized_date = doc_date.strip() if doc_date else ""
-                            
-                            # Проверяем соответствие ожидаемой дате
-                            if normalized_date not in expected_date_formats:
-                                has_error = True
-                                error_message = f"Ошибка: Документ с кодом 09034 должен иметь дату 31.05.2011, но получена дата: {normalized_date}"
-                        
-                        # Проверяем документы с кодами 04021 и 04131 на соответствие данным инвойса
-                        elif doc_kind in ["04021", "04131"] and invoice_data:
-                            # Нормализуем номера инвойсов для сравнения (убираем ведущие нули)
-                            def normalize_invoice_number(invoice_num):
-                                """Нормализует номер инвойса, убирая ведущие нули"""
-                                if not invoice_num:
-                                    return ""
-                                
-                                # Преобразуем в строку, если это не строка
-                                invoice_str = str(invoice_num).strip()
-                                
-                                # Если это число, убираем ведущие нули
-                                if invoice_str.isdigit():
-                                    return str(int(invoice_str))
-                                
-                                return invoice_str
-                            
-                            normalized_doc_id = normalize_invoice_number(doc_id)
-                            normalized_invoice_id = normalize_invoice_number(invoice_data.invoice)
-                            
-                            # Проверяем соответствие DocId с invoice_data.invoice
-                            if normalized_doc_id != normalized_invoice_id:
-                                has_error = True
-                                error_message = f"Ошибка: Документ с кодом {doc_kind} должен иметь DocId равный номеру инвойса ({invoice_data.invoice}), но получен: {doc_id}. Типы: DocId={type(doc_id)}, Invoice={type(invoice_data.invoice)}"
-                            # Проверяем соответствие DocCreationDate с invoice_data.date_invoice
-                            else:
-                                # Преобразуем даты в формат YYYY-MM-DD для сравнения
-                                def convert_to_yyyy_mm_dd(date_str):
-                                    """Преобразует дату в формат YYYY-MM-DD"""
-                                    if not date_str or date_str.strip() == "":
-                                        return ""
-                                    
-                                    date_str = date_str.strip()
-                                    
-                                    # Если дата уже в формате YYYY-MM-DD, возвращаем как есть
-                                    if len(date_str) == 10 and date_str.count('-') == 2:
-                                        return date_str
-                                    
-                                    # Если дата в формате DD.MM.YYYY, конвертируем в YYYY-MM-DD
-                                    if len(date_str) == 10 and date_str.count('.') == 2:
-                                        try:
-                                            parts = date_str.split('.')
-                                            if len(parts) == 3:
-                                                return f"{parts[2]}-{parts[1]}-{parts[0]}"
-                                        except:
-                                            pass
-                                    
-                                    # Если дата в формате YYYY/MM/DD, конвертируем в YYYY-MM-DD
-                                    if len(date_str) == 10 and date_str.count('/') == 2:
-                                        try:
-                                            parts = date_str.split('/')
-                                            if len(parts) == 3:
-                                                return f"{parts[0]}-{parts[1]}-{parts[2]}"
-                                        except:
-                                            pass
-                                    
-                                    # Если дата содержит время (ISO формат), извлекаем только дату
-                                    if 'T' in date_str:
-                                        date_part = date_str.split('T')[0]
-                                        return convert_to_yyyy_mm_dd(date_part)
-                                    
-                                    # Если дата содержит пробел и время (формат YYYY-MM-DD HH:MM:SS), извлекаем только дату
-                                    if ' ' in date_str:
-                                        date_part = date_str.split(' ')[0]
-                                        return convert_to_yyyy_mm_dd(date_part)
-                                    
-                                    # Если ничего не подошло, возвращаем исходную строку
-                                    return date_str
-                                
-                                doc_date_formatted = convert_to_yyyy_mm_dd(doc_date)
-                                invoice_date_formatted = convert_to_yyyy_mm_dd(invoice_data.date_invoice)
-                                
-                                if doc_date_formatted != invoice_date_formatted:
-                                    has_error = True
-                                    error_message = f"Ошибка: Документ с кодом {doc_kind} должен иметь дату равную дате инвойса ({invoice_date_formatted}), но получена дата: {doc_date_formatted}"
-                        
-                        # Устанавливаем специальное название для документов с кодом 02013
-                        final_doc_name = doc_name
-                        if doc_kind == "02013" and doc_name == "":
-                            final_doc_name = "ЖД НАКЛАДНАЯ"
-                        
-                        doc = DocumentInfo(
-                            DocKindCode=doc_kind,
-                            DocName=final_doc_name,
-                            DocId=doc_id,
-                            DocCreationDate=doc_date,
-                            has_error=has_error,
-                            error_message=error_message
-                        )
-                        # Проверяем на дубликаты перед добавлением
-                        doc_exists = False
-                        for existing_doc in documents:
-                            if (existing_doc.DocKindCode == doc.DocKindCode and
-                                existing_doc.DocName == doc.DocName and
-                                existing_doc.DocId == doc.DocId and
-                                existing_doc.DocCreationDate == doc.DocCreationDate):
-                                doc_exists = True
-                                break
-                        
-                        if not doc_exists:
-                            documents.append(doc)
-
-        # Извлекаем данные из каждого товарного блока
-        for item in goods_items:
-            # Извлекаем основные данные
-            commodity_code = find_first_text(item, "CommodityCode")
-            goods_description = find_first_text(item, "GoodsDescriptionText")
-            gross_mass = find_first_text(item, "UnifiedGrossMassMeasure")
-            goods_prohibition_free_code = find_first_text(item, "GoodsProhibitionFreeCode")
-            package_availability_code = find_first_text(item, "PackageAvailabilityCode")
-            cargo_quantity = find_first_text(item, "CargoQuantity")
-            package_quantity = find_first_text(item, "PackageQuantity")
-            # Берем именно точный тег ContainerId конкретного товара
-            container_id = find_first_text_exact(item, "ContainerId")
-            value_amount = find_first_text(item, "CAValueAmount")
-            currency = find_first_attribute(item, "CAValueAmount", "currencyCode")
-            package_kind = find_first_text(item, "PackageKindCode")
-            
-            # Создаем запись товара
-            if not container_id:
-                container_id = "Без номера контейнера"
-
-            if debug_container_transport:
-                container_transport_array.append(
-                    {
-                        "TransportMeansRegId": transport_means_reg_id,
-                        "ContainerId": container_id,
-                    }
-                )
-            
-            record = {
-                "Код ТН ВЭД": int(commodity_code) if commodity_code and commodity_code.isdigit() else 0,
-                "Коммерческое описание товара": goods_description,
-                "Признак товара, свободного от применения запретов и ограничений (всегда 1)": 1 if goods_prohibition_free_code == "C" else 0,
-                "Информация об упаковке (0-БЕЗ, 1 С)": package_availability_code,
-                "Количество грузовых мест": float(cargo_quantity) if cargo_quantity else 0,
-                "Вид информации об упаковке (всегда 0)": 0,
-                "Вид упаковки ": package_kind if package_kind else "PK",
-                "Количество упаковок": float(package_quantity) if package_quantity else 0,
-                "Номер контейнера": container_id,
-                "Вес брутто": float(gross_mass) if gross_mass else 0,
-                "Валюта": currency if currency else "USD",
-                "Сумма": float(value_amount) if value_amount else 0
-            }
-            
-            # Добавляем в контейнер
+        for record in goods_records:
+            container_id = record["Номер контейнера"]
             if container_id not in excel_data.containers:
                 excel_data.containers[container_id] = []
             excel_data.containers[container_id].append(record)
@@ -358,8 +326,7 @@ def extract_xml_data_and_documents(
             total_quantity += record["Количество грузовых мест"]
             total_weight += record["Вес брутто"]
             total_amount += record["Сумма"]
-        
-        # Устанавливаем итоги
+
         excel_data.totals = Totals(
             total_quantity=total_quantity,
             total_weight=total_weight,
@@ -371,12 +338,255 @@ def extract_xml_data_and_documents(
             calc_amount=total_amount
         )
 
+        # Документы без дубликатов (первое вхождение в порядке документа)
+        documents = []
+        seen_documents = set()
+        for _, doc in self._ordered(self.documents):
+            doc_key = (doc["DocKindCode"], doc["DocName"], doc["DocId"], doc["DocCreationDate"])
+            if doc_key not in seen_documents:
+                seen_documents.add(doc_key)
+                documents.append(doc)
+
         if debug_container_transport:
-            # Печатаем массив один раз на обработку XML
-            print(container_transport_array)
-        
+            # Массив значений ContainerId из каждого товара + TransportMeansRegId из шапки
+            print([
+                {"TransportMeansRegId": transport_means_reg_id, "ContainerId": record["Номер контейнера"]}
+                for record in goods_records
+            ])
+
         return excel_data, documents, transport_means_reg_id
 
+
+def _collect_tree(source: Source) -> DeclarationCollector:
+    """Один обход полного дерева (ET.fromstring/ET.parse) с диспетчеризацией по тегу."""
+    collector = DeclarationCollector()
+    if isinstance(source, (bytes, bytearray)):
+        root = ET.fromstring(source)
+    else:
+        with open_source(source) as f:
+            root = ET.parse(f).getroot()
+    for order, elem in enumerate(root.iter()):
+        kinds = _declaration_kinds(elem.tag)
+        if kinds:
+            collector.add(order, elem, kinds)
+    return collector
+
+
+def _collect_stream(source) -> DeclarationCollector:
+    """
+    Потоковый разбор через iterparse: элементы обрабатываются по закрытию тега
+    и сразу удаляются из дерева. В памяти остается только открытая ветка
+    (и поддерево текущей товарной позиции/документа), поэтому пиковое
+    потребление памяти не растет с размером декларации.
+    """
+    collector = DeclarationCollector()
+    # Вложенные элементы закрываются раньше родителя - порядок восстанавливается сортировкой
+    collector.unordered = True
+    stack = []  # [(elem, order, retained)]
+    retained_depth = 0  # сколько открытых предков нужны целиком
+    order = 0
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            retained = not RETAINED_KINDS.isdisjoint(_declaration_kinds(elem.tag))
+            if retained:
+                retained_depth += 1
+            stack.append((elem, order, retained))
+            order += 1
+            continue
+
+        _, elem_order, retained = stack.pop()
+        kinds = _declaration_kinds(elem.tag)
+        if kinds:
+            collector.add(elem_order, elem, kinds)
+        if retained:
+            retained_depth -= 1
+        if retained_depth == 0 and stack:
+            # Обработанные элементы больше не нужны: удаляем их из родителя
+            del stack[-1][0][:]
+    return collector
+
+
+def parse_declaration(
+    xml_bytes: Source,
+    debug_container_transport: bool = False,
+    streaming: Optional[bool] = None,
+) -> tuple[ExcelData, List[dict], str]:
+    """
+    Разбирает XML декларации один раз: шапка, товары и документы.
+
+    Все нужные элементы собираются за один обход (диспетчеризация по тегу),
+    поля каждой товарной позиции - за один проход по ее поддереву.
+    Документы возвращаются "сырыми" (без дубликатов) - проверки, зависящие
+    от инвойса, выполняет validate_documents().
+
+    Args:
+        xml_bytes: XML декларации - байты, путь к файлу или файловый объект
+        streaming: True - потоковый разбор через iterparse, False - через полное
+            дерево, None - выбор по размеру (STREAMING_THRESHOLD_BYTES).
+            Результат обоих режимов одинаковый.
+    """
+    if streaming is None:
+        streaming = source_size(xml_bytes) > STREAMING_THRESHOLD_BYTES
+    try:
+        started = metrics.start()
+        if streaming:
+            with open_source(xml_bytes) as source:
+                collector = _collect_stream(source)
+        else:
+            collector = _collect_tree(xml_bytes)
+        result = collector.result(debug_container_transport)
+        metrics.stop(
+            "declaration.parse_stream" if streaming else "declaration.parse_tree",
+            started,
+            sum(len(records) for records in result[0].containers.values()),
+        )
+        return result
+    except Exception as e:
+        return _empty_declaration()
+
+
+def normalize_invoice_number(invoice_num):
+    """Нормализует номер инвойса, убирая ведущие нули"""
+    if not invoice_num:
+        return ""
+
+    # Преобразуем в строку, если это не строка
+    invoice_str = str(invoice_num).strip()
+
+    # Если это число, убираем ведущие нули
+    if invoice_str.isdigit():
+        return str(int(invoice_str))
+
+    return invoice_str
+
+
+def convert_to_yyyy_mm_dd(date_str):
+    """Преобразует дату в формат YYYY-MM-DD"""
+    if not date_str or date_str.strip() == "":
+        return ""
+
+    date_str = date_str.strip()
+
+    # Если дата уже в формате YYYY-MM-DD, возвращаем как есть
+    if len(date_str) == 10 and date_str.count('-') == 2:
+        return date_str
+
+    # Если дата в формате DD.MM.YYYY, конвертируем в YYYY-MM-DD
+    if len(date_str) == 10 and date_str.count('.') == 2:
+        try:
+            parts = date_str.split('.')
+            if len(parts) == 3:
+                return f"{parts[2]}-{parts[1]}-{parts[0]}"
+        except:
+            pass
+
+    # Если дата в формате YYYY/MM/DD, конвертируем в YYYY-MM-DD
+    if len(date_str) == 10 and date_str.count('/') == 2:
+        try:
+            parts = date_str.split('/')
+            if len(parts) == 3:
+                return f"{parts[0]}-{parts[1]}-{parts[2]}"
+        except:
+            pass
+
+    # Если дата содержит время (ISO формат), извлекаем только дату
+    if 'T' in date_str:
+        date_part = date_str.split('T')[0]
+        return convert_to_yyyy_mm_dd(date_part)
+
+    # Если дата содержит пробел и время (формат YYYY-MM-DD HH:MM:SS), извлекаем только дату
+    if ' ' in date_str:
+        date_part = date_str.split(' ')[0]
+        return convert_to_yyyy_mm_dd(date_part)
+
+    # Если ничего не подошло, возвращаем исходную строку
+    return date_str
+
+
+def check_document(doc_kind: str, doc_id: str, doc_date: str, invoice_data=None) -> tuple[bool, str]:
+    """
+    Проверяет документ декларации: код 09034 - по фиксированной дате,
+    коды 04021/04131 - по номеру и дате инвойса.
+
+    Returns:
+        (has_error, error_message)
+    """
+    # Проверяем документы с кодом 09034 на соответствие дате 31.05.2011
+    has_error = False
+    error_message = ""
+
+    if doc_kind == "09034":
+        # Проверяем различные форматы даты
+        expected_date_formats = [
+            "31.05.2011",
+            "2011-05-31",
+            "2011/05/31",
+            "31/05/2011",
+            "2011-05-31T00:00:00",
+            "2011-05-31T00:00:00Z"
+        ]
+
+        # Нормализуем дату для сравнения
+        normalized_date = doc_date.strip() if doc_date else ""
+
+        # Проверяем соответствие ожидаемой дате
+        if normalized_date not in expected_date_formats:
+            has_error = True
+            error_message = f"Ошибка: Документ с кодом 09034 должен иметь дату 31.05.2011, но получена дата: {normalized_date}"
+
+    # Проверяем документы с кодами 04021 и 04131 на соответствие данным инвойса
+    elif doc_kind in ["04021", "04131"] and invoice_data:
+        # Нормализуем номера инвойсов для сравнения (убираем ведущие нули)
+        normalized_doc_id = normalize_invoice_number(doc_id)
+        normalized_invoice_id = normalize_invoice_number(invoice_data.invoice)
+
+        # Проверяем соответствие DocId с invoice_data.invoice
+        if normalized_doc_id != normalized_invoice_id:
+            has_error = True
+            error_message = f"Ошибка: Документ с кодом {doc_kind} должен иметь DocId равный номеру инвойса ({invoice_data.invoice}), но получен: {doc_id}. Типы: DocId={type(doc_id)}, Invoice={type(invoice_data.invoice)}"
+        # Проверяем соответствие DocCreationDate с invoice_data.date_invoice
+        else:
+            # Преобразуем даты в формат YYYY-MM-DD для сравнения
+            doc_date_formatted = convert_to_yyyy_mm_dd(doc_date)
+            invoice_date_formatted = convert_to_yyyy_mm_dd(invoice_data.date_invoice)
+
+            if doc_date_formatted != invoice_date_formatted:
+                has_error = True
+                error_message = f"Ошибка: Документ с кодом {doc_kind} должен иметь дату равную дате инвойса ({invoice_date_formatted}), но получена дата: {doc_date_formatted}"
+
+    return has_error, error_message
+
+
+def validate_documents(raw_documents: List[dict], invoice_data=None) -> List[DocumentInfo]:
+    """Строит DocumentInfo для документов декларации с проверками по данным инвойса."""
+    documents = []
+    for raw in raw_documents:
+        has_error, error_message = check_document(
+            raw["DocKindCode"], raw["DocId"], raw["DocCreationDate"], invoice_data
+        )
+        documents.append(DocumentInfo(
+            DocKindCode=raw["DocKindCode"],
+            DocName=raw["DocName"],
+            DocId=raw["DocId"],
+            DocCreationDate=raw["DocCreationDate"],
+            has_error=has_error,
+            error_message=error_message
+        ))
+    return documents
+
+
+def extract_xml_data_and_documents(
+    xml_bytes: Source,
+    invoice_data=None,
+    debug_container_transport: bool = False,
+    streaming: Optional[bool] = None,
+) -> tuple[ExcelData, List[DocumentInfo], str]:
+    """Извлекает данные из XML в формате ExcelData и отдельно документы."""
+    try:
+        excel_data, raw_documents, transport_means_reg_id = parse_declaration(
+            xml_bytes, debug_container_transport=debug_container_transport, streaming=streaming
+        )
+        return excel_data, validate_documents(raw_documents, invoice_data), transport_means_reg_id
     except Exception as e:
         return (
             ExcelData(
@@ -393,39 +603,55 @@ def extract_xml_data_and_documents(
         )
 
 
-def unified_compare_handler(invoice_bytes: bytes, decl_bytes: bytes, invoice_name: str, decl_name: str) -> Dict:
-    """Обработчик сравнения для Testoviy: извлекает данные из XML и обрабатывает инвойс через testoviy алгоритм."""
-    # Берем основной номер контейнера из "шапки" XML (TransportMeansRegId)
-    # и используем его для выбора контейнера в алгоритме обработки инвойса.
-    temp_xml_data, _, transport_means_reg_id = extract_xml_data_and_documents(decl_bytes)
-    first_container_number = transport_means_reg_id.strip() if transport_means_reg_id else None
-    if not first_container_number and temp_xml_data.containers:
+def declaration_container(xml_data: ExcelData, transport_means_reg_id: str) -> Optional[str]:
+    """
+    Основной номер контейнера декларации: TransportMeansRegId из "шапки" XML,
+    по нему в инвойсе выбирается контейнер для сравнения.
+    """
+    container_number = transport_means_reg_id.strip() if transport_means_reg_id else None
+    if not container_number and xml_data.containers:
         # fallback на первый контейнер, если TransportMeansRegId пустой
-        first_container_number = next(iter(temp_xml_data.containers.keys()))
-    
-    # Обрабатываем инвойс через алгоритм testoviy
+        container_number = next(iter(xml_data.containers.keys()))
+    return container_number
+
+
+def process_invoice(invoice_bytes: Source, container_number: Optional[str]) -> Dict:
+    """Обрабатывает инвойс через единый алгоритм; ошибка возвращается как {"error": ...}"""
     try:
-        invoice_result = process_unified(invoice_bytes, first_container_number)
-        invoice_data = None
-        if invoice_result.get("success") and "storage" in invoice_result:
-            invoice_data = invoice_result["storage"]
+        return process_unified(invoice_bytes, container_number)
     except Exception as e:
-        invoice_result = {"error": str(e)}
-        invoice_data = None
-    
-    # Обрабатываем XML декларацию с данными инвойса для валидации документов
-    xml_data, xml_documents, _ = extract_xml_data_and_documents(decl_bytes, invoice_data, debug_container_transport=False)
-    
+        return {"error": str(e)}
+
+
+def build_compare_result(declaration: tuple, invoice_result: Dict) -> Dict:
+    """
+    Собирает ответ сравнения из разобранной декларации (результат parse_declaration)
+    и результата обработки инвойса. Исходные данные не изменяются, поэтому один
+    разобранный инвойс можно использовать для нескольких деклараций.
+    """
+    xml_data, raw_documents, _ = declaration
+    invoice_data = None
+    if invoice_result.get("success") and "storage" in invoice_result:
+        invoice_data = invoice_result["storage"]
+
+    # Проверяем документы декларации по данным инвойса (04021/04131/09034)
+    started = metrics.start()
+    xml_documents = validate_documents(raw_documents, invoice_data)
+    metrics.stop("compare.documents", started, len(raw_documents))
+
     # Сортируем записи в каждом контейнере по трем критериям
-    for container_id, records in xml_data.containers.items():
-        xml_data.containers[container_id] = sort_records_by_criteria(records)
+    started = metrics.start()
+    xml_containers = {
+        container_id: sort_records_by_criteria(records)
+        for container_id, records in xml_data.containers.items()
+    }
 
     # Создаем результат согласно требуемой структуре
     result_data = {
         "success": True,
         "data": {
             "xml_data": {
-                "containers": xml_data.containers,
+                "containers": xml_containers,
                 "calc": xml_data.calc.dict(),
                 "sender_name": xml_data.sender_name,
                 "sender_address": xml_data.sender_address,
@@ -441,14 +667,18 @@ def unified_compare_handler(invoice_bytes: bytes, decl_bytes: bytes, invoice_nam
         },
     }
     # Сортируем записи в каждом контейнере по трем критериям
+    invoice_containers = None
     if invoice_data:
-        for container_id, records in invoice_data.containers.items():
-            invoice_data.containers[container_id] = sort_records_by_criteria(records)
-    
+        invoice_containers = {
+            container_id: sort_records_by_criteria(records)
+            for container_id, records in invoice_data.containers.items()
+        }
+    metrics.stop("compare.sort", started)
+
     # Добавляем данные инвойса, если они есть
     if invoice_data:
         result_data["data"]["invoice_data"] = {
-            "containers": invoice_data.containers,
+            "containers": invoice_containers,
             "calc": invoice_data.calc.dict(),
             "invoice": invoice_data.invoice,
             "date_invoice": invoice_data.date_invoice,
@@ -457,6 +687,19 @@ def unified_compare_handler(invoice_bytes: bytes, decl_bytes: bytes, invoice_nam
             "recipient_name": invoice_data.recipient_name,
             "recipient_address": invoice_data.recipient_address,
         }
-       
-    
+
     return result_data
+
+
+def unified_compare_handler(invoice_bytes: Source, decl_bytes: Source, invoice_name: str, decl_name: str) -> Dict:
+    """
+    Обработчик сравнения для Testoviy: извлекает данные из XML и обрабатывает инвойс через testoviy алгоритм.
+    Файлы передаются байтами, путями к файлам или файловыми объектами.
+    """
+    # XML декларации разбирается один раз: шапка, товары и документы
+    declaration = parse_declaration(decl_bytes)
+    xml_data, _, transport_means_reg_id = declaration
+
+    # Контейнер из "шапки" XML выбирает контейнер в алгоритме обработки инвойса
+    invoice_result = process_invoice(invoice_bytes, declaration_container(xml_data, transport_means_reg_id))
+    return build_compare_result(declaration, invoice_result)
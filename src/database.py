@@ -1,49 +1,329 @@
 """
 Модуль для работы с базой данных PostgreSQL
+
+Пул соединений потокобезопасный (ThreadedConnectionPool): запросы к БД
+выполняются в отдельном пуле потоков (save_data_to_db_async), чтобы не
+блокировать event loop. Настройка через переменные окружения:
+    DB_POOL_MIN             - минимум открытых соединений (по умолчанию 1)
+    DB_POOL_MAX             - максимум соединений (по умолчанию 20)
+    DB_ACQUIRE_TIMEOUT      - сколько ждать свободное соединение, сек (по умолчанию 10)
+    DB_HEALTH_CHECK_INTERVAL - соединение, простаивавшее дольше (сек), перед выдачей
+                              проверяется запросом SELECT 1 (по умолчанию 30, 0 - всегда)
+    DB_COPY_THRESHOLD       - начиная с этого числа товаров они загружаются через COPY
+                              вместо INSERT ... VALUES (по умолчанию 5000)
+    DB_UPSERT               - "auto" (по умолчанию), "1" или "0": клиенты и заказы через
+                              INSERT ... ON CONFLICT ... RETURNING id (нужны уникальные индексы)
+    DB_SAVE_SINGLE_STATEMENT - клиент, заказ и инвойсы одним запросом (по умолчанию 1)
+    DB_SAVE_FINGERPRINT     - "auto" (по умолчанию), "1" или "0": отпечатки содержимого
+                              контейнеров в invoices.content_hash, повторное сохранение
+                              тех же данных ничего не пишет
 """
+import io
 import os
+import csv
+import json
+import hashlib
+import time
+import asyncio
+import itertools
+from collections import deque
+import threading
 import psycopg2
 from psycopg2 import pool
 from psycopg2.extras import execute_values
-from typing import Dict, Any, Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Iterable, Optional, List
 from datetime import datetime
 import logging
 
+from src import metrics
+from src.services import PreparedItem
+
 logger = logging.getLogger(__name__)
 
+COPY_THRESHOLD = int(os.getenv("DB_COPY_THRESHOLD", "5000"))
+
+# Режим upsert: "auto" - по наличию уникальных индексов, "1" - включен, "0" - SELECT + INSERT
+UPSERT_MODE = os.getenv("DB_UPSERT", "auto").strip().lower()
+# Клиент, заказ и инвойсы одним запросом (при включенном upsert)
+SAVE_SINGLE_STATEMENT = os.getenv("DB_SAVE_SINGLE_STATEMENT", "1").strip().lower() not in ("0", "false", "no", "off")
+
+# DO UPDATE (а не DO NOTHING), чтобы RETURNING вернул id и для существующей строки
+CLIENT_UPSERT_SQL = """INSERT INTO clients (name) VALUES (%s)
+   ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+   RETURNING id"""
+
+ORDER_UPSERT_SQL = """INSERT INTO orders (client_id, order_number) VALUES (%s, %s)
+   ON CONFLICT (client_id, order_number) DO UPDATE SET order_number = EXCLUDED.order_number
+   RETURNING id"""
+
+SAVE_ORDER_CTE_SQL = """WITH client AS (
+       INSERT INTO clients (name) VALUES (%s)
+       ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+       RETURNING id
+   ), client_order AS (
+       INSERT INTO orders (client_id, order_number) SELECT id, %s FROM client
+       ON CONFLICT (client_id, order_number) DO UPDATE SET order_number = EXCLUDED.order_number
+       RETURNING id
+   )
+"""
+
+# Отпечатки содержимого (invoices.content_hash): "auto", "1" или "0"
+FINGERPRINT_MODE = os.getenv("DB_SAVE_FINGERPRINT", "auto").strip().lower()
+
+INVOICE_COLUMNS = (
+    "order_id", "container", "consignor", "consignee",
+    "sender_address", "recipient_address", "invoice_number", "invoice_date",
+)
+
+# Инвойсы заказа, сохраненные с отпечатком содержимого
+EXISTING_INVOICES_SQL = """SELECT i.id, i.container, i.invoice_number, i.content_hash
+   FROM invoices i
+   JOIN orders o ON o.id = i.order_id
+   JOIN clients c ON c.id = o.client_id
+   WHERE c.name = %s AND o.order_number = %s AND i.content_hash IS NOT NULL"""
+
+# Определяются при инициализации пула (detect_upsert_support, detect_fingerprint_support)
+upsert_supported = UPSERT_MODE in ("1", "true", "yes", "on")
+fingerprint_supported = FINGERPRINT_MODE in ("1", "true", "yes", "on")
+
+
+class DatabasePoolTimeout(Exception):
+    """Свободное соединение не освободилось за DB_ACQUIRE_TIMEOUT"""
+
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений с ожиданием свободного соединения,
+    проверкой соединений перед выдачей и счетчиками использования.
+    """
+
+    def __init__(
+        self,
+        database_url: str,
+        min_size: int = 1,
+        max_size: int = 20,
+        acquire_timeout: float = 10.0,
+        health_check_interval: float = 30.0,
+    ):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self._pool = psycopg2.pool.ThreadedConnectionPool(self.min_size, self.max_size, database_url)
+        # ThreadedConnectionPool при исчерпании сразу бросает PoolError - ждем слот на семафоре
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._lock = threading.Lock()
+        self._last_used = {}  # {id(conn): время возврата в пул}
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_seconds = 0.0
+
+    @classmethod
+    def from_env(cls, database_url: str) -> "ConnectionPool":
+        return cls(
+            database_url,
+            min_size=int(os.getenv("DB_POOL_MIN", "1")),
+            max_size=int(os.getenv("DB_POOL_MAX", "20")),
+            acquire_timeout=float(os.getenv("DB_ACQUIRE_TIMEOUT", "10")),
+            health_check_interval=float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30")),
+        )
+
+    def _healthy(self, conn) -> bool:
+        """Проверяет соединение, если оно закрыто или долго простаивало"""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warning(f"Соединение с БД не прошло проверку: {e}")
+            return False
+
+    def getconn(self, timeout: Optional[float] = None):
+        """Выдает проверенное соединение, ожидая свободное не дольше timeout"""
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._timeouts += 1
+            raise DatabasePoolTimeout(f"Нет свободного соединения с БД за {timeout:g} сек")
+        try:
+            # Битые соединения закрываются и заменяются новыми
+            for _ in range(self.max_size + 1):
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    break
+                with self._lock:
+                    self._discarded += 1
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+            else:
+                raise psycopg2.OperationalError("Не удалось получить рабочее соединение с БД")
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._acquired += 1
+            self._wait_seconds += time.monotonic() - started
+        return conn
+
+    def putconn(self, conn, close: bool = False) -> None:
+        """Возвращает соединение в пул (close=True - закрыть вместо повторного использования)"""
+        close = close or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def closeall(self) -> None:
+        self._pool.closeall()
+        self._last_used.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "utilization": round(self._in_use / self.max_size, 4),
+                "acquired": self._acquired,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "avg_wait_seconds": round(self._wait_seconds / self._acquired, 6) if self._acquired else 0.0,
+            }
+
+
 # Глобальный пул соединений
 connection_pool = None
 
+# Пул потоков для блокирующих запросов к БД (по одному потоку на соединение)
+db_executor = None
+
 
 def init_db_pool():
     """Инициализация пула соединений с БД"""
-    global connection_pool
+    global connection_pool, db_executor
     if connection_pool is None:
         database_url = os.getenv("DATABASE_URL")
         if not database_url:
             raise ValueError("DATABASE_URL не установлен в переменных окружения")
         
         try:
-            connection_pool = psycopg2.pool.SimpleConnectionPool(
-                1, 20, database_url
-            )
+            connection_pool = ConnectionPool.from_env(database_url)
             logger.info("Пул соединений с БД успешно инициализирован")
         except Exception as e:
             logger.error(f"Ошибка при создании пула соединений: {e}")
             raise
+    if db_executor is None:
+        db_executor = ThreadPoolExecutor(max_workers=connection_pool.max_size, thread_name_prefix="db")
+    if UPSERT_MODE == "auto":
+        detect_upsert_support()
+    if FINGERPRINT_MODE == "auto":
+        detect_fingerprint_support()
 
 
-def get_db_connection():
+def _explain_error(*statements) -> Optional[str]:
+    """
+    Проверяет запросы через EXPLAIN (только планирование, данные не меняются).
+    Возвращает текст ошибки или None, если схема БД их поддерживает.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            for sql, params in statements:
+                cursor.execute("EXPLAIN " + sql, params)
+        return None
+    except psycopg2.Error as e:
+        return str(e)
+    finally:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+        return_db_connection(conn)
+
+
+def detect_upsert_support() -> bool:
+    """
+    Проверяет, есть ли уникальные индексы для ON CONFLICT
+    (clients(name) и orders(client_id, order_number)).
+    """
+    global upsert_supported
+    error = _explain_error((CLIENT_UPSERT_SQL, ("",)), (ORDER_UPSERT_SQL, (0, "")))
+    upsert_supported = error is None
+    if error:
+        logger.warning(f"Upsert клиентов/заказов недоступен (нет уникальных индексов), используется SELECT + INSERT: {error}")
+    return upsert_supported
+
+
+def detect_fingerprint_support() -> bool:
+    """Проверяет, есть ли колонка invoices.content_hash для отпечатков содержимого"""
+    global fingerprint_supported
+    error = _explain_error((EXISTING_INVOICES_SQL, ("", "")))
+    fingerprint_supported = error is None
+    if error:
+        logger.warning(f"Нет колонки invoices.content_hash, повторные сохранения не дедуплицируются: {error}")
+    return fingerprint_supported
+
+
+def close_db_pool():
+    """Закрытие пула соединений и потоков БД"""
+    global connection_pool, db_executor
+    if db_executor is not None:
+        db_executor.shutdown(wait=True)
+        db_executor = None
+    if connection_pool is not None:
+        connection_pool.closeall()
+        connection_pool = None
+
+
+def db_pool_stats() -> Dict[str, Any]:
+    """Счетчики использования пула (пустой словарь, если пул не создан)"""
+    return connection_pool.stats() if connection_pool is not None else {}
+
+
+def get_db_connection(timeout: Optional[float] = None):
     """Получить соединение с БД из пула"""
     if connection_pool is None:
         init_db_pool()
-    return connection_pool.getconn()
+    return connection_pool.getconn(timeout)
 
 
-def return_db_connection(conn):
+def return_db_connection(conn, close: bool = False):
     """Вернуть соединение в пул"""
     if connection_pool:
-        connection_pool.putconn(conn)
+        connection_pool.putconn(conn, close=close)
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет блокирующую функцию работы с БД в пуле потоков БД"""
+    if db_executor is None:
+        init_db_pool()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, lambda: func(*args, **kwargs))
+
+
+async def save_data_to_db_async(data: Dict[str, Any], client_name: str, order_number: str) -> Dict[str, Any]:
+    """Асинхронная обертка над save_data_to_db (тот же формат результата)"""
+    return await run_db(save_data_to_db, data, client_name, order_number)
 
 
 def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -> Dict[str, Any]:
@@ -60,32 +340,20 @@ def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -
     """
     conn = None
     cursor = None
+    broken = False  # соединение, на котором не прошел откат, в пул не возвращается
+    save_started = metrics.start()
     try:
+        started = metrics.start()
         conn = get_db_connection()
         if not conn:
             raise Exception("Не удалось получить соединение с БД")
+        metrics.stop("db.acquire", started)
         
         cursor = conn.cursor()
         
         # Начинаем транзакцию с оптимизацией для массовой вставки
         conn.autocommit = False
         
-        # КРИТИЧНЫЕ ОПТИМИЗАЦИИ ДЛЯ МАКСИМАЛЬНОЙ СКОРОСТИ:
-        # 1. Отключаем синхронизацию на диск (быстрее в 100 раз, но менее надежно при сбое)
-        cursor.execute("SET LOCAL synchronous_commit = OFF")
-        
-        # 2. Увеличиваем work_mem для быстрой сортировки и соединений
-        cursor.execute("SET LOCAL work_mem = '256MB'")
-        
-        # 3. Увеличиваем maintenance_work_mem для более быстрых операций
-        cursor.execute("SET LOCAL maintenance_work_mem = '256MB'")
-        
-        # 1. Сохраняем или получаем клиента
-        client_id = save_or_get_client(cursor, client_name)
-        
-        # 2. Создаем заказ (используем переданный номер заказа)
-        order_id = save_or_get_order(cursor, client_id, order_number)
-        
         # Собираем все инвойсы и товары для batch-вставки
         invoice_data_batch = []
         
@@ -99,9 +367,9 @@ def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -
             invoice_date_str = container_data.get("invoice_date", "")
             items = container_data.get("items", [])
             
-            # Подготавливаем данные инвойса
+            # Подготавливаем данные инвойса (order_id проставляется после получения заказа)
             invoice_data_batch.append({
-                "order_id": order_id,
+                "order_id": None,
                 "container": container[:20] if container else "",
                 "consignor": consignor,
                 "consignee": consignee,
@@ -109,19 +377,77 @@ def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -
                 "recipient_address": recipient_address,
                 "invoice_number": invoice_number[:50] if invoice_number else "",
                 "invoice_date_str": invoice_date_str,
+                "content_hash": container_fingerprint(container_data) if fingerprint_supported else None,
                 "items": items
             })
         
-        # Batch-вставка инвойсов и товаров
-        batch_insert_invoices_and_items(cursor, invoice_data_batch)
+        # КРИТИЧНЫЕ ОПТИМИЗАЦИИ ДЛЯ МАКСИМАЛЬНОЙ СКОРОСТИ (одним запросом):
+        # 1. Отключаем синхронизацию на диск (быстрее в 100 раз, но менее надежно при сбое)
+        # 2. Увеличиваем work_mem для быстрой сортировки и соединений
+        # 3. Увеличиваем maintenance_work_mem для более быстрых операций
+        settings_sql = (
+            "SET LOCAL synchronous_commit = OFF; "
+            "SET LOCAL work_mem = '256MB'; "
+            "SET LOCAL maintenance_work_mem = '256MB'"
+        )
+        if fingerprint_supported:
+            # Одновременные сохранения одного заказа (двойной клик) выполняются по очереди
+            cursor.execute(
+                settings_sql.replace("%", "%%") + "; SELECT pg_advisory_xact_lock(hashtext(%s))",
+                (f"{client_name}\n{order_number}",)
+            )
+        else:
+            cursor.execute(settings_sql)
+        
+        stale_ids = []
+        if fingerprint_supported:
+            # Пишем только контейнеры, содержимое которых изменилось
+            invoice_data_batch, stale_ids = plan_incremental_save(cursor, client_name, order_number, invoice_data_batch)
+            if not invoice_data_batch and not stale_ids:
+                conn.commit()
+                metrics.stop("db.save_unchanged", save_started)
+                return {
+                    "success": True,
+                    "message": "Данные не изменились, повторное сохранение пропущено",
+                    "containers_saved": len(data),
+                    "containers_written": 0,
+                    "containers_removed": 0,
+                    "unchanged": True,
+                    "items_skipped": 0
+                }
+            if stale_ids:
+                delete_invoices(cursor, stale_ids)
+        
+        if SAVE_SINGLE_STATEMENT and upsert_supported and invoice_data_batch:
+            # Клиент, заказ и инвойсы - одним запросом (CTE), затем товары
+            order_id, invoice_ids = save_order_with_invoices(cursor, client_name, order_number, invoice_data_batch)
+            skipped_items = insert_invoice_items(cursor, invoice_data_batch, invoice_ids)
+        else:
+            # 1. Сохраняем или получаем клиента
+            client_id = save_or_get_client(cursor, client_name)
+            
+            # 2. Создаем заказ (используем переданный номер заказа)
+            order_id = save_or_get_order(cursor, client_id, order_number)
+            for inv_data in invoice_data_batch:
+                inv_data["order_id"] = order_id
+            
+            # Batch-вставка инвойсов и товаров
+            skipped_items = batch_insert_invoices_and_items(cursor, invoice_data_batch)
         
         # Коммитим транзакцию
+        started = metrics.start()
         conn.commit()
+        metrics.stop("db.commit", started)
+        metrics.stop("db.save", save_started, sum(len(inv["items"]) for inv in invoice_data_batch))
         
         return {
             "success": True,
             "message": f"Данные успешно сохранены в БД. Обработано контейнеров: {len(data)}",
-            "containers_saved": len(data)
+            "containers_saved": len(data),
+            "containers_written": len(invoice_data_batch),
+            "containers_removed": len(stale_ids),
+            "unchanged": False,
+            "items_skipped": skipped_items
         }
         
     except Exception as e:
@@ -129,11 +455,11 @@ def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -
             try:
                 conn.rollback()
             except Exception as rollback_error:
+                broken = True
                 logger.error(f"Ошибка при откате транзакции: {rollback_error}")
         
         error_msg = str(e)
         logger.error(f"Ошибка при сохранении данных в БД: {error_msg}")
-        print(f"Ошибка при сохранении данных в БД: {error_msg}")
         
         return {
             "success": False,
@@ -146,7 +472,59 @@ def save_data_to_db(data: Dict[str, Any], client_name: str, order_number: str) -
             except Exception:
                 pass
         if conn:
-            return_db_connection(conn)
+            return_db_connection(conn, close=broken)
+
+
+def _fingerprint_default(obj):
+    return obj.to_dict() if isinstance(obj, PreparedItem) else str(obj)
+
+
+def container_fingerprint(container_data: Dict[str, Any]) -> str:
+    """SHA-256 подготовленного контейнера (канонический JSON) - отпечаток для повторных сохранений"""
+    payload = json.dumps(container_data, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=_fingerprint_default)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def plan_incremental_save(
+    cursor,
+    client_name: str,
+    order_number: str,
+    invoice_data_batch: List[Dict[str, Any]],
+) -> tuple:
+    """
+    Сравнивает отпечатки контейнеров с уже сохраненными в заказе.
+    
+    Контейнер с тем же отпечатком не переписывается. Сохраненные версии
+    контейнеров из текущих данных (тот же контейнер и инвойс) с другим
+    отпечатком устаревают. Контейнеры, которых нет в текущих данных, не трогаются.
+    
+    Returns:
+        (инвойсы для вставки, ID устаревших инвойсов)
+    """
+    cursor.execute(EXISTING_INVOICES_SQL, (client_name, (order_number[:50] if order_number else "")))
+    keys = {(inv_data["container"], inv_data["invoice_number"]) for inv_data in invoice_data_batch}
+    stored = {}  # {content_hash: deque(id)}
+    for inv_id, container, inv_num, content_hash in cursor.fetchall():
+        if (container, inv_num) in keys:
+            stored.setdefault(content_hash, deque()).append(inv_id)
+    
+    to_insert = []
+    for inv_data in invoice_data_batch:
+        ids = stored.get(inv_data["content_hash"])
+        if ids:
+            ids.popleft()
+        else:
+            to_insert.append(inv_data)
+    stale_ids = [inv_id for ids in stored.values() for inv_id in ids]
+    return to_insert, stale_ids
+
+
+def delete_invoices(cursor, invoice_ids: List[int]) -> None:
+    """Удаляет инвойсы вместе с товарами (один запрос)"""
+    cursor.execute(
+        "DELETE FROM invoice_items WHERE invoice_id = ANY(%s); DELETE FROM invoices WHERE id = ANY(%s)",
+        (invoice_ids, invoice_ids)
+    )
 
 
 def save_or_get_client(cursor, name: str) -> int:
@@ -156,6 +534,11 @@ def save_or_get_client(cursor, name: str) -> int:
     Returns:
         ID клиента
     """
+    if upsert_supported:
+        # Один запрос и без гонки при одновременном сохранении одного клиента
+        cursor.execute(CLIENT_UPSERT_SQL, (name,))
+        return cursor.fetchone()[0]
+    
     # Проверяем, существует ли клиент
     cursor.execute("SELECT id FROM clients WHERE name = %s", (name,))
     result = cursor.fetchone()
@@ -178,6 +561,10 @@ def save_or_get_order(cursor, client_id: int, order_number: str) -> int:
     # Обрезаем order_number до 50 символов (лимит VARCHAR(50))
     order_number = (order_number[:50] if order_number else "")
     
+    if upsert_supported:
+        cursor.execute(ORDER_UPSERT_SQL, (client_id, order_number))
+        return cursor.fetchone()[0]
+    
     # Проверяем, существует ли заказ
     cursor.execute(
         "SELECT id FROM orders WHERE client_id = %s AND order_number = %s",
@@ -196,6 +583,41 @@ def save_or_get_order(cursor, client_id: int, order_number: str) -> int:
     return cursor.fetchone()[0]
 
 
+def save_order_with_invoices(
+    cursor,
+    client_name: str,
+    order_number: str,
+    invoice_data_batch: List[Dict[str, Any]],
+) -> tuple:
+    """
+    Одним запросом (CTE) получает клиента и заказ (upsert) и вставляет инвойсы.
+    Проставляет order_id в invoice_data_batch.
+    
+    Returns:
+        (ID заказа, строки (id, container, invoice_number, order_id) вставленных инвойсов)
+    """
+    order_number = (order_number[:50] if order_number else "")
+    # В execute_values допустим только один %s - параметры клиента и заказа подставляются заранее
+    prefix = cursor.mogrify(SAVE_ORDER_CTE_SQL, (client_name, order_number))
+    encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+    columns = invoice_columns()[1:]
+    records = [record[1:] for record in invoice_records(invoice_data_batch)]
+    started = metrics.start()
+    rows = execute_values(
+        cursor,
+        prefix.replace(b"%", b"%%") + _invoices_from_cte_sql(columns).encode(encoding),
+        records,
+        template="(" + ", ".join("%s::timestamp" if column == "invoice_date" else "%s" for column in columns) + ")",
+        page_size=len(records),  # все инвойсы - в одном запросе
+        fetch=True,
+    )
+    metrics.stop("db.insert_invoices", started, len(records))
+    order_id = rows[0][3]
+    for inv_data in invoice_data_batch:
+        inv_data["order_id"] = order_id
+    return order_id, [row[:3] for row in rows]
+
+
 def save_invoice(
     cursor,
     order_id: int,
@@ -240,7 +662,50 @@ def save_invoice(
     return cursor.fetchone()[0]
 
 
-def batch_insert_invoices_and_items(cursor, invoice_data_batch: List[Dict[str, Any]]) -> None:
+def parse_invoice_date(invoice_date_str: str) -> Optional[datetime]:
+    """Дата инвойса в одном из поддерживаемых форматов (None, если не распознана)"""
+    if not invoice_date_str:
+        return None
+    for fmt in ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y", "%d/%m/%Y"]:
+        try:
+            return datetime.strptime(invoice_date_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def invoice_columns() -> tuple:
+    """Колонки invoices для вставки (content_hash - если есть в схеме)"""
+    return INVOICE_COLUMNS + (("content_hash",) if fingerprint_supported else ())
+
+
+def _invoices_from_cte_sql(columns: tuple) -> str:
+    """Вставка инвойсов с order_id из CTE client_order (см. save_order_with_invoices)"""
+    return f"""INSERT INTO invoices (order_id, {', '.join(columns)})
+   SELECT client_order.id, {', '.join('v.' + column for column in columns)}
+   FROM client_order, (VALUES %s) AS v ({', '.join(columns)})
+   RETURNING id, container, invoice_number, order_id"""
+
+
+def invoice_records(invoice_data_batch: List[Dict[str, Any]]) -> List[tuple]:
+    """Кортежи для вставки в invoices (в порядке invoice_columns())"""
+    with_hash = fingerprint_supported
+    return [
+        (
+            inv_data["order_id"],
+            inv_data["container"],
+            inv_data["consignor"],
+            inv_data["consignee"],
+            inv_data["sender_address"],
+            inv_data["recipient_address"],
+            inv_data["invoice_number"],
+            parse_invoice_date(inv_data["invoice_date_str"]),
+        ) + ((inv_data.get("content_hash"),) if with_hash else ())
+        for inv_data in invoice_data_batch
+    ]
+
+
+def batch_insert_invoices_and_items(cursor, invoice_data_batch: List[Dict[str, Any]]) -> int:
     """
     ULTRA-FAST Batch-вставка инвойсов и товаров с максимальной производительностью
     Использует execute_values для суперскорости и VALUES с RETURNING для получения ID
@@ -248,90 +713,89 @@ def batch_insert_invoices_and_items(cursor, invoice_data_batch: List[Dict[str, A
     Args:
         cursor: Курсор БД
         invoice_data_batch: Список данных инвойсов с товарами
+        
+    Returns:
+        Количество пропущенных товаров
     """
     if not invoice_data_batch:
-        return
+        return 0
     
     # 1. Подготовка данных инвойсов
-    invoice_records = []
-    for inv_data in invoice_data_batch:
-        # Парсим дату инвойса
-        invoice_date = None
-        if inv_data["invoice_date_str"]:
-            try:
-                for fmt in ["%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%d.%m.%Y", "%d/%m/%Y"]:
-                    try:
-                        invoice_date = datetime.strptime(inv_data["invoice_date_str"], fmt)
-                        break
-                    except ValueError:
-                        continue
-            except Exception:
-                pass
-        
-        invoice_records.append((
-            inv_data["order_id"],
-            inv_data["container"],
-            inv_data["consignor"],
-            inv_data["consignee"],
-            inv_data["sender_address"],
-            inv_data["recipient_address"],
-            inv_data["invoice_number"],
-            invoice_date
-        ))
+    records = invoice_records(invoice_data_batch)
     
     # Суперскоростная вставка всех инвойсов с RETURNING для получения ID
+    started = metrics.start()
     invoice_ids = execute_values(
         cursor,
-        """INSERT INTO invoices 
-           (order_id, container, consignor, consignee, sender_address, recipient_address, invoice_number, invoice_date)
+        f"""INSERT INTO invoices 
+           ({', '.join(invoice_columns())})
            VALUES %s
            RETURNING id, container, invoice_number""",
-        invoice_records,
+        records,
         fetch=True
     )
+    metrics.stop("db.insert_invoices", started, len(records))
+    
+    return insert_invoice_items(cursor, invoice_data_batch, invoice_ids)
+
+
+def map_invoice_ids(invoice_data_batch: List[Dict[str, Any]], invoice_ids: List[tuple]) -> List[Optional[int]]:
+    """
+    ID инвойса для каждого элемента invoice_data_batch.
+    
+    Строки RETURNING идут в порядке VALUES, поэтому ID сопоставляются по позиции:
+    инвойсы с одинаковыми (после обрезки) контейнером и номером не склеиваются.
+    Если порядок не совпал (проверка по контейнеру и номеру), ID раздаются
+    по ключу в порядке строк.
+    """
+    if len(invoice_ids) == len(invoice_data_batch) and all(
+        row[1] == inv_data["container"] and row[2] == inv_data["invoice_number"]
+        for row, inv_data in zip(invoice_ids, invoice_data_batch)
+    ):
+        return [row[0] for row in invoice_ids]
     
-    # Создаем карту ID инвойсов для быстрого доступа
-    invoice_id_map = {}
+    logger.warning("Порядок строк RETURNING не совпал с порядком инвойсов, сопоставление по ключу")
+    ids_by_key = {}
     for inv_id, container, inv_num in invoice_ids:
-        key = f"{container}_{inv_num}"
-        invoice_id_map[key] = inv_id
+        ids_by_key.setdefault((container, inv_num), deque()).append(inv_id)
+    mapped = []
+    for inv_data in invoice_data_batch:
+        ids = ids_by_key.get((inv_data["container"], inv_data["invoice_number"]))
+        mapped.append(ids.popleft() if ids else None)
+    return mapped
+
+
+def insert_invoice_items(cursor, invoice_data_batch: List[Dict[str, Any]], invoice_ids: List[tuple]) -> int:
+    """
+    Вставка товаров по уже полученным ID инвойсов
     
+    Args:
+        invoice_ids: строки (id, container, invoice_number) из RETURNING
+        
+    Returns:
+        Количество пропущенных товаров (инвойс без ID)
+    """
     # 2. Подготовка всех товаров для массовой вставки
     items_records = []
-    for inv_data in invoice_data_batch:
-        key = f"{inv_data['container']}_{inv_data['invoice_number']}"
-        invoice_id = invoice_id_map.get(key)
-        
+    skipped_items = 0
+    for inv_data, invoice_id in zip(invoice_data_batch, map_invoice_ids(invoice_data_batch, invoice_ids)):
         if not invoice_id:
+            skipped_items += len(inv_data["items"])
             continue
         
         for item in inv_data["items"]:
-            # Обрезаем значения согласно лимитам БД
-            code = (item.get("code", "")[:20] if item.get("code") else "")
-            package_type = (item.get("package_type", "")[:10] if item.get("package_type") else "")
-            currency = (item.get("currency", "")[:10] if item.get("currency") else "")
-            
-            # Преобразуем в boolean
-            restriction_flag = bool(item.get("restriction_flag")) if item.get("restriction_flag") is not None else False
-            package_info = bool(item.get("package_info")) if item.get("package_info") is not None else False
-            
-            items_records.append((
-                invoice_id,
-                code,
-                item.get("goods_name", ""),
-                restriction_flag,
-                package_info,
-                int(item.get("places", 0)),
-                int(item.get("package_info_type", 0)),
-                package_type,
-                int(item.get("package_count", 0)),
-                float(item.get("weight", 0.0)),
-                currency,
-                float(item.get("value_amount", 0.0))
-            ))
+            # Подготовленный товар уже содержит приведенные и обрезанные значения
+            values = item.db_values if isinstance(item, PreparedItem) else item_db_values(item)
+            items_records.append((invoice_id,) + values)
     
     # Суперскоростная вставка всех товаров одним махом
-    if items_records:
+    if len(items_records) >= COPY_THRESHOLD:
+        # Большие заказы - через COPY (без генерации и разбора SQL)
+        started = metrics.start()
+        copy_invoice_items(cursor, items_records)
+        metrics.stop("db.copy_items", started, len(items_records))
+    elif items_records:
+        started = metrics.start()
         execute_values(
             cursor,
             """INSERT INTO invoice_items 
@@ -341,6 +805,85 @@ def batch_insert_invoices_and_items(cursor, invoice_data_batch: List[Dict[str, A
             items_records,
             page_size=1000  # Оптимальный размер пакета для PostgreSQL
         )
+        metrics.stop("db.insert_items", started, len(items_records))
+    
+    if skipped_items:
+        logger.error(f"Товары без ID инвойса не сохранены: {skipped_items}")
+        metrics.observe(metrics.STAGE_ITEMS, skipped_items, stage="db.items_skipped")
+    return skipped_items
+
+
+def item_db_values(item: Dict[str, Any]) -> tuple:
+    """Значения колонок invoice_items (без invoice_id) для товара-словаря в формате 1.json"""
+    # Обрезаем значения согласно лимитам БД
+    code = (item.get("code", "")[:20] if item.get("code") else "")
+    package_type = (item.get("package_type", "")[:10] if item.get("package_type") else "")
+    currency = (item.get("currency", "")[:10] if item.get("currency") else "")
+    
+    # Преобразуем в boolean
+    restriction_flag = bool(item.get("restriction_flag")) if item.get("restriction_flag") is not None else False
+    package_info = bool(item.get("package_info")) if item.get("package_info") is not None else False
+    
+    return (
+        code,
+        item.get("goods_name", ""),
+        restriction_flag,
+        package_info,
+        int(item.get("places", 0)),
+        int(item.get("package_info_type", 0)),
+        package_type,
+        int(item.get("package_count", 0)),
+        float(item.get("weight", 0.0)),
+        currency,
+        float(item.get("value_amount", 0.0))
+    )
+
+
+class CopyBuffer:
+    """
+    Файлоподобный поток CSV для COPY FROM STDIN: строки формируются
+    по мере чтения, весь заказ целиком в памяти не собирается.
+    """
+
+    def __init__(self, records: Iterable[tuple], chunk_rows: int = 1000):
+        self._records = iter(records)
+        self._chunk_rows = chunk_rows
+        self._buffer = io.StringIO()
+        # Все текстовые значения в кавычках: пустая строка остается '', а не NULL
+        self._writer = csv.writer(self._buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        self._pending = ""
+
+    def _fill(self) -> bool:
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerows(itertools.islice(self._records, self._chunk_rows))
+        self._pending += self._buffer.getvalue()
+        return self._buffer.tell() > 0
+
+    def read(self, size: int = -1) -> str:
+        while (size < 0 or len(self._pending) < size) and self._fill():
+            pass
+        if size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+def copy_invoice_items(cursor, items_records: List[tuple]) -> None:
+    """
+    Массовая загрузка товаров через COPY invoice_items FROM STDIN (CSV).
+    Записи - в том же порядке полей, что и для execute_values.
+    """
+    cursor.copy_expert(
+        """COPY invoice_items 
+           (invoice_id, code, goods_name, restriction_flag, package_info, places, 
+            package_info_type, package_type, package_count, weight, currency, value_amount)
+           FROM STDIN WITH (FORMAT csv)""",
+        CopyBuffer(items_records),
+    )
 
 
 def save_invoice_item(
@@ -0,0 +1,199 @@
+"""
+Пул исполнителей для тяжелых (CPU-bound) задач: обработки инвойсов и сравнения.
+
+Задачи выполняются вне event loop, чтобы большой файл не блокировал
+остальные запросы (включая health-check "/").
+Настройка через переменные окружения:
+    WORKER_POOL_KIND    - "process" (по умолчанию) или "thread"
+    WORKER_POOL_SIZE    - количество воркеров (по умолчанию 2)
+    WORKER_QUEUE_SIZE   - сколько задач может ждать в очереди сверх воркеров (по умолчанию 8)
+    WORKER_JOB_TIMEOUT  - таймаут одной задачи в секундах (по умолчанию 300)
+    WORKER_RETRY_AFTER  - значение Retry-After при перегрузке в секундах (по умолчанию 5)
+"""
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutorSaturatedError(Exception):
+    """Все воркеры заняты и очередь заполнена"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Сервер перегружен, повторите запрос позже")
+        self.retry_after = retry_after
+
+
+class ExecutorTimeoutError(Exception):
+    """Задача не уложилась в таймаут"""
+
+
+class JobExecutor:
+    """Пул процессов или потоков с ограниченной очередью и таймаутом задач"""
+
+    def __init__(
+        self,
+        kind: str = "process",
+        max_workers: int = 2,
+        max_queue: int = 8,
+        timeout: float = 300.0,
+        retry_after: int = 5,
+    ):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Неизвестный тип пула: {kind}")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._pool = None
+        self._pending = 0  # задачи в работе + в очереди
+        self._rejected = 0
+        self._timed_out = 0
+        self._broken = 0
+        self._completed = 0
+
+    @classmethod
+    def from_env(cls) -> "JobExecutor":
+        """Создает пул по переменным окружения"""
+        return cls(
+            kind=os.getenv("WORKER_POOL_KIND", "process").strip().lower(),
+            max_workers=int(os.getenv("WORKER_POOL_SIZE", "2")),
+            max_queue=int(os.getenv("WORKER_QUEUE_SIZE", "8")),
+            timeout=float(os.getenv("WORKER_JOB_TIMEOUT", "300")),
+            retry_after=int(os.getenv("WORKER_RETRY_AFTER", "5")),
+        )
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+        if self.kind == "process":
+            # spawn вместо fork: форк процесса с запущенными потоками uvicorn небезопасен
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="job-worker",
+            )
+        logger.info(f"Пул исполнителей запущен: {self.kind}, воркеров: {self.max_workers}")
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _restart(self, pool) -> None:
+        """Пересоздает поврежденный пул (если его еще не пересоздала другая задача)"""
+        if self._pool is not pool:
+            return
+        # Воркер упал (например, по OOM) - остальные процессы старого пула останавливаем
+        logger.error("Пул процессов поврежден, пересоздаем")
+        pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+        self.start()
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def _release(self) -> None:
+        self._pending -= 1
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """
+        Выполняет func(*args) в пуле.
+
+        Raises:
+            ExecutorSaturatedError: если все воркеры заняты и очередь заполнена
+                или пул процессов поврежден во время задачи
+            ExecutorTimeoutError: если задача не уложилась в таймаут
+        """
+        if self._pool is None:
+            self.start()
+        if self._pending >= self.capacity:
+            self._rejected += 1
+            raise ExecutorSaturatedError(self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        # Замеры этапов внутри воркера возвращаются вместе с результатом
+        pool = self._pool
+        try:
+            future = pool.submit(metrics.call_collecting, func, *args)
+        except BrokenProcessPool:
+            self._restart(pool)
+            pool = self._pool
+            future = pool.submit(metrics.call_collecting, func, *args)
+
+        # Слот освобождается, только когда задача реально завершилась:
+        # задача, прерванная по таймауту, продолжает занимать воркер
+        self._pending += 1
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+
+        try:
+            result, samples = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()  # снимет задачу, если она еще в очереди
+            self._timed_out += 1
+            raise ExecutorTimeoutError(f"Обработка не уложилась в {self.timeout:g} сек")
+        except BrokenProcessPool:
+            # Воркер упал во время задачи - пул пересоздается, клиент повторяет запрос
+            self._broken += 1
+            self._restart(pool)
+            raise ExecutorSaturatedError(self.retry_after)
+
+        metrics.merge(samples)
+        self._completed += 1
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "workers": self.max_workers,
+            "queue_size": self.max_queue,
+            "pending": self._pending,
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "timed_out": self._timed_out,
+            "broken": self._broken,
+        }
+
+
+# Глобальный пул исполнителей
+job_executor = None
+
+
+def init_executor() -> JobExecutor:
+    """Инициализация пула исполнителей"""
+    global job_executor
+    if job_executor is None:
+        job_executor = JobExecutor.from_env()
+        job_executor.start()
+    return job_executor
+
+
+def shutdown_executor() -> None:
+    """Остановка пула исполнителей"""
+    global job_executor
+    if job_executor is not None:
+        job_executor.shutdown()
+        job_executor = None
+
+
+def job_executor_stats() -> Dict[str, Any]:
+    """Счетчики глобального пула (пустой словарь, если пул не запущен)"""
+    return job_executor.stats() if job_executor is not None else {}
+
+
+async def run_job(func: Callable, *args: Any) -> Any:
+    """Выполняет задачу в глобальном пуле исполнителей"""
+    return await init_executor().run(func, *args)
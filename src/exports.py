@@ -0,0 +1,257 @@
+"""
+Хранилище экспортированных JSON-файлов (static/downloads).
+
+Каждый экспорт получает уникальное имя (время + случайный суффикс), поэтому
+экспорты в одну и ту же секунду не перезаписывают друг друга. Список файлов
+держится в памяти (строится сканированием папки при старте), и /download не
+обращается к диску для проверки существования. Старые файлы удаляются по
+возрасту и по суммарному размеру папки.
+
+При нескольких воркерах uvicorn у каждого свой индекс: экспорт, созданный
+другим воркером, ищется на диске при промахе индекса, а периодическая
+очистка (cleanup, запускается из lifespan) сверяет индекс с папкой.
+
+Экспорт может храниться сжатым (mapping_data_*.json.gz): клиентам, которые
+принимают gzip, он отдается как есть с Content-Encoding: gzip, остальным -
+распаковывается на лету.
+
+Настройка через переменные окружения:
+    EXPORT_DIR       - папка экспортов (по умолчанию static/downloads)
+    EXPORT_MAX_BYTES - суммарный размер экспортов в байтах (по умолчанию 1 ГБ, 0 - без ограничения)
+    EXPORT_MAX_AGE   - время хранения экспорта в секундах (по умолчанию 7 дней, 0 - без ограничения)
+    EXPORT_CLEANUP_INTERVAL - период очистки в секундах (по умолчанию 600, 0 - только при старте)
+"""
+import os
+import gzip
+import asyncio
+import logging
+import time
+import uuid
+import threading
+from datetime import datetime
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+GZIP_SUFFIX = ".gz"
+
+# Недописанный экспорт старше этого (сек) считается оставшимся после сбоя:
+# более свежий может в этот момент писать другой воркер
+TMP_MAX_AGE = 3600
+
+
+class ExportEntry:
+    """Файл экспорта: имя для скачивания и фактический файл на диске"""
+
+    __slots__ = ("name", "path", "size", "created", "encoding")
+
+    def __init__(self, name: str, path: str, size: int, created: float, encoding: Optional[str]):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.created = created
+        self.encoding = encoding  # "gzip" для сжатого файла, иначе None
+
+
+class ExportStore:
+    """Экспорты с уникальными именами и вытеснением по возрасту/размеру"""
+
+    def __init__(self, directory: str = "static/downloads", max_bytes: int = 1024 * 1024 * 1024,
+                 max_age: float = 7 * 24 * 3600, cleanup_interval: float = 600):
+        self.directory = directory
+        self.max_bytes = max(0, max_bytes)
+        self.max_age = max(0.0, max_age)
+        self.cleanup_interval = max(0.0, cleanup_interval)
+        self._entries: Dict[str, ExportEntry] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._scan()
+
+    @classmethod
+    def from_env(cls) -> "ExportStore":
+        return cls(
+            directory=os.getenv("EXPORT_DIR") or "static/downloads",
+            max_bytes=int(os.getenv("EXPORT_MAX_BYTES", str(1024 * 1024 * 1024))),
+            max_age=float(os.getenv("EXPORT_MAX_AGE", str(7 * 24 * 3600))),
+            cleanup_interval=float(os.getenv("EXPORT_CLEANUP_INTERVAL", "600")),
+        )
+
+    def _scan(self) -> None:
+        """
+        Сверяет индекс с папкой: добавляет экспорты, созданные до перезапуска
+        или другими воркерами, и снимает с учета удаленные другими воркерами.
+        """
+        now = time.time()
+        found = {}
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".tmp"):
+                try:
+                    if now - os.stat(path).st_mtime > TMP_MAX_AGE:
+                        self._remove_file(path)  # недописанный экспорт после сбоя
+                except OSError:
+                    pass
+                continue
+            entry = self._disk_entry(filename[:-len(GZIP_SUFFIX)] if filename.endswith(GZIP_SUFFIX) else filename)
+            if entry is not None and entry.path == path:
+                found.setdefault(entry.name, entry)
+        with self._lock:
+            # Экспорты, записанные уже после чтения папки, не снимаются
+            for name in [name for name, entry in self._entries.items() if name not in found and entry.created < now]:
+                self._pop(name)
+            for name, entry in found.items():
+                if name not in self._entries:
+                    self._add(entry)
+
+    def _disk_entry(self, name: str) -> Optional[ExportEntry]:
+        """Экспорт с именем name в папке (сжатый или обычный) без учета индекса"""
+        if not name.endswith(".json") or name.startswith(".") or os.path.basename(name) != name:
+            return None
+        for suffix, encoding in ((GZIP_SUFFIX, "gzip"), ("", None)):
+            path = os.path.join(self.directory, name + suffix)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            return ExportEntry(name, path, stat.st_size, stat.st_mtime, encoding)
+        return None
+
+    def _add(self, entry: ExportEntry) -> None:
+        self._entries[entry.name] = entry
+        self._size += entry.size
+
+    def _pop(self, name: str) -> Optional[ExportEntry]:
+        entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._size -= entry.size
+        return entry
+
+    @staticmethod
+    def _remove_file(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _expired(self, entry: ExportEntry, now: float) -> bool:
+        return bool(self.max_age) and now - entry.created > self.max_age
+
+    def write(self, writer: Callable[[BinaryIO], None], compress: bool = False,
+              prefix: str = "mapping_data") -> ExportEntry:
+        """
+        Создает новый экспорт: writer(f) пишет содержимое в бинарный файл f
+        (при compress=True - в gzip-поток).
+
+        Returns:
+            Запись экспорта; entry.name - имя для /download/{name}
+        """
+        name = f"{prefix}_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:8]}.json"
+        path = os.path.join(self.directory, name + (GZIP_SUFFIX if compress else ""))
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as raw:
+                if compress:
+                    with gzip.GzipFile(filename=name, mode="wb", fileobj=raw, compresslevel=6) as f:
+                        writer(f)
+                else:
+                    writer(raw)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove_file(tmp_path)
+            raise
+
+        entry = ExportEntry(name, path, os.path.getsize(path), time.time(), "gzip" if compress else None)
+        with self._lock:
+            self._add(entry)
+            evicted = self._evict(keep=name)
+        for old in evicted:
+            self._remove_file(old.path)
+        return entry
+
+    def _evict(self, keep: Optional[str] = None) -> List[ExportEntry]:
+        """Снимает с учета просроченные и самые старые экспорты сверх бюджета (под self._lock)"""
+        now = time.time()
+        evicted = []
+        for entry in sorted(self._entries.values(), key=lambda e: e.created):
+            if entry.name == keep:
+                continue
+            if self._expired(entry, now) or (self.max_bytes and self._size > self.max_bytes):
+                evicted.append(self._pop(entry.name))
+        self.evictions += len(evicted)
+        return evicted
+
+    def get(self, name: str) -> Optional[ExportEntry]:
+        """Экспорт по имени (None, если не найден или истек)"""
+        with self._lock:
+            entry = self._entries.get(name)
+        if entry is None:
+            # Экспорт мог создать другой воркер - проверяем папку
+            found = self._disk_entry(name)
+            if found is None:
+                return None
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    entry = found
+                    self._add(entry)
+        with self._lock:
+            if not self._expired(entry, time.time()):
+                return entry
+            if self._entries.get(name) is not entry:
+                return None  # уже снят с учета другим запросом
+            self._pop(name)
+            self.evictions += 1
+        self._remove_file(entry.path)
+        return None
+
+    def cleanup(self) -> None:
+        """Сверяет индекс с папкой и удаляет истекшие экспорты и экспорты сверх бюджета"""
+        self._scan()
+        with self._lock:
+            evicted = self._evict()
+        for entry in evicted:
+            self._remove_file(entry.path)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "max_age": self.max_age,
+                "evictions": self.evictions,
+            }
+
+
+async def cleanup_periodically(store: ExportStore) -> None:
+    """Фоновая очистка экспортов раз в store.cleanup_interval секунд (задача lifespan)"""
+    while store.cleanup_interval:
+        await asyncio.sleep(store.cleanup_interval)
+        try:
+            await asyncio.to_thread(store.cleanup)
+        except Exception as e:
+            logger.warning(f"Ошибка очистки экспортов: {e}")
+
+
+def iter_gunzip(path: str, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """Распакованное содержимое gzip-файла кусками"""
+    with gzip.open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+# Глобальное хранилище экспортов
+export_store = None
+
+
+def get_export_store() -> ExportStore:
+    """Хранилище экспортов (создается при первом обращении)"""
+    global export_store
+    if export_store is None:
+        export_store = ExportStore.from_env()
+    return export_store
@@ -0,0 +1,178 @@
+"""
+Прием загружаемых файлов без чтения целиком в память и без лишних копий.
+
+Starlette держит тело файла до 1 МБ в памяти, а сверх - во временном файле
+на диске. Загрузка читается один раз кусками (размер и SHA-256 для кэша),
+а обработчикам передается то, что уже лежит у Starlette: байты небольшого
+файла или путь к его временному файлу (безымянный файл открывается через
+/proc/self/fd - это работает только в пуле потоков). Копия во временный
+файл делается, только если пути нет, а обработка идет в пуле процессов;
+файлы из zip-архивов тоже распаковываются во временные файлы (spool).
+Обработчики принимают bytes, путь или файловый объект (open_source).
+
+Настройка через переменные окружения:
+    UPLOAD_MAX_BYTES - максимальный размер одного файла в байтах (по умолчанию 256 МБ, 0 - без ограничения)
+    UPLOAD_SPOOL_DIR - папка для временных файлов (по умолчанию системная временная папка)
+"""
+import io
+import os
+import hashlib
+import asyncio
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional, Union
+
+from src.executor import init_executor
+
+CHUNK_SIZE = 1024 * 1024
+
+# Содержимое файла для обработчиков: байты, путь к файлу или файловый объект
+Source = Union[bytes, str, BinaryIO]
+
+
+class UploadTooLargeError(Exception):
+    """Файл больше UPLOAD_MAX_BYTES"""
+
+    def __init__(self, max_bytes: int, filename: str = ""):
+        self.max_bytes = max_bytes
+        name = f" {filename}" if filename else ""
+        super().__init__(f"Файл{name} больше допустимого размера ({max_bytes // (1024 * 1024)} МБ)")
+
+
+def max_upload_bytes() -> int:
+    return max(0, int(os.getenv("UPLOAD_MAX_BYTES", str(256 * 1024 * 1024))))
+
+
+@contextmanager
+def open_source(content: Source) -> Iterator[BinaryIO]:
+    """
+    Файловый объект для openpyxl/pandas/ElementTree: байты оборачиваются в BytesIO,
+    путь открывается (и закрывается по выходу), файловый объект перематывается в начало.
+    """
+    if isinstance(content, (bytes, bytearray)):
+        yield io.BytesIO(content)
+    elif isinstance(content, (str, os.PathLike)):
+        # openpyxl проверяет расширение у пути, а у временного файла его нет
+        with open(content, "rb") as f:
+            yield f
+    else:
+        content.seek(0)
+        yield content
+
+
+def source_size(content: Source) -> int:
+    """Размер содержимого в байтах"""
+    if isinstance(content, (bytes, bytearray)):
+        return len(content)
+    if isinstance(content, (str, os.PathLike)):
+        return os.path.getsize(content)
+    position = content.tell()
+    size = content.seek(0, io.SEEK_END)
+    content.seek(position)
+    return size
+
+
+class SpooledUpload:
+    """
+    Загруженный файл: source - байты или путь к файлу (передается в пул исполнителей).
+    Временный файл удаляется в cleanup, только если он создан здесь (owned).
+    """
+
+    __slots__ = ("source", "size", "sha256", "filename", "owned")
+
+    def __init__(self, source: Union[bytes, str], size: int, sha256: str, filename: str, owned: bool = True):
+        self.source = source
+        self.size = size
+        self.sha256 = sha256
+        self.filename = filename
+        self.owned = owned
+
+    def cleanup(self) -> None:
+        if not self.owned:
+            return
+        try:
+            os.remove(self.source)
+        except OSError:
+            pass
+
+
+def spool(stream: BinaryIO, filename: str = "", max_bytes: Optional[int] = None) -> SpooledUpload:
+    """Копирует поток кусками во временный файл; при превышении max_bytes файл удаляется сразу"""
+    max_bytes = max_upload_bytes() if max_bytes is None else max_bytes
+    digest = hashlib.sha256()
+    size = 0
+    handle, path = tempfile.mkstemp(prefix="upload_", dir=os.getenv("UPLOAD_SPOOL_DIR") or None)
+    try:
+        with os.fdopen(handle, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise UploadTooLargeError(max_bytes, filename)
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return SpooledUpload(path, size, digest.hexdigest(), filename)
+
+
+def _digest(stream: BinaryIO, filename: str, max_bytes: int):
+    """Размер и SHA-256 потока (читается кусками с начала)"""
+    digest = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise UploadTooLargeError(max_bytes, filename)
+        digest.update(chunk)
+    return size, digest.hexdigest()
+
+
+def shared_source(file, processes: bool) -> Optional[Union[bytes, str]]:
+    """
+    Содержимое SpooledTemporaryFile Starlette без копирования на диск:
+    байты, если файл еще в памяти, или путь к его файлу на диске.
+    Безымянный TemporaryFile (name - номер дескриптора) доступен по
+    /proc/self/fd только в этом процессе, поэтому для пула процессов - None.
+    """
+    raw = getattr(file, "_file", file)
+    if isinstance(raw, io.BytesIO):
+        return raw.getvalue()
+    name = getattr(raw, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return name
+    if isinstance(name, int) and not processes:
+        path = f"/proc/self/fd/{name}"
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _spool_upload(file, filename: str, max_bytes: int, processes: bool) -> SpooledUpload:
+    source = shared_source(file, processes)
+    if source is None:
+        file.seek(0)
+        return spool(file, filename, max_bytes)
+    size, sha256 = _digest(io.BytesIO(source) if isinstance(source, bytes) else file, filename, max_bytes)
+    return SpooledUpload(source, size, sha256, filename, owned=False)
+
+
+async def spool_upload(upload, max_bytes: Optional[int] = None, processes: Optional[bool] = None) -> SpooledUpload:
+    """
+    Готовит UploadFile к обработке вне event loop (без чтения целиком в память).
+    processes - обработка в пуле процессов (по умолчанию - по типу пула исполнителей).
+    Источник действителен, пока открыт UploadFile (FastAPI закрывает его после ответа).
+    """
+    max_bytes = max_upload_bytes() if max_bytes is None else max_bytes
+    if max_bytes and upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLargeError(max_bytes, upload.filename or "")
+    if processes is None:
+        processes = init_executor().kind == "process"
+    return await asyncio.to_thread(_spool_upload, upload.file, upload.filename or "", max_bytes, processes)
@@ -0,0 +1,190 @@
+"""
+Метрики времени выполнения этапов обработки (формат Prometheus).
+
+Этапы замеряются в горячем пути (чтение запроса, загрузка книги, проход
+по строкам, разбор декларации, сохранение в БД), длительности и количество
+строк/позиций копятся в гистограммах и отдаются на GET /metrics.
+
+Настройка через переменные окружения:
+    METRICS_ENABLED - "1" (по умолчанию) или "0"; в выключенном режиме
+                      start() возвращает 0 и observe/stop сразу выходят
+
+Задачи из пула процессов пишут замеры в локальный буфер (capture),
+буфер возвращается вместе с результатом и сливается в реестр основного процесса.
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+ENABLED = os.getenv("METRICS_ENABLED", "1").strip().lower() not in ("0", "false", "no", "off")
+
+# Границы корзин гистограмм
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+ITEMS_BUCKETS = (1, 10, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000)
+
+STAGE_DURATION = "mappingdata_stage_duration_seconds"
+STAGE_ITEMS = "mappingdata_stage_items"
+HTTP_DURATION = "mappingdata_http_request_duration_seconds"
+
+METRICS = {
+    STAGE_DURATION: ("Длительность этапа обработки, сек", DURATION_BUCKETS),
+    STAGE_ITEMS: ("Количество строк/позиций, обработанных на этапе", ITEMS_BUCKETS),
+    HTTP_DURATION: ("Длительность HTTP-запроса, сек", DURATION_BUCKETS),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+
+class Histogram:
+    """Накопительная гистограмма с фиксированными границами корзин"""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_histograms: Dict[Tuple[str, Labels], Histogram] = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def _record(name: str, labels: Labels, value: float) -> None:
+    sink = getattr(_local, "sink", None)
+    if sink is not None:
+        sink.append((name, labels, value))
+        return
+    key = (name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(METRICS[name][1])
+        histogram.observe(value)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """Добавляет значение в гистограмму name с метками labels"""
+    if not ENABLED:
+        return
+    _record(name, tuple(sorted(labels.items())), value)
+
+
+def start() -> float:
+    """Отметка начала этапа (0, если метрики выключены)"""
+    return time.perf_counter() if ENABLED else 0.0
+
+
+def stop(stage: str, started: float, items: Optional[int] = None) -> None:
+    """Фиксирует длительность этапа с момента started и, если задано, количество позиций"""
+    if not ENABLED:
+        return
+    labels = (("stage", stage),)
+    _record(STAGE_DURATION, labels, time.perf_counter() - started)
+    if items is not None:
+        _record(STAGE_ITEMS, labels, items)
+
+
+@contextmanager
+def timed(stage: str):
+    """Контекстный менеджер для замера небольшого блока кода"""
+    started = start()
+    try:
+        yield
+    finally:
+        stop(stage, started)
+
+
+@contextmanager
+def capture():
+    """Собирает замеры текущего потока в список вместо общего реестра"""
+    previous = getattr(_local, "sink", None)
+    samples: List[Sample] = []
+    _local.sink = samples
+    try:
+        yield samples
+    finally:
+        _local.sink = previous
+
+
+def call_collecting(func: Callable, *args: Any) -> Tuple[Any, List[Sample]]:
+    """Выполняет func(*args) в воркере и возвращает результат вместе с замерами"""
+    with capture() as samples:
+        result = func(*args)
+    return result, samples
+
+
+def merge(samples: Iterable[Sample]) -> None:
+    """Сливает замеры, полученные из воркера, в реестр процесса"""
+    for name, labels, value in samples:
+        _record(name, labels, value)
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_number(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(gauges: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+    """
+    Текст в формате Prometheus (text/plain; version=0.0.4).
+
+    Args:
+        gauges: дополнительные показатели {имя: (описание, значение)}
+    """
+    with _lock:
+        snapshot = [
+            (name, labels, histogram.bounds, list(histogram.counts), histogram.sum, histogram.count)
+            for (name, labels), histogram in _histograms.items()
+        ]
+
+    lines = []
+    for name in METRICS:
+        entries = sorted((entry for entry in snapshot if entry[0] == name), key=lambda entry: entry[1])
+        if not entries:
+            continue
+        lines.append(f"# HELP {name} {METRICS[name][0]}")
+        lines.append(f"# TYPE {name} histogram")
+        for _, labels, bounds, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket in zip(bounds, counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_format_labels(labels, ('le', _format_number(bound)))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for name, (description, value) in (gauges or {}).items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_format_number(value)}")
+
+    return "\n".join(lines) + "\n"
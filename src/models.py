@@ -46,6 +46,45 @@ class RawDataRequest(BaseModel):
     order_number: str = ""  # Номер заказа для сохранения в БД
 
 
+class SaveSessionRequest(BaseModel):
+    """Открытие сессии поэтапного сохранения: поля RawDataRequest без контейнеров"""
+    totals: Dict[str, Any] = {}
+    calc: Dict[str, Any] = {}
+    sender_name: str = ""
+    sender_address: str = ""
+    recipient_name: str = ""
+    recipient_address: str = ""
+    invoice: str = ""
+    date_invoice: str = ""
+    sender: str = ""
+    recipient: str = ""
+    truck: str = ""
+    client_name: str = ""
+    order_number: str = ""
+
+
+class SaveChunkRequest(BaseModel):
+    """Пачка контейнеров в сессии сохранения"""
+    containers: Dict[str, List[Dict[str, Any]]]
+    container_info: Dict[str, dict] = {}
+
+
+class SaveFinalizeRequest(BaseModel):
+    """Завершение сессии сохранения"""
+    expected_containers: Optional[int] = None  # Проверка, что приняты все контейнеры
+
+
+class RowPatchRequest(BaseModel):
+    """Правка строк загрузки: {колонка: новое значение}"""
+    values: Dict[str, Any]
+
+
+class UploadSaveRequest(BaseModel):
+    """Сохранение загрузки из серверного хранилища в БД"""
+    client_name: str = ""
+    order_number: str = ""
+
+
 # ===== Модели для сравнения =====
 class DocumentInfo(BaseModel):
     """Информация о документе."""
@@ -1,8 +1,36 @@
+import re
+import math
 import pandas as pd
-import io
+from itertools import chain
+from datetime import datetime
 from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
 from decimal import Decimal
+from typing import Dict, List, Optional
 from src.models import ExcelData, Totals, Calc
+from src import metrics
+from src.ingest import Source, open_source
+
+# Строки, которые pd.read_excel по умолчанию считает пустыми значениями (NaN)
+PANDAS_NA_STRINGS = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+    "nan", "null",
+}) | frozenset(ERROR_CODES)
+
+# Пустое значение ячейки в потоковом режиме (ведет себя как NaN из pandas)
+_NA = float("nan")
+
+# Текстовые колонки листа "PL": их тип pandas выводит по всем значениям колонки
+TEXT_COLUMNS = (1, 2, 5, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18)
+
+# Строки, которые pandas при выводе типа колонки считает числами
+_INTEGER_TEXT = re.compile(r"\s*[+-]?\d+\s*", re.ASCII)
+_NUMBER_TEXT = re.compile(r"\s*[+-]?(?:(?:\d+\.?\d*|\.\d+)(?:e[+-]?\d+)?|inf(?:inity)?)\s*",
+                          re.ASCII | re.IGNORECASE)
+
+# Коды упаковки, для которых "Информация об упаковке" всегда 0
+NO_PACKAGE_KINDS = {"NE", "NF", "NG", "PP"}
 
 def get_precise_float_from_excel(workbook, sheet_name, row_idx, col_idx):
     """
@@ -12,13 +40,75 @@ def get_precise_float_from_excel(workbook, sheet_name, row_idx, col_idx):
     try:
         sheet = workbook[sheet_name]
         cell = sheet.cell(row=row_idx + 1, column=col_idx + 1)  # openpyxl использует 1-based индексацию
-        
-        if cell.value is None:
+        return precise_float(cell.value)
+    except Exception:
+        # В случае ошибки возвращаем 0.0
+        return 0.0
+
+
+def _is_clean_float(number: float) -> bool:
+    """
+    Быстрая проверка по кратчайшему представлению repr(): если в нем нет
+    экспоненты и не больше 10 знаков после точки, очистка вернет число без изменений.
+    """
+    text = repr(number)
+    if 'e' in text or 'n' in text:  # экспонента, inf, nan
+        return False
+    return len(text) - text.index('.') - 1 <= 10
+
+
+def precise_float(value):
+    """
+    Очищает сырое значение ячейки Excel от артефактов float.
+    Используется как get_precise_float_from_excel, так и потоковым чтением листа.
+    """
+    if value.__class__ is float and _is_clean_float(value):
+        return value
+    if value.__class__ is int and -2 ** 53 <= value <= 2 ** 53:
+        return float(value)
+    return _precise_float_slow(value)
+
+
+def precise_floats(values) -> List[float]:
+    """
+    Пакетная очистка колонки сырых значений ячеек (см. precise_float).
+    Сначала дешевая проверка по repr(), медленный поиск артефактов -
+    только для оставшихся значений (с кэшем повторов внутри колонки).
+    """
+    result = []
+    append = result.append
+    slow_cache = {}
+    for value in values:
+        cls = value.__class__
+        if cls is float and _is_clean_float(value):
+            append(value)
+        elif cls is int and -2 ** 53 <= value <= 2 ** 53:
+            append(float(value))
+        elif value is None:
+            append(0.0)
+        else:
+            key = (cls, value)
+            try:
+                cleaned = slow_cache.get(key)
+            except TypeError:  # нехэшируемое значение
+                cleaned = None
+                key = None
+            if cleaned is None:
+                cleaned = _precise_float_slow(value)
+                if key is not None:
+                    slow_cache[key] = cleaned
+            append(cleaned)
+    return result
+
+
+def _precise_float_slow(value):
+    """Полная очистка с поиском артефактов float через Decimal."""
+    try:
+        if value is None:
             return 0.0
-        
         # Если значение - число
-        if isinstance(cell.value, (int, float)):
-            original_float = float(cell.value)
+        if isinstance(value, (int, float)):
+            original_float = float(value)
             
             # Используем Decimal для точного представления
             # Важно: преобразуем через строку для избежания потери точности
@@ -74,13 +164,13 @@ def get_precise_float_from_excel(workbook, sheet_name, row_idx, col_idx):
             return float(decimal_value)
         
         # Если это строка, пытаемся преобразовать
-        if isinstance(cell.value, str):
+        if isinstance(value, str):
             try:
                 # Используем Decimal для точного преобразования
-                decimal_value = Decimal(cell.value)
+                decimal_value = Decimal(value)
                 # Определяем количество знаков после запятой из строки
-                if '.' in cell.value:
-                    fractional_part = cell.value.split('.')[1]
+                if '.' in value:
+                    fractional_part = value.split('.')[1]
                     decimal_places = len(fractional_part)
                     if decimal_places > 15:
                         decimal_places = 15
@@ -90,13 +180,12 @@ def get_precise_float_from_excel(workbook, sheet_name, row_idx, col_idx):
                 return 0.0
         
         return 0.0
-    except Exception as e:
-        # В случае ошибки возвращаем 0.0
+    except Exception:
         return 0.0
 
-def process_unified(file_content: bytes, CON_NUMBER: str = None) -> dict:
-    
-    storage = ExcelData(
+
+def _new_storage() -> ExcelData:
+    return ExcelData(
         containers={},
         container_info={},
         totals=Totals(),
@@ -109,157 +198,620 @@ def process_unified(file_content: bytes, CON_NUMBER: str = None) -> dict:
         recipient_address="-"
     )
 
-    column_mapping = {
-        "Unnamed: 0": "Номер",
-        "Unnamed: 1": "Код ТН ВЭД",
-        "Unnamed: 2": "Коммерческое описание товара",
-        "Unnamed: 3": "Кол-во штук",
-        "Unnamed: 4": "Кол-во мест",
-        "Unnamed: 5": "Упаковка",
-        "Unnamed: 6": "Нетто",
-        "Unnamed: 7": "Брутто",
-        "Unnamed: 8": "Валюта",
-        "Unnamed: 9": "Сумма",
-        "Unnamed: 10": "Номер контейнера",
-        "Unnamed: 11": "Номер инвойса",
-        "Unnamed: 12": "Дата инвойса",
-        "Unnamed: 13": "Отправитель:",
-        "Unnamed: 14": "Адрес отправителя:",
-        "Unnamed: 15": "Продавец:",
-        "Unnamed: 16": "Получатель:",
-        "Unnamed: 17": "Адрес получателя:",
-        "Unnamed: 18": "Покупатель:",
+
+class ContainerSlice:
+    """
+    Контейнер инвойса в результате process_unified: его ключи в storage.containers,
+    итоги и шапка (последняя строка) по его строкам. По ним select_container
+    выделяет контейнер без повторного чтения файла.
+    """
+
+    __slots__ = ("keys", "quantity", "weight", "amount", "info")
+
+    def __init__(self):
+        self.keys: List[str] = []
+        self.quantity = 0
+        self.weight = 0
+        self.amount = 0
+        self.info: Optional[dict] = None
+
+
+def select_container(result: dict, CON_NUMBER: Optional[str]) -> Optional[dict]:
+    """
+    Результат process_unified(file, CON_NUMBER) из результата обработки всех контейнеров
+    (CON_NUMBER=None): товары не копируются, итоги и шапка берутся из индекса "index".
+
+    Returns:
+        None, если индекса нет (ошибка обработки или результат без индекса) -
+        тогда контейнер нужно обработать отдельно
+    """
+    if CON_NUMBER is None:
+        return result
+    index = result.get("index")
+    if index is None:
+        return None
+    full = result["storage"]
+    storage = _new_storage()
+    part = index.get(CON_NUMBER)
+    if part is not None:
+        for container_key in part.keys:
+            storage.containers[container_key] = full.containers[container_key]
+            storage.container_info[container_key] = full.container_info[container_key]
+        storage.sender_name = part.info['sender_name']
+        storage.sender_address = part.info['sender_address']
+        storage.recipient_name = part.info['recipient_name']
+        storage.recipient_address = part.info['recipient_address']
+        storage.invoice = part.info['invoice']
+        storage.date_invoice = part.info['date_invoice']
+    _set_totals(storage, part.quantity if part else 0, part.weight if part else 0, part.amount if part else 0)
+    return {"success": True, "storage": storage, "index": {CON_NUMBER: part} if part else {}}
+
+
+def _set_totals(storage: ExcelData, quantity, weight, amount) -> None:
+    storage.calc.calc_quantity = quantity
+    storage.calc.calc_weight = weight
+    storage.calc.calc_amount = amount
+    storage.totals.total_quantity = quantity
+    storage.totals.total_weight = weight
+    storage.totals.total_amount = amount
+
+
+def _pandas_value(value):
+    """
+    Приводит сырое значение openpyxl к тому, что вернул бы pd.read_excel
+    в колонке типа object: пустые и NA-строки -> _NA, целые float -> int.
+    """
+    if value is None:
+        return _NA
+    if isinstance(value, str):
+        return _NA if value in PANDAS_NA_STRINGS else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _column_kind(value) -> Optional[type]:
+    """
+    Тип, к которому pandas приводит непустое значение при выводе типа колонки:
+    int, float, datetime или None - значение оставляет колонку текстовой (object).
+    Значение - уже после _pandas_value.
+    """
+    if isinstance(value, bool):
+        return int
+    if isinstance(value, int):
+        if -2 ** 63 <= value < 2 ** 63:
+            return int
+        # uint64 с пустыми значениями pandas оставляет object, большие числа - float
+        return None if 0 < value < 2 ** 64 else float
+    if isinstance(value, float):
+        return float
+    if isinstance(value, datetime):
+        return datetime
+    if isinstance(value, str):
+        if _INTEGER_TEXT.fullmatch(value):
+            return int if -2 ** 63 <= int(value) < 2 ** 63 else None
+        if _NUMBER_TEXT.fullmatch(value) and (math.isfinite(float(value)) or "n" in value.lower()):
+            return float
+    return None
+
+
+def _is_na(value) -> bool:
+    return value is _NA or value is pd.NaT
+
+
+def _typed_value(value, kind: type):
+    """Значение в колонке pandas типа kind (float64, int64 или datetime64)."""
+    if kind is datetime:
+        return pd.NaT if value is _NA else value
+    if value is _NA:
+        return _NA
+    if isinstance(value, str):
+        return float(value) if kind is float else int(value)
+    return kind(value)
+
+
+def _typed_columns(titles, rows, columns) -> Dict[int, type]:
+    """
+    Колонки из columns, которым pd.read_excel выведет не текстовый тип: все значения
+    колонки, включая строку заголовков таблицы, - пустые и числа (числовые строки)
+    либо пустые и даты. Числа с пустыми или дробными значениями дают float64
+    (12345 -> "12345.0"), иначе int64; пустые значения дат - NaT.
+    """
+    kinds = {col: set() for col in columns}
+    pending_empty = False
+    for values in chain((titles,), rows):
+        width = _row_width(values)
+        if not width:
+            # Пустые строки в конце листа pandas отбрасывает, в середине - это NaN
+            pending_empty = True
+            continue
+        for col in list(kinds):
+            found = kinds[col]
+            value = _pandas_value(values[col]) if col < width else _NA
+            if value is _NA:
+                found.add(_NA)
+            else:
+                kind = _column_kind(value)
+                if kind is None or ((datetime in found) != (kind is datetime) and found - {_NA}):
+                    del kinds[col]
+                    continue
+                found.add(kind)
+            if pending_empty:
+                found.add(_NA)
+        pending_empty = False
+        if not kinds:
+            break
+
+    typed = {}
+    for col, found in kinds.items():
+        if datetime in found:
+            typed[col] = datetime
+        elif found - {int}:
+            typed[col] = float  # есть пустые или дробные значения
+        elif found:
+            typed[col] = int
+    return typed
+
+
+def _row_width(values) -> int:
+    """Ширина строки без хвостовых пустых ячеек (как в pandas get_sheet_data)."""
+    width = len(values)
+    while width and (values[width - 1] is None or values[width - 1] == ""):
+        width -= 1
+    return width
+
+
+def _party_info(values, missing, typed) -> dict:
+    """
+    Собирает отправителя/получателя/инвойс из строки листа "PL" так же,
+    как это делает обработка через pandas (включая "nan" для пустых ячеек).
+    typed - колонки листа с не текстовым типом в pandas (см. _typed_columns).
+    """
+    def get(col, default=None):
+        if col in missing:
+            return default
+        value = _pandas_value(values[col]) if col < len(values) else _NA
+        kind = typed.get(col)
+        return value if kind is None else _typed_value(value, kind)
+
+    def text(col):
+        value = get(col)
+        return str(value).strip() if not _is_na(value) and value is not None else ''
+
+    def suffix(col):
+        value = get(col)
+        if _is_na(value) or value is None or not str(value).strip():
+            return ""
+        return f" П/П {str(value).strip()}"
+
+    return {
+        'sender_name': str(get(13, '')).strip() + suffix(15),
+        'sender_address': str(get(14, '')).strip(),
+        'recipient_name': str(get(16, '')).strip() + suffix(18),
+        'recipient_address': str(get(17, '')).strip(),
+        'invoice': text(11),
+        'date_invoice': text(12),
+    }
+
+
+def _process_unified_streaming(file_content: Source, CON_NUMBER: str = None) -> dict:
+    """
+    Потоковая обработка листа "PL": книга читается один раз через openpyxl
+    в режиме read_only/values_only, контейнеры и итоги собираются за один проход.
+    Результат совпадает с обработкой через pandas (_process_unified_pandas).
+    """
+    storage = _new_storage()
+
+    calculated_total_quantity = 0
+    calculated_total_weight = 0
+    calculated_total_amount = 0
+
+    container_invoices = {}  # {container_number: set(invoice_numbers)}
+    index: Dict[str, ContainerSlice] = {}  # {container_number: ContainerSlice}
+    last_rows = {}  # {container_number: строка} - последняя строка контейнера
+    all_items = []  # [(container_number, invoice_number, item)] в порядке строк
+    first_rows = {}  # {(container_number, invoice_number): строка} - первая строка пары
+    first_container_rows = {}  # {container_number: строка} - первая строка контейнера
+    last_row = None
+
+    try:
+        started = metrics.start()
+        # Книга в режиме read_only читает файл по ходу прохода - он открыт до конца цикла
+        with open_source(file_content) as source:
+            workbook = load_workbook(source, read_only=True, data_only=True)
+            metrics.stop("invoice.load", started)
+            started = metrics.start()
+            try:
+                sheet = workbook["PL"]
+                # Размеры в файле бывают неверными, pandas их тоже сбрасывает
+                sheet.reset_dimensions()
+                rows = sheet.iter_rows(values_only=True)
+
+                # Первая строка листа - заголовок pandas. Колонки с текстом в заголовке
+                # не получают имя "Unnamed: N" и при обработке через pandas недоступны.
+                header = next(rows, ())
+                named = {col for col, value in enumerate(header) if value is not None and value != ""}
+                width = _row_width(header)
+
+                # Вторая строка - заголовки таблицы (в pandas-режиме пропускается через iloc[1:])
+                titles = next(rows, ())
+                width = max(width, _row_width(titles))
+
+                package_missing = 5 in named
+                container_missing = 10 in named
+
+                # Текстовая колонка без заголовка (или с числом в заголовке) у pandas становится
+                # числовой, если в ней только числа, или колонкой дат. Это видно лишь после
+                # всего листа, поэтому для таких листов (редкий случай) типы колонок выводятся
+                # отдельным проходом по листу до основного - без чтения строк в память.
+                typed = {}
+                candidates = [
+                    col for col in TEXT_COLUMNS
+                    if col not in named
+                    and (col >= len(titles) or _pandas_value(titles[col]) is _NA
+                         or _column_kind(_pandas_value(titles[col])) is not None)
+                ]
+                if candidates:
+                    scan_started = metrics.start()
+                    typed = _typed_columns(titles, sheet.iter_rows(min_row=3, values_only=True), candidates)
+                    metrics.stop("invoice.type_scan", scan_started)
+
+                def get(values, col):
+                    if col in named:
+                        return None
+                    value = _pandas_value(values[col]) if col < len(values) else _NA
+                    kind = typed.get(col)
+                    return value if kind is None else _typed_value(value, kind)
+
+                def text(values, col):
+                    value = get(values, col)
+                    return str(value).strip() if not _is_na(value) and value is not None else ''
+
+                for values in rows:
+                    row_width = _row_width(values)
+                    if row_width > width:
+                        width = row_width
+                    if row_width <= 10 or container_missing:
+                        continue
+
+                    container_number = get(values, 10)
+                    if _is_na(container_number) or str(container_number).strip() == '':
+                        continue
+
+                    container_number = str(container_number).strip()
+                    if not (CON_NUMBER == container_number or CON_NUMBER is None):
+                        continue
+
+                    invoice_number = text(values, 11)
+                    invoices = container_invoices.get(container_number)
+                    if invoices is None:
+                        invoices = container_invoices[container_number] = set()
+                        index[container_number] = ContainerSlice()
+                        first_container_rows[container_number] = values
+                    if invoice_number:
+                        invoices.add(invoice_number)
+                    if (container_number, invoice_number) not in first_rows:
+                        first_rows[(container_number, invoice_number)] = values
+                    last_row = values
+                    last_rows[container_number] = values
+
+                    quantity_places = precise_float(values[4])
+                    weight_netto = precise_float(values[6])
+                    weight_brutto = precise_float(values[7])
+                    amount = precise_float(values[9])
+
+                    package_raw = '' if package_missing else get(values, 5)
+
+                    item = {
+                        "Код ТН ВЭД": text(values, 1)[:6],
+                        "Коммерческое описание товара": text(values, 2),
+                        "Признак товара, свободного от применения запретов и ограничений (всегда 1)": 1,
+                        "Информация об упаковке (0-БЕЗ, 1 С)":
+                            0 if package_raw.strip() in NO_PACKAGE_KINDS else (1 if weight_brutto >= weight_netto else 0),
+                        "Количество грузовых мест": quantity_places,
+                        "Вид информации об упаковке (всегда 0)": 0,
+                        "Вид упаковки ": text(values, 5),
+                        "Количество упаковок": quantity_places,
+                        "Номер контейнера": container_number,
+                        "Вес брутто": weight_brutto,
+                        "Валюта": text(values, 8),
+                        "Сумма": amount,
+                    }
+                    all_items.append((container_number, invoice_number, item))
+
+                    calculated_total_quantity += quantity_places
+                    calculated_total_weight += weight_brutto
+                    calculated_total_amount += amount
+                    # Итоги контейнера - в том же порядке сложения, что и при фильтре по CON_NUMBER
+                    part = index[container_number]
+                    part.quantity += quantity_places
+                    part.weight += weight_brutto
+                    part.amount += amount
+            finally:
+                workbook.close()
+        metrics.stop("invoice.rows", started, len(all_items))
+        started = metrics.start()
+
+        # Колонки за пределами самой широкой строки pandas тоже не создает
+        missing = named | set(range(width, 19))
+
+        # Раскладываем товары по ключам: если в контейнере несколько инвойсов,
+        # к ключу добавляется номер инвойса
+        key_rows = {}
+        for container_number, invoice_number, item in all_items:
+            if len(container_invoices[container_number]) > 1 and invoice_number:
+                container_key = f"{container_number}_{invoice_number}"
+                source_row = first_rows[(container_number, invoice_number)]
+            elif len(container_invoices[container_number]) > 1:
+                container_key = container_number
+                source_row = first_rows[(container_number, '')]
+            else:
+                container_key = container_number
+                source_row = first_container_rows[container_number]
+
+            items = storage.containers.get(container_key)
+            if items is None:
+                items = storage.containers[container_key] = []
+                key_rows[container_key] = source_row
+                index[container_number].keys.append(container_key)
+            items.append(item)
+
+        for container_key, source_row in key_rows.items():
+            storage.container_info[container_key] = _party_info(source_row, missing, typed)
+        for container_number, part in index.items():
+            part.info = _party_info(last_rows[container_number], missing, typed)
+        metrics.stop("invoice.group", started, len(storage.containers))
+
+        # Общая информация для совместимости берется из последней строки
+        if last_row is not None:
+            info = _party_info(last_row, missing, typed)
+            storage.sender_name = info['sender_name']
+            storage.sender_address = info['sender_address']
+            storage.recipient_name = info['recipient_name']
+            storage.recipient_address = info['recipient_address']
+            storage.invoice = info['invoice']
+            storage.date_invoice = info['date_invoice']
+
+    except Exception as e:
+        return {"error": str(e)}
+
+    _set_totals(storage, calculated_total_quantity, calculated_total_weight, calculated_total_amount)
+
+    return {"success": True, "storage": storage, "index": index}
+
+
+# Колонки листа "PL" (имена pandas при пустой первой строке)
+COLUMN_MAPPING = {
+    "Unnamed: 0": "Номер",
+    "Unnamed: 1": "Код ТН ВЭД",
+    "Unnamed: 2": "Коммерческое описание товара",
+    "Unnamed: 3": "Кол-во штук",
+    "Unnamed: 4": "Кол-во мест",
+    "Unnamed: 5": "Упаковка",
+    "Unnamed: 6": "Нетто",
+    "Unnamed: 7": "Брутто",
+    "Unnamed: 8": "Валюта",
+    "Unnamed: 9": "Сумма",
+    "Unnamed: 10": "Номер контейнера",
+    "Unnamed: 11": "Номер инвойса",
+    "Unnamed: 12": "Дата инвойса",
+    "Unnamed: 13": "Отправитель:",
+    "Unnamed: 14": "Адрес отправителя:",
+    "Unnamed: 15": "Продавец:",
+    "Unnamed: 16": "Получатель:",
+    "Unnamed: 17": "Адрес получателя:",
+    "Unnamed: 18": "Покупатель:",
+}
+
+# Поля записи товара в порядке вывода
+ITEM_FIELDS = (
+    "Код ТН ВЭД",
+    "Коммерческое описание товара",
+    "Признак товара, свободного от применения запретов и ограничений (всегда 1)",
+    "Информация об упаковке (0-БЕЗ, 1 С)",
+    "Количество грузовых мест",
+    "Вид информации об упаковке (всегда 0)",
+    "Вид упаковки ",
+    "Количество упаковок",
+    "Номер контейнера",
+    "Вес брутто",
+    "Валюта",
+    "Сумма",
+)
+
+
+def _text_column(df: pd.DataFrame, name: str) -> pd.Series:
+    """Вся колонка как str(value).strip(), пустые значения и отсутствующая колонка -> ''."""
+    if name not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    column = df[name]
+    # astype(str) у колонки дат опускает нулевое время, а str(Timestamp) - нет
+    text = column.map(str) if column.dtype.kind == "M" else column.astype(str)
+    return text.str.strip().where(column.notna(), '')
+
+
+def _sheet_column(sheet, row_indices: List[int], col_idx: int) -> list:
+    """Сырые значения ячеек колонки col_idx для 0-based строк row_indices."""
+    cell = sheet.cell
+    column = col_idx + 1  # openpyxl использует 1-based индексацию
+    return [cell(row=row_idx + 1, column=column).value for row_idx in row_indices]
+
+
+def _row_party_info(row: pd.Series) -> dict:
+    """Отправитель/получатель/инвойс из одной строки листа (для container_info)."""
+    return {
+        'sender_name': str(row.get('Unnamed: 13', '')).strip() + (f" П/П {str(row.get('Unnamed: 15', '')).strip()}" if pd.notna(row.get('Unnamed: 15')) and str(row.get('Unnamed: 15')).strip() else ""),
+        'sender_address': str(row.get('Unnamed: 14', '')).strip(),
+        'recipient_name': str(row.get('Unnamed: 16', '')).strip() + (f" П/П {str(row.get('Unnamed: 18', '')).strip()}" if pd.notna(row.get('Unnamed: 18')) and str(row.get('Unnamed: 18')).strip() else ""),
+        'recipient_address': str(row.get('Unnamed: 17', '')).strip(),
+        'invoice': str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else '',
+        'date_invoice': str(row.get('Unnamed: 12', '')).strip() if pd.notna(row.get('Unnamed: 12')) else '',
     }
 
+
+def _process_unified_pandas(file_content: Source, CON_NUMBER: str = None) -> dict:
+    """
+    Обработка листа "PL" через openpyxl + pandas.
+    Текстовые колонки нормализуются целиком (без построчного iterrows),
+    строки раскладываются по контейнерам через groupby.
+    """
+    storage = _new_storage()
+    index: Dict[str, ContainerSlice] = {}  # {container_number: ContainerSlice}
+
+    # Переменные для подсчета общих значений
+    calculated_total_quantity = 0
+    calculated_total_weight = 0
+    calculated_total_amount = 0
+
     try:
         # Читаем Excel файл через openpyxl для точного чтения чисел
-        workbook = load_workbook(io.BytesIO(file_content), data_only=True)
+        started = metrics.start()
+        with open_source(file_content) as source:
+            workbook = load_workbook(source, data_only=True)
         sheet = workbook["PL"]
+        metrics.stop("invoice.load", started)
         
         # Также читаем через pandas для удобства работы со структурой
-        df = pd.read_excel(io.BytesIO(file_content), sheet_name="PL")
+        started = metrics.start()
+        with open_source(file_content) as source:
+            df = pd.read_excel(source, sheet_name="PL")
+        metrics.stop("invoice.read_excel", started, len(df))
+        started = metrics.start()
         
         # Начинаем сканирование с 1 строки (индекс 0 в pandas, но строка 2 в Excel)
         start_row = 1
-        data_df = df.iloc[start_row:].copy()
-        # Переменные для подсчета общих значений
-        calculated_total_quantity = 0
-        calculated_total_weight = 0
-        calculated_total_amount = 0
-        
-        # Сначала собираем все данные для анализа инвойсов по контейнерам
-        container_invoices = {}  # {container_number: set(invoice_numbers)}
-        all_items = []  # Список всех товаров для последующей обработки
-        
-        # Первый проход - собираем информацию о контейнерах и инвойсах
-        for idx, row in data_df.iterrows():
-            container_number = row.get('Unnamed: 10')
-            if pd.isna(container_number) or str(container_number).strip() == '':
-                continue
-            
-            container_number = str(container_number).strip()
-            if CON_NUMBER == container_number or CON_NUMBER is None:
-                invoice_number = str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else ''
-                
-                if container_number not in container_invoices:
-                    container_invoices[container_number] = set()
-                if invoice_number:
-                    container_invoices[container_number].add(invoice_number)
-                
-                all_items.append((idx, row))
-        
-        # Второй проход - обрабатываем товары с правильными ключами
-        for idx, row in all_items:
-            # Определяем номер строки в Excel (idx - это индекс в pandas, +1 для заголовка, +1 для 1-based индексации Excel)
-            excel_row = idx + 2  # +1 для заголовка, +1 для 1-based индексации
-            
-            container_number = str(row.get('Unnamed: 10')).strip()
-            invoice_number = str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else ''
-            
+        data_df = df.iloc[start_row:]
+        if len(data_df.columns) and not (data_df.dtypes == object).any():
+            # Без текстовых колонок строка pandas приводит значения к общему типу
+            # (int -> float) - сохраняем это поведение для совместимости
+            data_df = pd.DataFrame(data_df.to_numpy(), index=data_df.index, columns=data_df.columns)
+
+        # Отбираем строки с номером контейнера (и нужным контейнером, если задан)
+        containers = _text_column(data_df, 'Unnamed: 10')
+        mask = containers != ''
+        if CON_NUMBER is not None:
+            mask &= containers == CON_NUMBER
+        selected = data_df[mask]
+        containers = containers[mask]
+
+        if len(selected):
+            invoices = _text_column(selected, 'Unnamed: 11')
+
+            # Пустое значение в колонке упаковки ломает обработку так же, как раньше (.strip() у NaN)
+            if 'Unnamed: 5' in selected.columns:
+                package_raw = selected['Unnamed: 5'].astype(object)
+                not_text = ~package_raw.map(lambda value: isinstance(value, str))
+                if not_text.any():
+                    bad_value = package_raw[not_text].iloc[0]
+                    raise AttributeError(f"'{type(bad_value).__name__}' object has no attribute 'strip'")
+                package_codes = package_raw.str.strip()
+            else:
+                package_codes = pd.Series('', index=selected.index, dtype=object)
+
             # Определяем ключ контейнера
             # Если в контейнере несколько разных инвойсов, добавляем номер инвойса к ключу
-            if len(container_invoices[container_number]) > 1 and invoice_number:
-                container_key = f"{container_number}_{invoice_number}"
-            else:
-                container_key = container_number
-            
+            has_invoice = invoices != ''
+            invoice_counts = invoices[has_invoice].groupby(containers[has_invoice]).nunique()
+            multi_invoice = containers.map(invoice_counts).fillna(0) > 1
+            keys = containers.where(~(multi_invoice & has_invoice), containers + '_' + invoices)
+
             # Читаем числовые значения напрямую из Excel через openpyxl для точности
-            # В pandas "Unnamed: 4" = колонка 4 (0-based) = колонка 5 в Excel (1-based)
-            # excel_row уже 1-based (строка в Excel), функция ожидает 0-based индекс строки
-            quantity_places = get_precise_float_from_excel(workbook, "PL", excel_row - 1, 4)  # Unnamed: 4
-            weight_brutto = get_precise_float_from_excel(workbook, "PL", excel_row - 1, 7)    # Unnamed: 7
-            weight_netto = get_precise_float_from_excel(workbook, "PL", excel_row - 1, 6)     # Unnamed: 6
-            amount = get_precise_float_from_excel(workbook, "PL", excel_row - 1, 9)            # Unnamed: 9
-            
-            # Создаем запись товара
-            item = {
-                "Код ТН ВЭД": str(row.get('Unnamed: 1', '')).strip()[:6] if pd.notna(row.get('Unnamed: 1')) else '',
-                "Коммерческое описание товара": str(row.get('Unnamed: 2', '')).strip() if pd.notna(row.get('Unnamed: 2')) else '',
-                "Признак товара, свободного от применения запретов и ограничений (всегда 1)": 1,
-                "Информация об упаковке (0-БЕЗ, 1 С)":
-                    0 if row.get('Unnamed: 5', '').strip() in {"NE", "NF", "NG", "PP"} else (1 if weight_brutto >= weight_netto else 0),
-                #"Кол-во штук": float(row.get('Unnamed: 3', 0)) if pd.notna(row.get('Unnamed: 3')) else 0,
-                "Количество грузовых мест": quantity_places,
-                "Вид информации об упаковке (всегда 0)": 0,
-                "Вид упаковки ": str(row.get('Unnamed: 5', '')).strip() if pd.notna(row.get('Unnamed: 5')) else '',
-                "Количество упаковок": quantity_places,
-                #"Нетто": float(row.get('Unnamed: 6', 0)) if pd.notna(row.get('Unnamed: 6')) else 0,
-                "Номер контейнера": container_number, 
-                "Вес брутто": weight_brutto,
-                "Валюта": str(row.get('Unnamed: 8', '')).strip() if pd.notna(row.get('Unnamed: 8')) else '',
-                "Сумма": amount,
-                #"Номер инвойса": str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else '',
-                #"Case No": str(row.get('Unnamed: 10', '')).strip() if pd.notna(row.get('Unnamed: 10')) else '',
-            }
-            
-            # Добавляем товар в контейнер (используем уникальный ключ)
-            if container_key not in storage.containers:
-                storage.containers[container_key] = []
-            
-            storage.containers[container_key].append(item)
-            
-            sender_name = str(row.get('Unnamed: 13', '')).strip() + (f" П/П {str(row.get('Unnamed: 15', '')).strip()}" if pd.notna(row.get('Unnamed: 15')) and str(row.get('Unnamed: 15')).strip() else "")
-            sender_address = str(row.get('Unnamed: 14', '')).strip()
-            recipient_name = str(row.get('Unnamed: 16', '')).strip() + (f" П/П {str(row.get('Unnamed: 18', '')).strip()}" if pd.notna(row.get('Unnamed: 18')) and str(row.get('Unnamed: 18')).strip() else "")
-            recipient_address = str(row.get('Unnamed: 17', '')).strip()
-           
-            # Сохраняем информацию об отправителе и получателе для каждого контейнера
-            if container_key not in storage.container_info:
-                storage.container_info[container_key] = {
-                    'sender_name': sender_name,
-                    'sender_address': sender_address,
-                    'recipient_name': recipient_name,
-                    'recipient_address': recipient_address,
-                    'invoice': str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else '',
-                    'date_invoice': str(row.get('Unnamed: 12', '')).strip() if pd.notna(row.get('Unnamed: 12')) else ''
-                }
-            
-            # Также сохраняем общую информацию для совместимости
-            storage.sender_name = sender_name
-            storage.sender_address = sender_address
-            storage.recipient_name = recipient_name
-            storage.recipient_address = recipient_address
-
-            storage.invoice = str(row.get('Unnamed: 11', '')).strip() if pd.notna(row.get('Unnamed: 11')) else ''
-            storage.date_invoice = str(row.get('Unnamed: 12', '')).strip() if pd.notna(row.get('Unnamed: 12')) else ''
-
-            # Подсчитываем общие значения
-            calculated_total_quantity += item["Количество грузовых мест"]
-            calculated_total_weight += item["Вес брутто"]
-            calculated_total_amount += item["Сумма"]
-            
-            
+            # (индекс pandas + 1 для заголовка = 0-based строка Excel)
+            excel_rows = (selected.index + 1).tolist()
+            quantity_places = precise_floats(_sheet_column(sheet, excel_rows, 4))  # Unnamed: 4
+            weight_brutto = precise_floats(_sheet_column(sheet, excel_rows, 7))    # Unnamed: 7
+            weight_netto = precise_floats(_sheet_column(sheet, excel_rows, 6))     # Unnamed: 6
+            amount = precise_floats(_sheet_column(sheet, excel_rows, 9))            # Unnamed: 9
+
+            package_info = [
+                0 if no_package else (1 if brutto >= netto else 0)
+                for no_package, brutto, netto in zip(
+                    package_codes.isin(NO_PACKAGE_KINDS).tolist(), weight_brutto, weight_netto
+                )
+            ]
+
+            count = len(selected)
+            columns = (
+                _text_column(selected, 'Unnamed: 1').str[:6].tolist(),
+                _text_column(selected, 'Unnamed: 2').tolist(),
+                [1] * count,
+                package_info,
+                quantity_places,
+                [0] * count,
+                _text_column(selected, 'Unnamed: 5').tolist(),
+                quantity_places,
+                containers.tolist(),
+                weight_brutto,
+                _text_column(selected, 'Unnamed: 8').tolist(),
+                amount,
+            )
+            items = [dict(zip(ITEM_FIELDS, values)) for values in zip(*columns)]
+
+            # Раскладываем товары по контейнерам одним groupby (порядок - по первому вхождению)
+            key_values = keys.to_numpy()
+            positions = keys.groupby(key_values, sort=False).indices
+            for container_key in pd.unique(key_values):
+                key_positions = positions[container_key]
+                storage.containers[container_key] = [items[position] for position in key_positions]
+                # Информация об отправителе и получателе - из первой строки контейнера
+                storage.container_info[container_key] = _row_party_info(selected.iloc[key_positions[0]])
+
+            # Индекс по контейнерам: ключи, итоги (в порядке строк) и шапка из последней строки
+            container_values = containers.to_numpy()
+            key_container = dict(zip(key_values, container_values))
+            for container_number, container_positions in containers.groupby(container_values, sort=False).indices.items():
+                part = index[container_number] = ContainerSlice()
+                part.quantity = sum(quantity_places[position] for position in container_positions)
+                part.weight = sum(weight_brutto[position] for position in container_positions)
+                part.amount = sum(amount[position] for position in container_positions)
+                part.info = _row_party_info(selected.iloc[container_positions[-1]])
+            for container_key in storage.containers:
+                index[key_container[container_key]].keys.append(container_key)
+
+            # Общая информация для совместимости берется из последней строки
+            last_info = _row_party_info(selected.iloc[-1])
+            storage.sender_name = last_info['sender_name']
+            storage.sender_address = last_info['sender_address']
+            storage.recipient_name = last_info['recipient_name']
+            storage.recipient_address = last_info['recipient_address']
+            storage.invoice = last_info['invoice']
+            storage.date_invoice = last_info['date_invoice']
+
+            # Подсчитываем общие значения (последовательно, как при построчной обработке)
+            calculated_total_quantity = sum(quantity_places)
+            calculated_total_weight = sum(weight_brutto)
+            calculated_total_amount = sum(amount)
+        metrics.stop("invoice.rows", started, len(selected))
+
     except Exception as e:
         return {"error": str(e)}
-    # Обновляем рассчитанные значения
-    storage.calc.calc_quantity = calculated_total_quantity
-    storage.calc.calc_weight = calculated_total_weight
-    storage.calc.calc_amount = calculated_total_amount
-    # Устанавливаем значения по умолчанию для totals (можно будет обновить при необходимости)
-    storage.totals.total_quantity = calculated_total_quantity
-    storage.totals.total_weight = calculated_total_weight
-    storage.totals.total_amount = calculated_total_amount
+    # Обновляем рассчитанные значения (totals совпадают с calc)
+    _set_totals(storage, calculated_total_quantity, calculated_total_weight, calculated_total_amount)
 
     # Возвращаем результат обработки
-    return {"success": True, "storage": storage}
+    return {"success": True, "storage": storage, "index": index}
+
+
+# Доступные режимы чтения листа "PL"
+ENGINES = {
+    "streaming": _process_unified_streaming,
+    "pandas": _process_unified_pandas,
+}
 
+
+def process_unified(file_content: Source, CON_NUMBER: str = None, engine: str = "streaming") -> dict:
+    """
+    Обрабатывает инвойс единого шаблона (лист "PL").
+
+    Args:
+        file_content: Содержимое Excel файла - байты, путь к файлу или файловый объект
+        CON_NUMBER: Номер контейнера для фильтрации (None - все контейнеры)
+        engine: Режим чтения - "streaming" (один проход openpyxl) или "pandas"
+
+    Returns:
+        {"success": True, "storage": ExcelData, "index": {номер контейнера: ContainerSlice}}
+        или {"error": ...}; по "index" select_container выделяет один контейнер
+    """
+    if engine not in ENGINES:
+        return {"error": f"Неизвестный режим обработки: {engine}"}
+    return ENGINES[engine](file_content, CON_NUMBER)
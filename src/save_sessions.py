@@ -0,0 +1,200 @@
+"""
+Поэтапное (chunked) сохранение больших заказов.
+
+Браузер открывает сессию сохранения (шапка заказа без контейнеров), затем
+отправляет контейнеры пачками. Каждая пачка сразу подготавливается
+(DataHandler.prepare_data) и дописывается на диск, поэтому сервер не держит
+в памяти весь исходный JSON. При обрыве соединения клиент запрашивает
+список уже принятых контейнеров и досылает остальные. Финализация пишет
+весь заказ в БД одной транзакцией.
+
+Настройка через переменные окружения:
+    SAVE_SESSION_DIR - папка для промежуточных данных (по умолчанию во временной папке)
+    SAVE_SESSION_TTL - время жизни неактивной сессии в секундах (по умолчанию 3600)
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import logging
+from typing import Any, Dict, List, Optional
+
+from src.models import RawDataRequest
+from src.services import DataHandler, PreparedItem, to_jsonable
+
+logger = logging.getLogger(__name__)
+
+META_FILE = "meta.json"
+DATA_FILE = "containers.jsonl"
+
+
+class SaveSessionError(Exception):
+    """Ошибка подготовки пачки контейнеров"""
+
+
+class SaveSessionStore:
+    """Сессии сохранения с промежуточными данными на диске"""
+
+    def __init__(self, directory: str, ttl: float = 3600.0):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> "SaveSessionStore":
+        return cls(
+            directory=os.getenv("SAVE_SESSION_DIR") or os.path.join(tempfile.gettempdir(), "mappingdata_save_sessions"),
+            ttl=float(os.getenv("SAVE_SESSION_TTL", "3600")),
+        )
+
+    def _path(self, session_id: str, name: str = "") -> str:
+        return os.path.join(self.directory, session_id, name)
+
+    def _read_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        # session_id приходит из URL - принимаем только то, что сами выдали
+        if not session_id or not all(c in "0123456789abcdef" for c in session_id):
+            return None
+        try:
+            with open(self._path(session_id, META_FILE), encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - meta["updated_at"] > self.ttl:
+            self.discard(session_id)
+            return None
+        return meta
+
+    def _write_meta(self, session_id: str, meta: Dict[str, Any]) -> None:
+        meta["updated_at"] = time.time()
+        tmp_path = self._path(session_id, META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(session_id, META_FILE))
+
+    def _staged(self, session_id: str) -> List[Dict[str, Any]]:
+        """Принятые записи {"key", "data"} в порядке поступления (недописанная строка пропускается)"""
+        records = []
+        try:
+            with open(self._path(session_id, DATA_FILE), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # Запись оборвалась (сбой во время пачки) - клиент дошлет ее повторно
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def open(self, header: Dict[str, Any]) -> Dict[str, Any]:
+        """Создает сессию; header - поля RawDataRequest без контейнеров"""
+        self.cleanup()
+        session_id = uuid.uuid4().hex
+        os.makedirs(self._path(session_id))
+        meta = {"session_id": session_id, "header": header, "created_at": time.time(), "batches": 0}
+        self._write_meta(session_id, meta)
+        return meta
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Состояние сессии (None, если не найдена или истекла)"""
+        meta = self._read_meta(session_id)
+        if meta is None:
+            return None
+        received = list(dict.fromkeys(record["key"] for record in self._staged(session_id)))
+        return {
+            "session_id": session_id,
+            "client_name": meta["header"].get("client_name", ""),
+            "order_number": meta["header"].get("order_number", ""),
+            "batches": meta["batches"],
+            "received": received,
+            "containers_received": len(received),
+            "expires_in": max(0, int(meta["updated_at"] + self.ttl - time.time())),
+        }
+
+    def stage(self, session_id: str, containers: Dict[str, List[dict]], container_info: Dict[str, dict]) -> Optional[int]:
+        """
+        Подготавливает пачку контейнеров и дописывает ее к сессии.
+        Повторно присланный контейнер заменяет ранее принятый.
+
+        Returns:
+            Количество контейнеров в пачке (None, если сессия не найдена)
+        """
+        meta = self._read_meta(session_id)
+        if meta is None:
+            return None
+
+        handler = DataHandler()
+        result = handler.prepare_data(RawDataRequest(
+            **meta["header"], containers=containers, container_info=container_info
+        ))
+        if not result["success"]:
+            raise SaveSessionError(result["error"])
+
+        prepared = {container_data["container"]: container_data for container_data in handler.prepared_data}
+        # Пустые контейнеры prepare_data пропускает - фиксируем их как принятые без данных
+        lines = "".join(
+            json.dumps({"key": key, "data": prepared.get(key)}, ensure_ascii=False, default=to_jsonable) + "\n"
+            for key in containers
+        )
+        with self._lock:
+            # Пачки одной сессии могут прийти параллельно (повтор после таймаута) -
+            # счетчик берется из meta, прочитанной под блокировкой
+            meta = self._read_meta(session_id)
+            if meta is None:
+                return None
+            with open(self._path(session_id, DATA_FILE), "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            meta["batches"] += 1
+            self._write_meta(session_id, meta)
+        return len(containers)
+
+    def prepared_data(self, session_id: str) -> List[Dict[str, Any]]:
+        """Подготовленные контейнеры для save_data_to_db (последняя версия каждого, порядок - первого поступления)"""
+        latest = {}
+        for record in self._staged(session_id):
+            latest[record["key"]] = record["data"]
+        prepared = [data for data in latest.values() if data is not None]
+        for container_data in prepared:
+            container_data["items"] = [PreparedItem.from_dict(item) for item in container_data["items"]]
+        return prepared
+
+    def header(self, session_id: str) -> Optional[Dict[str, Any]]:
+        meta = self._read_meta(session_id)
+        return meta["header"] if meta else None
+
+    def discard(self, session_id: str) -> None:
+        shutil.rmtree(self._path(session_id), ignore_errors=True)
+
+    def cleanup(self) -> None:
+        """Удаляет истекшие сессии"""
+        try:
+            session_ids = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for session_id in session_ids:
+            meta_path = self._path(session_id, META_FILE)
+            try:
+                # Без meta.json (сбой при открытии) - по времени создания папки
+                path = meta_path if os.path.exists(meta_path) else self._path(session_id)
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    self.discard(session_id)
+            except OSError:
+                continue
+
+
+# Глобальное хранилище сессий сохранения
+save_sessions = None
+
+
+def get_save_sessions() -> SaveSessionStore:
+    """Хранилище сессий сохранения (создается при первом обращении)"""
+    global save_sessions
+    if save_sessions is None:
+        save_sessions = SaveSessionStore.from_env()
+    return save_sessions
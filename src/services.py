@@ -3,9 +3,209 @@
 """
 import json
 import os
-from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 from src.models import RawDataRequest
+from src.exports import get_export_store
+
+try:
+    import orjson
+except ImportError:  # без orjson экспорт работает на стандартном json
+    orjson = None
+
+# Колонки строки таблицы (ключи из localStorage)
+PACKAGE_INFO_KEY = "Информация об упаковке (0-БЕЗ, 1 С)"
+PLACES_KEY = "Количество грузовых мест"
+PACKAGE_COUNT_KEY = "Количество упаковок"
+
+
+def safe_float(value, default=0.0):
+    """Безопасное преобразование в float (пустое/некорректное значение - default)"""
+    try:
+        if value is None or value == "":
+            return default
+        return float(value)
+    except (ValueError, TypeError):
+        return default
+
+
+def safe_int(value, default=0):
+    """Безопасное преобразование в int (сначала float, потом int для корректного преобразования)"""
+    try:
+        if value is None or value == "":
+            return default
+        return int(float(value))
+    except (ValueError, TypeError):
+        return default
+
+
+def _truncate(value, limit: int) -> str:
+    """Обрезка строки под лимит VARCHAR (пустое значение - '')"""
+    if not value:
+        return ""
+    return value[:limit] if isinstance(value, str) else str(value)[:limit]
+
+
+class PreparedItem:
+    """
+    Подготовленная строка товара: значения формата 1.json уже приведены,
+    а кортеж для invoice_items (db_values) - уже обрезан под лимиты БД.
+    """
+
+    __slots__ = (
+        "code", "goods_name", "package_info", "places", "package_type",
+        "package_count", "weight", "currency", "value_amount", "db_values",
+    )
+
+    # restriction_flag и package_info_type в формате 1.json всегда 1 и 0
+    restriction_flag = 1
+    package_info_type = 0
+
+    def __init__(self, code, goods_name, package_info, places, package_type, package_count, weight, currency, value_amount):
+        self.code = code
+        self.goods_name = goods_name
+        self.package_info = package_info
+        self.places = places
+        self.package_type = package_type
+        self.package_count = package_count
+        self.weight = weight
+        self.currency = currency
+        self.value_amount = value_amount
+        # Порядок колонок invoice_items без invoice_id
+        self.db_values = (
+            _truncate(code, 20),
+            goods_name,
+            True,
+            bool(package_info),
+            places,
+            0,
+            _truncate(package_type, 10),
+            package_count,
+            weight,
+            _truncate(currency, 10),
+            value_amount,
+        )
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "PreparedItem":
+        """Строка таблицы из localStorage -> подготовленный товар"""
+        get = row.get
+        return cls(
+            get("Код ТН ВЭД", ""),
+            get("Коммерческое описание товара", ""),
+            safe_int(get(PACKAGE_INFO_KEY, 0)),  # Берем значение из данных пользователя
+            safe_int(get(PLACES_KEY, 0)),  # Целое число
+            get("Вид упаковки ", "PP"),
+            safe_int(get(PACKAGE_COUNT_KEY, 0)),  # Целое число
+            safe_float(get("Вес брутто", 0.0)),  # Вещественное число
+            get("Валюта", ""),
+            safe_float(get("Сумма", 0.0)),  # Вещественное число
+        )
+
+    @classmethod
+    def from_dict(cls, item: Dict[str, Any]) -> "PreparedItem":
+        """Товар в формате 1.json (например, прочитанный с диска) -> подготовленный товар"""
+        return cls(
+            item.get("code", ""),
+            item.get("goods_name", ""),
+            safe_int(item.get("package_info", 0)),
+            safe_int(item.get("places", 0)),
+            item.get("package_type", ""),
+            safe_int(item.get("package_count", 0)),
+            safe_float(item.get("weight", 0.0)),
+            item.get("currency", ""),
+            safe_float(item.get("value_amount", 0.0)),
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Товар в формате 1.json"""
+        return {
+            "code": self.code,
+            "goods_name": self.goods_name,
+            "restriction_flag": 1,
+            "package_info": self.package_info,
+            "places": self.places,
+            "package_info_type": 0,
+            "package_type": self.package_type,
+            "package_count": self.package_count,
+            "weight": self.weight,
+            "currency": self.currency,
+            "value_amount": self.value_amount,
+        }
+
+    def get(self, key: str, default=None):
+        """Доступ как к словарю (для кода, работающего с товарами-словарями)"""
+        return getattr(self, key, default) if key != "db_values" else default
+
+    def __eq__(self, other):
+        if isinstance(other, PreparedItem):
+            return self.db_values == other.db_values and self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    def __repr__(self):
+        return f"PreparedItem({self.to_dict()!r})"
+
+
+def to_jsonable(obj):
+    """default для json.dump: подготовленные товары сериализуются в формате 1.json"""
+    if isinstance(obj, PreparedItem):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _env_flag(name: str, default: str = "0") -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+class ExportOptions:
+    """
+    Режим экспорта подготовленных данных в файл (post_data/save_json_file).
+
+    Переменные окружения:
+        EXPORT_PRETTY - "1": JSON с отступами, как раньше (по умолчанию компактный)
+        EXPORT_GZIP   - "1": файл хранится сжатым и отдается с Content-Encoding: gzip
+        EXPORT_DEBUG  - "1": post_data дополнительно печатает контейнеры в консоль
+    """
+
+    __slots__ = ("pretty", "gzip", "debug")
+
+    def __init__(self, pretty: bool = False, gzip: bool = False, debug: bool = False):
+        self.pretty = pretty
+        self.gzip = gzip
+        self.debug = debug
+
+    @classmethod
+    def from_env(cls) -> "ExportOptions":
+        return cls(
+            pretty=_env_flag("EXPORT_PRETTY"),
+            gzip=_env_flag("EXPORT_GZIP"),
+            debug=_env_flag("EXPORT_DEBUG"),
+        )
+
+
+def encode_compact(obj) -> bytes:
+    """Компактный JSON в UTF-8 (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=to_jsonable)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=to_jsonable).encode("utf-8")
+
+
+def write_json_export(f, prepared_data: List[Dict[str, Any]], pretty: bool = False) -> None:
+    """Пишет список контейнеров в бинарный файл f по одному контейнеру, не собирая весь JSON в памяти"""
+    if pretty:
+        indent = b"\n    "
+        f.write(b"[")
+        for index, json_data in enumerate(prepared_data):
+            chunk = json.dumps(json_data, ensure_ascii=False, indent=4, default=to_jsonable).encode("utf-8")
+            f.write((b"," if index else b"") + indent + chunk.replace(b"\n", indent))
+        f.write(b"\n]" if prepared_data else b"]")
+        return
+
+    f.write(b"[")
+    for index, json_data in enumerate(prepared_data):
+        if index:
+            f.write(b",")
+        f.write(encode_compact(json_data))
+    f.write(b"]")
 
 
 class DataHandler:
@@ -54,45 +254,8 @@ class DataHandler:
                     "items": []
                 }
                 
-                # Обрабатываем товары в контейнере
-                for row in container_rows:
-                    # Отладочная информация - выводим значение поля "Информация об упаковке"
-                    package_info_raw = row.get("Информация об упаковке (0-БЕЗ, 1 С)", "НЕ_НАЙДЕНО")
-                    
-                    # Безопасное преобразование в числа с обработкой ошибок
-                    def safe_float(value, default=0.0):
-                        try:
-                            if value is None or value == "":
-                                return default
-                            return float(value)
-                        except (ValueError, TypeError):
-                            return default
-                    
-                    def safe_int(value, default=0):
-                        try:
-                            if value is None or value == "":
-                                return default
-                            return int(float(value))  # Сначала float, потом int для корректного преобразования
-                        except (ValueError, TypeError):
-                            return default
-                    
-                    # Вычисляем package_info
-                    package_info_value = safe_int(row.get("Информация об упаковке (0-БЕЗ, 1 С)", 0))
-                    
-                    item = {
-                        "code": row.get("Код ТН ВЭД", ""),
-                        "goods_name": row.get("Коммерческое описание товара", ""),
-                        "restriction_flag": 1,
-                        "package_info": package_info_value,  # Берем значение из данных пользователя
-                        "places": safe_int(row.get("Количество грузовых мест", 0)),  # Целое число
-                        "package_info_type": 0,
-                        "package_type": row.get("Вид упаковки ", "PP"),
-                        "package_count": safe_int(row.get("Количество упаковок", 0)),  # Целое число
-                        "weight": safe_float(row.get("Вес брутто", 0.0)),  # Вещественное число
-                        "currency": row.get("Валюта", ""),
-                        "value_amount": safe_float(row.get("Сумма", 0.0))  # Вещественное число
-                    }
-                    json_data["items"].append(item)
+                # Обрабатываем товары в контейнере (значения приводятся один раз)
+                json_data["items"] = [PreparedItem.from_row(row) for row in container_rows]
                 
                 # Сохраняем подготовленные данные
                 self.prepared_data.append(json_data)
@@ -110,10 +273,13 @@ class DataHandler:
                 "error": str(e)
             }
     
-    def save_json_file(self) -> Dict[str, Any]:
+    def save_json_file(self, options: Optional[ExportOptions] = None) -> Dict[str, Any]:
         """
         Сохраняет подготовленные данные в JSON файл
         
+        Args:
+            options: Режим экспорта (по умолчанию - из переменных окружения)
+            
         Returns:
             Dict с результатом операции и именем файла
         """
@@ -124,18 +290,15 @@ class DataHandler:
                     "error": "Нет подготовленных данных для сохранения"
                 }
             
-            # Создаем папку для сохранения файлов, если её нет
-            output_dir = "static/downloads"
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Генерируем имя файла с текущей датой и временем
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"mapping_data_{timestamp}.json"
-            filepath = os.path.join(output_dir, filename)
+            options = options or ExportOptions.from_env()
             
-            # Сохраняем данные в файл
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(self.prepared_data, f, ensure_ascii=False, indent=4)
+            # Пишем файл по одному контейнеру в хранилище экспортов (уникальное имя)
+            entry = get_export_store().write(
+                lambda f: write_json_export(f, self.prepared_data, pretty=options.pretty),
+                compress=options.gzip
+            )
+            filename = entry.name
+            filepath = entry.path
             
             return {
                 "success": True,
@@ -151,10 +314,13 @@ class DataHandler:
                 "error": str(e)
             }
 
-    def post_data(self) -> Dict[str, Any]:
+    def post_data(self, options: Optional[ExportOptions] = None) -> Dict[str, Any]:
         """
-        Выводит подготовленные данные в консоль и сохраняет в JSON файл
+        Сохраняет подготовленные данные в JSON файл (в режиме отладки - еще и выводит в консоль)
         
+        Args:
+            options: Режим экспорта (по умолчанию - из переменных окружения)
+            
         Returns:
             Dict с результатом операции
         """
@@ -165,12 +331,15 @@ class DataHandler:
                     "error": "Нет подготовленных данных для отправки"
                 }
             
-            # Выводим каждый контейнер в консоль
-            for json_data in self.prepared_data:
-                print(json.dumps(json_data, ensure_ascii=False, indent=4))
+            options = options or ExportOptions.from_env()
+            
+            # Выводим каждый контейнер в консоль только в режиме отладки
+            if options.debug:
+                for json_data in self.prepared_data:
+                    print(json.dumps(json_data, ensure_ascii=False, indent=4, default=to_jsonable))
             
             # Сохраняем данные в JSON файл
-            save_result = self.save_json_file()
+            save_result = self.save_json_file(options)
             
             if not save_result["success"]:
                 return {
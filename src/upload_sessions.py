@@ -0,0 +1,639 @@
+"""
+Серверное хранилище загруженных данных (сессии загрузки).
+
+Без него /upload возвращает весь разобранный инвойс, браузер держит его в
+localStorage и при каждой правке ячейки заново разбирает и сериализует весь
+объем, а /save отправляет все обратно. С хранилищем данные остаются на
+сервере под id загрузки: страница таблицы запрашивает их один раз, правка
+строки - это PATCH одной строки, а сохранение в БД передает только
+клиента и номер заказа.
+
+Хранилища (UPLOAD_SESSION_BACKEND):
+    memory - в памяти процесса (по умолчанию; только для одного воркера uvicorn)
+    disk   - папка на диске, файл на каждый контейнер
+    sqlite - файл SQLite, строка таблицы на каждую строку инвойса
+    off    - выключено, данные как раньше живут в localStorage
+
+Настройка через переменные окружения:
+    UPLOAD_SESSION_DIR - папка для disk/sqlite (по умолчанию во временной папке)
+    UPLOAD_SESSION_TTL - время жизни неактивной загрузки в секундах (по умолчанию 43200)
+    UPLOAD_SESSION_MAX - максимум загрузок в памяти для memory (по умолчанию 100)
+
+Для постраничного вывода таблицы при загрузке строится индекс в памяти
+(UploadIndex): порядок контейнеров, число строк, итоги и строки поиска
+(код ТН ВЭД, описание). Для disk/sqlite после перезапуска индекс
+строится заново при первом обращении.
+"""
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.services import PLACES_KEY, PACKAGE_COUNT_KEY, safe_float
+
+# Поля, которые хранятся отдельно от шапки загрузки
+CONTAINERS_KEY = "containers"
+CONTAINER_INFO_KEY = "container_info"
+
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+CODE_KEY = "Код ТН ВЭД"
+DESCRIPTION_KEY = "Коммерческое описание товара"
+TOTAL_KEYS = (PLACES_KEY, PACKAGE_COUNT_KEY, "Вес брутто", "Сумма")
+INDEXED_KEYS = frozenset((CODE_KEY, DESCRIPTION_KEY) + TOTAL_KEYS)
+
+MAX_PAGE_SIZE = 1000
+
+
+class UploadSessionError(Exception):
+    """Некорректная правка (неизвестная строка, недопустимое значение)"""
+
+
+def _check_values(values: Dict[str, Any]) -> None:
+    for key, value in values.items():
+        if not isinstance(value, SCALAR_TYPES):
+            raise UploadSessionError(f"Недопустимое значение для колонки '{key}'")
+
+
+def _valid_id(session_id: str) -> bool:
+    # id приходит из URL - принимаем только то, что сами выдали
+    return bool(session_id) and all(c in "0123456789abcdef" for c in session_id)
+
+
+def _search_text(value: Any) -> str:
+    return "" if value is None else str(value).strip().lower()
+
+
+class ContainerIndex:
+    """Контейнер в индексе: строки поиска по каждой строке и итоги"""
+
+    __slots__ = ("container", "codes", "descriptions", "totals")
+
+    def __init__(self, container: str, rows: List[dict]):
+        self.container = container
+        self.codes = [_search_text(row.get(CODE_KEY)) for row in rows]
+        self.descriptions = [_search_text(row.get(DESCRIPTION_KEY)) for row in rows]
+        self.totals = {key: round(sum(safe_float(row.get(key)) for row in rows), 6) for key in TOTAL_KEYS}
+
+    @property
+    def size(self) -> int:
+        return len(self.codes)
+
+    def match(self, code: str = "", description: str = "", search: str = "") -> List[int]:
+        """
+        Номера строк: код ТН ВЭД начинается с code, описание содержит description,
+        а search - начало кода или часть описания (значения уже в нижнем регистре).
+        """
+        if not (code or description or search):
+            return list(range(self.size))
+        return [
+            index
+            for index, (row_code, row_description) in enumerate(zip(self.codes, self.descriptions))
+            if row_code.startswith(code) and description in row_description
+            and (not search or row_code.startswith(search) or search in row_description)
+        ]
+
+
+class UploadIndex:
+    """Индекс загрузки для постраничного вывода и поиска"""
+
+    __slots__ = ("containers", "_positions")
+
+    def __init__(self, containers: Dict[str, List[dict]]):
+        self.containers = [ContainerIndex(container, rows) for container, rows in containers.items()]
+        self._positions = {entry.container: position for position, entry in enumerate(self.containers)}
+
+    def get(self, container: str) -> Optional[ContainerIndex]:
+        position = self._positions.get(container)
+        return None if position is None else self.containers[position]
+
+    def refresh(self, container: str, rows: List[dict]) -> None:
+        """Перестраивает запись контейнера после правки"""
+        position = self._positions.get(container)
+        if position is not None:
+            self.containers[position] = ContainerIndex(container, rows)
+
+    def search(self, container: str = "", code: str = "", description: str = "",
+               search: str = "") -> List[Tuple[ContainerIndex, int]]:
+        """
+        Контейнеры, подходящие под фильтры, с количеством подходящих строк.
+        search - общий поиск: номер контейнера, начало кода ТН ВЭД или часть описания.
+        """
+        container, code, description, search = (
+            _search_text(value) for value in (container, code, description, search)
+        )
+        found = []
+        for entry in self.containers:
+            name = entry.container.lower()
+            if container and container not in name:
+                continue
+            # Совпадение по номеру контейнера - общий поиск по строкам не нужен
+            row_search = "" if search and search in name else search
+            if code or description or row_search:
+                matched = len(entry.match(code, description, row_search))
+            else:
+                matched = entry.size
+            if matched:
+                found.append((entry, matched))
+        return found
+
+
+class MemoryUploadBackend:
+    """Загрузки в памяти процесса (LRU по времени последнего обращения)"""
+
+    def __init__(self, ttl: float, max_sessions: int = 100):
+        self.ttl = ttl
+        self.max_sessions = max(1, max_sessions)
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Сессия с отметкой обращения (вызывается под self._lock)"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        now = time.time()
+        if now - session["updated_at"] > self.ttl:
+            del self._sessions[session_id]
+            return None
+        session["updated_at"] = now
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def create(self, session_id: str, header: Dict[str, Any], container_info: Dict[str, dict],
+               containers: Dict[str, List[dict]]) -> None:
+        with self._lock:
+            self._sessions[session_id] = {
+                "header": header,
+                "container_info": container_info,
+                "containers": containers,
+                "updated_at": time.time(),
+            }
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            session = self._session(session_id)
+            if session is None:
+                return None
+            return {
+                "header": session["header"],
+                "container_info": session["container_info"],
+                "keys": list(session["containers"]),
+            }
+
+    def rows(self, session_id: str, container: str) -> Optional[List[dict]]:
+        with self._lock:
+            session = self._session(session_id)
+            if session is None:
+                return None
+            return session["containers"].get(container)
+
+    def update_rows(self, session_id: str, container: str, values: Dict[str, Any],
+                    index: Optional[int] = None) -> Optional[List[dict]]:
+        with self._lock:
+            session = self._session(session_id)
+            if session is None or container not in session["containers"]:
+                return None
+            rows = session["containers"][container]
+            targets = rows if index is None else [rows[index]]
+            for row in targets:
+                row.update(values)
+            return targets
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def cleanup(self) -> None:
+        now = time.time()
+        with self._lock:
+            for session_id in [sid for sid, s in self._sessions.items() if now - s["updated_at"] > self.ttl]:
+                del self._sessions[session_id]
+
+
+class DiskUploadBackend:
+    """Загрузки на диске: meta.json и по файлу на контейнер (правка переписывает один контейнер)"""
+
+    META_FILE = "meta.json"
+
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, session_id: str, name: str = "") -> str:
+        return os.path.join(self.directory, session_id, name)
+
+    @staticmethod
+    def _write_json(path: str, data: Any) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def _read_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        meta_path = self._path(session_id, self.META_FILE)
+        try:
+            if time.time() - os.path.getmtime(meta_path) > self.ttl:
+                self.delete(session_id)
+                return None
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            os.utime(meta_path)
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    def _container_path(self, session_id: str, meta: Dict[str, Any], container: str) -> Optional[str]:
+        try:
+            position = meta["keys"].index(container)
+        except ValueError:
+            return None
+        # Номер контейнера может содержать что угодно - файл называется по позиции
+        return self._path(session_id, f"{position}.json")
+
+    def create(self, session_id: str, header: Dict[str, Any], container_info: Dict[str, dict],
+               containers: Dict[str, List[dict]]) -> None:
+        os.makedirs(self._path(session_id))
+        for position, rows in enumerate(containers.values()):
+            self._write_json(self._path(session_id, f"{position}.json"), rows)
+        self._write_json(self._path(session_id, self.META_FILE), {
+            "header": header,
+            "container_info": container_info,
+            "keys": list(containers),
+        })
+
+    def meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self._read_meta(session_id)
+
+    def rows(self, session_id: str, container: str) -> Optional[List[dict]]:
+        meta = self._read_meta(session_id)
+        path = meta and self._container_path(session_id, meta, container)
+        if not path:
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def update_rows(self, session_id: str, container: str, values: Dict[str, Any],
+                    index: Optional[int] = None) -> Optional[List[dict]]:
+        meta = self._read_meta(session_id)
+        path = meta and self._container_path(session_id, meta, container)
+        if not path:
+            return None
+        with self._lock:
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)
+            targets = rows if index is None else [rows[index]]
+            for row in targets:
+                row.update(values)
+            self._write_json(path, rows)
+        return targets
+
+    def delete(self, session_id: str) -> None:
+        shutil.rmtree(self._path(session_id), ignore_errors=True)
+
+    def cleanup(self) -> None:
+        try:
+            session_ids = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for session_id in session_ids:
+            meta_path = self._path(session_id, self.META_FILE)
+            try:
+                path = meta_path if os.path.exists(meta_path) else self._path(session_id)
+                if time.time() - os.path.getmtime(path) > self.ttl:
+                    self.delete(session_id)
+            except OSError:
+                continue
+
+
+class SQLiteUploadBackend:
+    """Загрузки в SQLite: правка строки - UPDATE одной записи"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            meta TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS upload_rows (
+            session_id TEXT NOT NULL,
+            container TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (session_id, container, idx)
+        );
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def _touch(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Шапка сессии с отметкой обращения (вызывается под self._lock)"""
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT meta, updated_at FROM upload_sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.ttl:
+            self._delete(session_id)
+            return None
+        self._conn.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (now, session_id))
+        return json.loads(row[0])
+
+    def _delete(self, session_id: str) -> None:
+        self._conn.execute("BEGIN")
+        self._conn.execute("DELETE FROM upload_rows WHERE session_id = ?", (session_id,))
+        self._conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+        self._conn.execute("COMMIT")
+
+    def create(self, session_id: str, header: Dict[str, Any], container_info: Dict[str, dict],
+               containers: Dict[str, List[dict]]) -> None:
+        meta = {"header": header, "container_info": container_info, "keys": list(containers)}
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO upload_rows (session_id, container, idx, data) VALUES (?, ?, ?, ?)",
+                    (
+                        (session_id, container, index, json.dumps(row, ensure_ascii=False))
+                        for container, rows in containers.items()
+                        for index, row in enumerate(rows)
+                    ),
+                )
+                self._conn.execute(
+                    "INSERT INTO upload_sessions (id, meta, updated_at) VALUES (?, ?, ?)",
+                    (session_id, json.dumps(meta, ensure_ascii=False), time.time()),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._touch(session_id)
+
+    def rows(self, session_id: str, container: str) -> Optional[List[dict]]:
+        with self._lock:
+            meta = self._touch(session_id)
+            if meta is None or container not in meta["keys"]:
+                return None
+            cursor = self._conn.execute(
+                "SELECT data FROM upload_rows WHERE session_id = ? AND container = ? ORDER BY idx",
+                (session_id, container),
+            )
+            return [json.loads(data) for (data,) in cursor]
+
+    def update_rows(self, session_id: str, container: str, values: Dict[str, Any],
+                    index: Optional[int] = None) -> Optional[List[dict]]:
+        with self._lock:
+            meta = self._touch(session_id)
+            if meta is None or container not in meta["keys"]:
+                return None
+            query = "SELECT idx, data FROM upload_rows WHERE session_id = ? AND container = ?"
+            params = (session_id, container)
+            if index is not None:
+                query += " AND idx = ?"
+                params += (index,)
+            records = self._conn.execute(query + " ORDER BY idx", params).fetchall()
+            if index is not None and not records:
+                raise IndexError(index)
+            targets = []
+            self._conn.execute("BEGIN")
+            for idx, data in records:
+                row = json.loads(data)
+                row.update(values)
+                targets.append(row)
+                self._conn.execute(
+                    "UPDATE upload_rows SET data = ? WHERE session_id = ? AND container = ? AND idx = ?",
+                    (json.dumps(row, ensure_ascii=False), session_id, container, idx),
+                )
+            self._conn.execute("COMMIT")
+            return targets
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._delete(session_id)
+
+    def cleanup(self) -> None:
+        with self._lock:
+            expired = [sid for (sid,) in self._conn.execute(
+                "SELECT id FROM upload_sessions WHERE updated_at < ?", (time.time() - self.ttl,)
+            )]
+            for session_id in expired:
+                self._delete(session_id)
+
+
+class UploadSessionStore:
+    """Загрузки по id поверх выбранного хранилища"""
+
+    def __init__(self, backend, max_indexes: int = 100):
+        self.backend = backend
+        self.max_indexes = max(1, max_indexes)
+        self._indexes: "OrderedDict[str, UploadIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional["UploadSessionStore"]:
+        """Хранилище по переменным окружения (None, если выключено)"""
+        kind = os.getenv("UPLOAD_SESSION_BACKEND", "memory").strip().lower()
+        ttl = float(os.getenv("UPLOAD_SESSION_TTL", "43200"))
+        directory = os.getenv("UPLOAD_SESSION_DIR") or os.path.join(tempfile.gettempdir(), "mappingdata_uploads")
+        max_sessions = int(os.getenv("UPLOAD_SESSION_MAX", "100"))
+        if kind in ("off", "0", "none", ""):
+            return None
+        if kind == "memory":
+            return cls(MemoryUploadBackend(ttl, max_sessions), max_sessions)
+        if kind == "disk":
+            return cls(DiskUploadBackend(directory, ttl), max_sessions)
+        if kind == "sqlite":
+            return cls(SQLiteUploadBackend(os.path.join(directory, "uploads.sqlite3"), ttl), max_sessions)
+        raise ValueError(f"Неизвестное хранилище загрузок: {kind}")
+
+    def create(self, data: Dict[str, Any]) -> str:
+        """Сохраняет данные /upload (формат ответа data) и возвращает id загрузки"""
+        self.backend.cleanup()
+        session_id = uuid.uuid4().hex
+        header = {key: value for key, value in data.items() if key not in (CONTAINERS_KEY, CONTAINER_INFO_KEY)}
+        containers = {container: rows for container, rows in (data.get(CONTAINERS_KEY) or {}).items()}
+        self.backend.create(session_id, header, data.get(CONTAINER_INFO_KEY) or {}, containers)
+        self._put_index(session_id, UploadIndex(containers))
+        return session_id
+
+    def _put_index(self, session_id: str, index: UploadIndex) -> None:
+        with self._lock:
+            self._indexes[session_id] = index
+            self._indexes.move_to_end(session_id)
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+
+    def _index(self, session_id: str) -> Optional[Tuple[Dict[str, Any], UploadIndex]]:
+        """Шапка загрузки и ее индекс (индекс строится заново, если его нет в памяти)"""
+        if not _valid_id(session_id):
+            return None
+        meta = self.backend.meta(session_id)
+        if meta is None:
+            with self._lock:
+                self._indexes.pop(session_id, None)
+            return None
+        with self._lock:
+            index = self._indexes.get(session_id)
+            if index is not None:
+                self._indexes.move_to_end(session_id)
+        if index is None:
+            data = self.get(session_id)
+            if data is None:
+                return None
+            index = UploadIndex(data[CONTAINERS_KEY])
+            self._put_index(session_id, index)
+        return meta, index
+
+    def _refresh_index(self, session_id: str, container: str, values: Dict[str, Any]) -> None:
+        """После правки колонок, участвующих в поиске или итогах, перестраивает запись контейнера"""
+        if not INDEXED_KEYS.intersection(values):
+            return
+        with self._lock:
+            index = self._indexes.get(session_id)
+        if index is not None:
+            rows = self.backend.rows(session_id, container)
+            if rows is not None:
+                index.refresh(container, rows)
+
+    def list_containers(self, session_id: str, page: int = 1, page_size: int = 20, container: str = "",
+                        code: str = "", description: str = "", search: str = "") -> Optional[Dict[str, Any]]:
+        """
+        Страница контейнеров с фильтрами (None, если загрузка не найдена).
+
+        Args:
+            container: часть номера контейнера
+            code: начало кода ТН ВЭД хотя бы одной строки
+            description: часть описания товара хотя бы одной строки
+            search: любое из трех
+        """
+        found = self._index(session_id)
+        if found is None:
+            return None
+        meta, index = found
+        matched = index.search(container, code, description, search)
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        start = (max(1, page) - 1) * page_size
+        return {
+            "total": len(matched),
+            "page": max(1, page),
+            "page_size": page_size,
+            "pages": (len(matched) + page_size - 1) // page_size,
+            "containers": [
+                {
+                    "container": entry.container,
+                    "rows": entry.size,
+                    "matched_rows": matched_rows,
+                    "totals": entry.totals,
+                    "info": meta["container_info"].get(entry.container, {}),
+                }
+                for entry, matched_rows in matched[start:start + page_size]
+            ],
+        }
+
+    def list_rows(self, session_id: str, container: str, offset: int = 0, limit: int = 100, code: str = "",
+                  description: str = "", search: str = "") -> Optional[Dict[str, Any]]:
+        """Строки контейнера с фильтрами; index - номер строки для PATCH (None, если не найдены)"""
+        found = self._index(session_id)
+        if found is None:
+            return None
+        entry = found[1].get(container)
+        if entry is None:
+            return None
+        matched = entry.match(_search_text(code), _search_text(description), _search_text(search))
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        offset = max(0, offset)
+        selected = matched[offset:offset + limit]
+        rows = self.backend.rows(session_id, container) if selected else []
+        if rows is None:
+            return None
+        return {
+            "container": container,
+            "total": len(matched),
+            "offset": offset,
+            "limit": limit,
+            "rows": [{"index": index, "row": rows[index]} for index in selected],
+        }
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Данные загрузки в формате ответа /upload (None, если не найдена или истекла)"""
+        if not _valid_id(session_id):
+            return None
+        meta = self.backend.meta(session_id)
+        if meta is None:
+            return None
+        containers = {}
+        for container in meta["keys"]:
+            rows = self.backend.rows(session_id, container)
+            if rows is None:
+                # Сессия истекла между запросами
+                return None
+            containers[container] = rows
+        return {**meta["header"], CONTAINERS_KEY: containers, CONTAINER_INFO_KEY: meta["container_info"]}
+
+    def update_row(self, session_id: str, container: str, index: int, values: Dict[str, Any]) -> Optional[dict]:
+        """Меняет значения одной строки; возвращает строку после правки (None - загрузка/контейнер не найдены)"""
+        _check_values(values)
+        if not _valid_id(session_id):
+            return None
+        if index < 0:
+            raise UploadSessionError(f"Строка {index} не найдена в контейнере {container}")
+        try:
+            updated = self.backend.update_rows(session_id, container, values, index)
+        except IndexError:
+            raise UploadSessionError(f"Строка {index} не найдена в контейнере {container}")
+        if not updated:
+            return None
+        self._refresh_index(session_id, container, values)
+        return updated[0]
+
+    def update_container(self, session_id: str, container: str, values: Dict[str, Any]) -> Optional[int]:
+        """Меняет значения во всех строках контейнера; возвращает количество строк"""
+        _check_values(values)
+        if not _valid_id(session_id):
+            return None
+        updated = self.backend.update_rows(session_id, container, values)
+        if updated is None:
+            return None
+        self._refresh_index(session_id, container, values)
+        return len(updated)
+
+    def delete(self, session_id: str) -> None:
+        if _valid_id(session_id):
+            self.backend.delete(session_id)
+            with self._lock:
+                self._indexes.pop(session_id, None)
+
+
+# Глобальное хранилище загрузок
+upload_sessions = None
+_initialized = False
+
+
+def get_upload_sessions() -> Optional[UploadSessionStore]:
+    """Хранилище загрузок (None, если UPLOAD_SESSION_BACKEND=off)"""
+    global upload_sessions, _initialized
+    if not _initialized:
+        upload_sessions = UploadSessionStore.from_env()
+        _initialized = True
+    return upload_sessions
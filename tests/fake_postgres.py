@@ -0,0 +1,286 @@
+"""
+Подделка PostgreSQL для тестов src/database.py.
+
+Понимает только запросы, которые выполняет сохранение заказа: upsert клиента
+и заказа (в том числе CTE), вставку инвойсов и товаров через execute_values
+и COPY, выборку и удаление сохраненных инвойсов, EXPLAIN-проверки схемы.
+Значения execute_values не разбираются из SQL: mogrify возвращает метку,
+по которой execute находит исходный шаблон и параметры.
+"""
+import copy
+import csv
+import io
+import itertools
+import re
+
+import psycopg2
+
+_TOKEN = re.compile(rb"\x01(\d+)\x02")
+
+
+class FakePostgres:
+    """
+    Состояние "сервера": таблицы clients, orders, invoices, invoice_items.
+
+    unique_indexes - есть ли уникальные индексы для ON CONFLICT,
+    content_hash - есть ли колонка invoices.content_hash.
+    """
+
+    def __init__(self, unique_indexes: bool = True, content_hash: bool = True):
+        self.unique_indexes = unique_indexes
+        self.content_hash = content_hash
+        self.tables = {"clients": {}, "orders": {}, "invoices": {}, "invoice_items": []}
+        self._ids = itertools.count(1)
+        self.statements = []  # тексты выполненных запросов (без параметров)
+        self.fail_on = None  # подстрока запроса, на котором "сервер" вернет ошибку
+        self.returning = None  # функция, меняющая строки RETURNING инвойсов
+        self.connections = []
+
+    # --- psycopg2.pool.ThreadedConnectionPool ---
+
+    def pool(self, minconn, maxconn, *args, **kwargs):
+        return _FakePool(self)
+
+    def connect(self):
+        conn = FakeConnection(self)
+        self.connections.append(conn)
+        return conn
+
+    # --- выборки для проверок ---
+
+    @property
+    def invoices(self):
+        return self.tables["invoices"]
+
+    @property
+    def items(self):
+        return self.tables["invoice_items"]
+
+    def items_of(self, invoice_id):
+        return [item[1:] for item in self.items if item[0] == invoice_id]
+
+    # --- выполнение запросов ---
+
+    def execute(self, cursor, sql, args):
+        rows = []  # строки VALUES из execute_values
+        prefix = []  # параметры запроса, подставленного через mogrify целиком (CTE)
+
+        def expand(match):
+            template, params = cursor.connection.params[int(match.group(1))]
+            if template.lstrip().startswith(b"("):
+                rows.append(params)
+                return b"?"
+            prefix.append(params)
+            return template
+
+        if isinstance(sql, bytes):
+            sql = _TOKEN.sub(expand, sql).decode("utf-8")
+        text = sql.strip()
+        self.statements.append(text)
+        if self.fail_on and self.fail_on in text:
+            raise psycopg2.OperationalError(f"server error on: {self.fail_on}")
+
+        if text.startswith("EXPLAIN "):
+            self._check_schema(text)
+            return []
+        if text.startswith("SELECT 1"):
+            return [(1,)]
+        if text.startswith("SET LOCAL"):
+            return []
+        cursor.connection.begin()
+        if "client_order AS" in text:
+            return self._save_order_with_invoices(text, prefix[0], rows)
+        if text.startswith("SELECT i.id, i.container"):
+            return self._existing_invoices(*args)
+        if text.startswith("DELETE FROM invoice_items"):
+            ids = set(args[0])
+            self.tables["invoice_items"] = [item for item in self.items if item[0] not in ids]
+            for invoice_id in ids:
+                self.invoices.pop(invoice_id, None)
+            return []
+        if text.startswith("INSERT INTO clients"):
+            return [(self._client(args[0], upsert="ON CONFLICT" in text),)]
+        if text.startswith("INSERT INTO orders"):
+            return [(self._order(args[0], args[1], upsert="ON CONFLICT" in text),)]
+        if text.startswith("SELECT id FROM clients"):
+            return [(client_id,) for client_id, name in self.tables["clients"].items() if name == args[0]][:1]
+        if text.startswith("SELECT id FROM orders"):
+            return [(order_id,) for order_id, key in self.tables["orders"].items() if key == tuple(args)][:1]
+        if text.startswith("INSERT INTO invoices"):
+            columns = _columns(text.split("(", 1)[1].split(")", 1)[0])
+            inserted = [self._invoice(dict(zip(columns, row))) for row in rows]
+            return self._returning([(invoice_id, invoice["container"], invoice["invoice_number"])
+                                    for invoice_id, invoice in inserted])
+        if text.startswith("INSERT INTO invoice_items"):
+            self.items.extend(tuple(row) for row in rows)
+            return []
+        raise NotImplementedError(text)
+
+    def copy(self, connection, sql, stream):
+        self.statements.append(sql)
+        connection.begin()
+        if self.fail_on and self.fail_on in sql:
+            raise psycopg2.OperationalError(f"server error on: {self.fail_on}")
+        assert sql.lstrip().startswith("COPY invoice_items")
+        for row in csv.reader(io.StringIO(stream.read())):
+            self.items.append(_copied_item(row))
+
+    def _check_schema(self, text):
+        if "ON CONFLICT" in text and not self.unique_indexes:
+            raise psycopg2.ProgrammingError(
+                "there is no unique or exclusion constraint matching the ON CONFLICT specification")
+        if "content_hash" in text and not self.content_hash:
+            raise psycopg2.ProgrammingError("column i.content_hash does not exist")
+
+    def _client(self, name, upsert):
+        self._check_schema("ON CONFLICT" if upsert else "")
+        clients = self.tables["clients"]
+        if upsert:
+            for client_id, client_name in clients.items():
+                if client_name == name:
+                    return client_id
+        client_id = next(self._ids)
+        clients[client_id] = name
+        return client_id
+
+    def _order(self, client_id, order_number, upsert):
+        self._check_schema("ON CONFLICT" if upsert else "")
+        orders = self.tables["orders"]
+        if upsert:
+            for order_id, key in orders.items():
+                if key == (client_id, order_number):
+                    return order_id
+        order_id = next(self._ids)
+        orders[order_id] = (client_id, order_number)
+        return order_id
+
+    def _invoice(self, values):
+        if "content_hash" in values:
+            self._check_schema("content_hash")
+        invoice_id = next(self._ids)
+        values.setdefault("content_hash", None)
+        self.invoices[invoice_id] = values
+        return invoice_id, values
+
+    def _returning(self, rows):
+        return self.returning(rows) if self.returning else rows
+
+    def _save_order_with_invoices(self, text, order, rows):
+        client_name, order_number = order
+        order_id = self._order(self._client(client_name, upsert=True), order_number, upsert=True)
+        columns = _columns(text.rsplit("AS v (", 1)[1].split(")", 1)[0])
+        returned = []
+        for row in rows:
+            invoice_id, invoice = self._invoice(dict(zip(columns, row), order_id=order_id))
+            returned.append((invoice_id, invoice["container"], invoice["invoice_number"], order_id))
+        return self._returning(returned)
+
+    def _existing_invoices(self, client_name, order_number):
+        self._check_schema("content_hash")
+        order_ids = {
+            order_id for order_id, (client_id, number) in self.tables["orders"].items()
+            if number == order_number and self.tables["clients"].get(client_id) == client_name
+        }
+        return [
+            (invoice_id, invoice["container"], invoice["invoice_number"], invoice["content_hash"])
+            for invoice_id, invoice in self.invoices.items()
+            if invoice["order_id"] in order_ids and invoice["content_hash"] is not None
+        ]
+
+
+def _columns(text):
+    return [column.strip() for column in text.split(",")]
+
+
+def _copied_item(row):
+    # CSV COPY приходит строками, булевы значения - "True"/"False"
+    invoice_id, code, goods_name, restriction_flag, package_info, places, \
+        package_info_type, package_type, package_count, weight, currency, value_amount = row
+    return (int(invoice_id), code, goods_name, restriction_flag == "True", package_info == "True",
+            int(places), int(package_info_type), package_type, int(package_count),
+            float(weight), currency, float(value_amount))
+
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, server: FakePostgres):
+        self.server = server
+        self.closed = 0
+        self.autocommit = True
+        self.params = []
+        self._snapshot = None  # состояние таблиц на начало транзакции
+
+    def begin(self):
+        # Последовательности id, как и в PostgreSQL, при откате не возвращаются
+        if self._snapshot is None:
+            self._snapshot = copy.deepcopy(self.server.tables)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self._snapshot = None
+        self.params.clear()
+
+    def rollback(self):
+        if self._snapshot is not None:
+            self.server.tables = self._snapshot
+        self._snapshot = None
+        self.params.clear()
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCursor:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def mogrify(self, sql, args=None):
+        template = sql if isinstance(sql, bytes) else sql.encode("utf-8")
+        self.connection.params.append((template, tuple(args)))
+        return b"\x01%d\x02" % (len(self.connection.params) - 1)
+
+    def execute(self, sql, args=None):
+        self._rows = list(self.connection.server.execute(self, sql, args))
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def copy_expert(self, sql, stream, size=8192):
+        self.connection.server.copy(self.connection, sql, stream)
+
+
+class _FakePool:
+    def __init__(self, server: FakePostgres):
+        self.server = server
+        self._free = []
+
+    def getconn(self):
+        return self._free.pop() if self._free else self.server.connect()
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+        else:
+            self._free.append(conn)
+
+    def closeall(self):
+        for conn in self._free:
+            conn.close()
+        self._free.clear()
@@ -0,0 +1,64 @@
+"""Кэш результатов: копии значений, дисковый уровень, поврежденные записи."""
+from src import cache
+from src.cache import ResultCache, make_key
+
+
+def test_get_returns_independent_copy():
+    result_cache = ResultCache(max_bytes=1024 * 1024)
+    result_cache.put("key", {"items": [1, 2]})
+
+    value = result_cache.get("key")
+    value["items"].append(3)
+
+    assert result_cache.get("key") == {"items": [1, 2]}
+    assert result_cache.get("other") is None
+    assert result_cache.stats()["hits"] == 2
+    assert result_cache.stats()["misses"] == 1
+
+
+def test_disk_tier_survives_memory_clear(tmp_path):
+    result_cache = ResultCache(max_bytes=1024 * 1024, disk_dir=str(tmp_path))
+    result_cache.put("key", [1, 2, 3])
+    result_cache.clear()
+
+    assert result_cache.get("key") == [1, 2, 3]
+    assert result_cache.stats()["disk_hits"] == 1
+
+
+def test_corrupted_disk_entry_is_a_miss_and_removed(tmp_path):
+    result_cache = ResultCache(max_bytes=1024 * 1024, disk_dir=str(tmp_path))
+    path = tmp_path / "key.pkl"
+    path.write_bytes(b"not a pickle")
+
+    assert result_cache.get("key") is None
+    assert not path.exists()
+    assert result_cache.stats()["entries"] == 0
+    assert result_cache.stats()["bytes"] == 0
+    assert result_cache.stats()["misses"] == 1
+    assert result_cache.stats()["disk_hits"] == 0
+
+
+def test_truncated_memory_entry_is_a_miss():
+    result_cache = ResultCache(max_bytes=1024 * 1024)
+    result_cache.put("key", list(range(100)))
+    result_cache._entries["key"] = result_cache._entries["key"][:10]
+
+    assert result_cache.get("key") is None
+    assert "key" not in result_cache._entries
+    assert result_cache.stats()["hits"] == 0 and result_cache.stats()["misses"] == 1
+
+
+def test_key_depends_on_version(monkeypatch):
+    key = make_key("process_unified", "abc", None)
+    assert key == make_key("process_unified", "abc", None)
+    assert key != make_key("process_unified", "abc", "C1")
+
+    monkeypatch.setattr(cache, "CACHE_VERSION", cache.CACHE_VERSION + 1)
+    assert make_key("process_unified", "abc", None) != key
+
+
+def test_disabled_cache_stores_nothing():
+    result_cache = ResultCache(max_bytes=0)
+    result_cache.put("key", 1)
+
+    assert result_cache.get("key") is None
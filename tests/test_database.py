@@ -0,0 +1,201 @@
+"""Сохранение заказа в БД (src/database.py) на подделке PostgreSQL из fake_postgres.py."""
+import psycopg2.pool
+import pytest
+
+from fake_postgres import FakePostgres
+from src import database
+from src.database import map_invoice_ids, save_data_to_db
+
+
+@pytest.fixture
+def make_server(monkeypatch):
+    """Запускает пул соединений на подделке БД (upsert и отпечатки - в режиме auto)"""
+    def make(**options):
+        server = FakePostgres(**options)
+        monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", server.pool)
+        monkeypatch.setenv("DATABASE_URL", "postgresql://fake/mappingdata")
+        monkeypatch.setattr(database, "UPSERT_MODE", "auto")
+        monkeypatch.setattr(database, "FINGERPRINT_MODE", "auto")
+        monkeypatch.setattr(database, "upsert_supported", False)
+        monkeypatch.setattr(database, "fingerprint_supported", False)
+        database.init_db_pool()
+        return server
+
+    yield make
+    database.close_db_pool()
+
+
+def item(code, weight=1.5, amount=10.0):
+    return {
+        "code": code, "goods_name": f"Товар {code}", "restriction_flag": 1, "package_info": 1,
+        "places": 2, "package_info_type": 0, "package_type": "CT", "package_count": 2,
+        "weight": weight, "currency": "USD", "value_amount": amount,
+    }
+
+
+def container(number, invoice, *codes):
+    return {
+        "container": number, "consignor": "Отправитель", "consignee": "Получатель",
+        "sender_address": "Адрес отправителя", "recipient_address": "Адрес получателя",
+        "invoice_number": invoice, "invoice_date": "02.01.2024",
+        "items": [item(code) for code in codes],
+    }
+
+
+def saved(server):
+    """Инвойсы с кодами их товаров: [(контейнер, номер инвойса, [коды])] по порядку вставки"""
+    return [
+        (invoice["container"], invoice["invoice_number"], [values[0] for values in server.items_of(invoice_id)])
+        for invoice_id, invoice in server.invoices.items()
+    ]
+
+
+# Два инвойса с одинаковыми (контейнер, номер) - разные версии одного инвойса в заказе
+ORDER = [
+    container("CONT0000001", "INV-1", "a", "b"),
+    container("CONT0000001", "INV-1", "c"),
+    container("CONT0000002", "INV-2", "d"),
+]
+
+
+def test_single_statement_save_keeps_duplicate_keys(make_server):
+    server = make_server()
+    assert database.upsert_supported and database.fingerprint_supported
+
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert result["success"] and result["containers_written"] == 3 and result["items_skipped"] == 0
+    assert saved(server) == [
+        ("CONT0000001", "INV-1", ["a", "b"]),
+        ("CONT0000001", "INV-1", ["c"]),
+        ("CONT0000002", "INV-2", ["d"]),
+    ]
+    assert any("client_order AS" in statement for statement in server.statements)
+    assert len(server.tables["clients"]) == 1 and len(server.tables["orders"]) == 1
+    assert all(invoice["content_hash"] for invoice in server.invoices.values())
+
+
+def test_resave_of_unchanged_order_writes_nothing(make_server):
+    server = make_server()
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+    before = saved(server)
+
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert result["success"] and result["unchanged"]
+    assert result["containers_written"] == 0 and result["containers_removed"] == 0
+    assert saved(server) == before
+
+
+def test_changed_duplicate_replaces_only_its_version(make_server):
+    server = make_server()
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+    changed = [ORDER[0], container("CONT0000001", "INV-1", "e"), ORDER[2]]
+
+    result = save_data_to_db(changed, "Клиент", "ORDER-1")
+
+    assert result["containers_written"] == 1 and result["containers_removed"] == 1
+    assert sorted(saved(server)) == [
+        ("CONT0000001", "INV-1", ["a", "b"]),
+        ("CONT0000001", "INV-1", ["e"]),
+        ("CONT0000002", "INV-2", ["d"]),
+    ]
+
+
+def test_other_order_is_not_touched(make_server):
+    server = make_server()
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-2")
+
+    assert result["containers_written"] == 3
+    assert len(server.invoices) == 6 and len(server.tables["orders"]) == 2
+
+
+def test_returning_out_of_order_is_mapped_by_key(make_server):
+    server = make_server()
+    server.returning = lambda rows: rows[::-1]
+    order = [container("CONT0000001", "INV-1", "a"), container("CONT0000002", "INV-2", "b", "c")]
+
+    result = save_data_to_db(order, "Клиент", "ORDER-1")
+
+    assert result["items_skipped"] == 0
+    assert saved(server) == [("CONT0000001", "INV-1", ["a"]), ("CONT0000002", "INV-2", ["b", "c"])]
+
+
+def test_items_without_invoice_id_are_skipped(make_server):
+    server = make_server()
+    server.returning = lambda rows: rows[:-1]
+
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert result["success"] and result["items_skipped"] == 1
+    assert [codes for _, _, codes in saved(server)] == [["a", "b"], ["c"], []]
+
+
+def test_fallback_without_unique_indexes_and_content_hash(make_server):
+    server = make_server(unique_indexes=False, content_hash=False)
+    assert not database.upsert_supported and not database.fingerprint_supported
+
+    first = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+    second = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    # SELECT + INSERT: клиент и заказ переиспользуются, без отпечатков инвойсы пишутся повторно
+    assert first["success"] and second["success"] and not second["unchanged"]
+    assert len(server.tables["clients"]) == 1 and len(server.tables["orders"]) == 1
+    assert [codes for _, _, codes in saved(server)] == [["a", "b"], ["c"], ["d"]] * 2
+    assert not any("client_order AS" in statement or "ON CONFLICT" in statement
+                   for statement in server.statements if not statement.startswith("EXPLAIN"))
+    assert not any(statement.startswith("INSERT INTO invoices") and "content_hash" in statement
+                   for statement in server.statements)
+
+
+def test_upsert_without_content_hash(make_server):
+    server = make_server(content_hash=False)
+    assert database.upsert_supported and not database.fingerprint_supported
+
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert result["containers_written"] == 3 and not result["unchanged"]
+    assert len(server.invoices) == 6 and len(server.tables["orders"]) == 1
+    assert any("client_order AS" in statement for statement in server.statements)
+
+
+def test_copy_path_stores_the_same_items(make_server, monkeypatch):
+    by_values = make_server()
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+    database.close_db_pool()
+
+    monkeypatch.setattr(database, "COPY_THRESHOLD", 1)
+    by_copy = make_server()
+    save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert any(statement.lstrip().startswith("COPY") for statement in by_copy.statements)
+    assert sorted(by_copy.items) == sorted(by_values.items)
+
+
+def test_failed_save_is_rolled_back(make_server):
+    server = make_server()
+    server.fail_on = "INSERT INTO invoice_items"
+
+    result = save_data_to_db(ORDER, "Клиент", "ORDER-1")
+
+    assert not result["success"]
+    assert not server.invoices and not server.tables["clients"] and not server.tables["orders"]
+
+    server.fail_on = None
+    assert save_data_to_db(ORDER, "Клиент", "ORDER-1")["containers_written"] == 3
+
+
+def test_map_invoice_ids():
+    batch = [
+        {"container": "C1", "invoice_number": "I1"},
+        {"container": "C1", "invoice_number": "I1"},
+        {"container": "C2", "invoice_number": "I2"},
+    ]
+
+    assert map_invoice_ids(batch, [(1, "C1", "I1"), (2, "C1", "I1"), (3, "C2", "I2")]) == [1, 2, 3]
+    # Другой порядок - ID одинаковых ключей раздаются в порядке строк RETURNING
+    assert map_invoice_ids(batch, [(3, "C2", "I2"), (2, "C1", "I1"), (1, "C1", "I1")]) == [2, 1, 3]
+    assert map_invoice_ids(batch, [(1, "C1", "I1"), (3, "C2", "I2")]) == [1, None, 3]
@@ -0,0 +1,151 @@
+"""Разбор декларации: потоковый (iterparse) и через полное дерево дают одинаковый результат."""
+import io
+import random
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from benchmarks.generators import make_declaration_xml
+from src.compare import unified_compare
+from src.compare.unified_compare import _collect_stream, _collect_tree, parse_declaration
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>'
+          '<ns3:Decl xmlns:ns2="urn:x:common" xmlns:ns3="urn:x:transit" xmlns:ns4="urn:x:other">')
+
+
+def document(rnd):
+    parts = ["<ns3:TDPresentedDocDetails>"]
+    if rnd.random() < 0.8:
+        parts.append(f"<ns2:DocKindCode>{rnd.choice(['09034', '04021', '04131', '02013', ''])}</ns2:DocKindCode>")
+    if rnd.random() < 0.7:
+        parts.append(f"<ns2:DocName>{rnd.choice(['ИНВОЙС', '', 'CMR'])}</ns2:DocName>")
+    parts.append(f"<ns2:DocId>{rnd.choice(['INV1', '00077', '77', '12345'])}</ns2:DocId>")
+    parts.append(f"<ns2:DocCreationDate>{rnd.choice(['2024-01-15', '15.01.2024', '2011-05-31'])}</ns2:DocCreationDate>")
+    parts.append("</ns3:TDPresentedDocDetails>")
+    return "".join(parts)
+
+
+def goods_item(rnd, ordinal, containers, depth=0):
+    tag = rnd.choice(["ns3:TransitGoodsItemDetails", "ns4:GoodsItemDetails"])
+    parts = [
+        f"<{tag}><ns2:ConsignmentItemOrdinal>{ordinal}</ns2:ConsignmentItemOrdinal>",
+        f"<ns2:CommodityCode>{rnd.choice(['8471300000', '84713000', 'abc', ''])}</ns2:CommodityCode>",
+        f"<ns2:GoodsDescriptionText>{rnd.choice(['Widget', '  ', 'ноутбук'])}</ns2:GoodsDescriptionText>",
+        f"<ns2:UnifiedGrossMassMeasure>{rnd.choice(['12.5', '100', '0.001', ''])}</ns2:UnifiedGrossMassMeasure>",
+        "<ns3:CargoPackagePalletDetails>"
+        f"<ns2:CargoQuantity>{rnd.choice(['3', '7', ''])}</ns2:CargoQuantity>"
+        f"<ns3:PackagePalletDetails><ns2:PackageKindCode>{rnd.choice(['CT', 'PK', ''])}</ns2:PackageKindCode>"
+        "</ns3:PackagePalletDetails></ns3:CargoPackagePalletDetails>",
+    ]
+    if rnd.random() < 0.9:
+        parts.append(f"<ns3:TransportEquipment><ns2:ContainerId>{rnd.choice(containers + [''])}</ns2:ContainerId>"
+                     "<ns2:SomeContainerId>X</ns2:SomeContainerId></ns3:TransportEquipment>")
+    parts.append(f'<ns3:CAValueAmount currencyCode="{rnd.choice(["USD", "CNY"])}">'
+                 f'{rnd.choice(["100.5", "2000", ""])}</ns3:CAValueAmount>')
+    if rnd.random() < 0.3:
+        parts.append(document(rnd))
+    if depth < 2 and rnd.random() < 0.3:
+        # Вложенная товарная позиция закрывается раньше родителя
+        parts.append(goods_item(rnd, ordinal * 100, containers, depth + 1))
+    parts.append(f"</{tag}>")
+    return "".join(parts)
+
+
+def make_nested_xml(seed, goods=30):
+    rnd = random.Random(seed)
+    containers = [f"CONT{i:07d}" for i in range(3)]
+    out = [HEADER]
+    if rnd.random() < 0.8:
+        out.append(f"<ns3:TransportMeansRegId>{rnd.choice(['  ', containers[0]])}</ns3:TransportMeansRegId>")
+    out.append(f"<ns2:TransportMeansRegId>{containers[-1]}</ns2:TransportMeansRegId>")
+    for tag in ("ConsignorDetails", "ConsigneeDetails"):
+        for _ in range(rnd.choice([1, 2])):
+            out.append(f"<ns3:{tag}><ns2:SubjectName>{rnd.choice(['ООО Ромашка', ' ', 'ACME &amp; Co'])}</ns2:SubjectName>"
+                       "<ns2:SubjectAddressDetails><ns2:CountryCode>CN</ns2:CountryCode>"
+                       f"<ns2:CityName>{rnd.choice(['Urumqi', ''])}</ns2:CityName></ns2:SubjectAddressDetails></ns3:{tag}>")
+    out.append(f"<ns3:SealQuantity>{rnd.choice(['2', 'x', ''])}</ns3:SealQuantity>")
+    out.append("<ns3:Wrapper>")
+    out.extend(goods_item(rnd, ordinal, containers) for ordinal in range(1, goods + 1))
+    out.append("</ns3:Wrapper>")
+    out.extend(document(rnd) for _ in range(3))
+    out.append("</ns3:Decl>")
+    return "\n".join(out).encode("utf-8")
+
+
+def snapshot(result):
+    excel_data, documents, transport_means_reg_id = result
+    return repr((excel_data.model_dump(), documents, transport_means_reg_id))
+
+
+def assert_collectors_equal(content):
+    tree = _collect_tree(content).result()
+    stream = _collect_stream(io.BytesIO(content)).result()
+    assert snapshot(stream) == snapshot(tree)
+    return tree
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_nested_declarations(seed):
+    assert_collectors_equal(make_nested_xml(seed))
+
+
+def test_generated_declaration():
+    excel_data, documents, _ = assert_collectors_equal(make_declaration_xml(goods=300, documents=10, containers=3))
+    assert sum(len(records) for records in excel_data.containers.values()) == 300
+    assert documents
+
+
+@pytest.mark.parametrize("content", [
+    b"",
+    b"not xml at all",
+    HEADER.encode("utf-8"),  # корневой элемент не закрыт
+    make_nested_xml(1)[:-200],  # файл оборван
+    make_nested_xml(2).replace(b"</ns2:CommodityCode>", b"</ns2:Commodity>", 1),
+])
+def test_malformed_declarations(content):
+    with pytest.raises(ET.ParseError):
+        _collect_tree(content)
+    with pytest.raises(ET.ParseError):
+        _collect_stream(io.BytesIO(content))
+
+    streamed = parse_declaration(content, streaming=True)
+    assert snapshot(streamed) == snapshot(parse_declaration(content, streaming=False))
+    assert not streamed[0].containers
+
+
+def test_threshold_switches_to_streaming(monkeypatch, tmp_path):
+    content = make_declaration_xml(goods=2000, documents=20, containers=4, seed=3)
+    path = tmp_path / "declaration.xml"
+    path.write_bytes(content)
+    calls = []
+
+    def spy(collect):
+        def wrapper(source):
+            calls.append(collect.__name__)
+            return collect(source)
+        return wrapper
+
+    monkeypatch.setattr(unified_compare, "_collect_stream", spy(_collect_stream))
+    monkeypatch.setattr(unified_compare, "_collect_tree", spy(_collect_tree))
+    monkeypatch.setattr(unified_compare, "STREAMING_THRESHOLD_BYTES", len(content) - 1)
+
+    streamed = parse_declaration(str(path))
+    assert calls == ["_collect_stream"]
+
+    monkeypatch.setattr(unified_compare, "STREAMING_THRESHOLD_BYTES", len(content))
+    from_tree = parse_declaration(str(path))
+    assert calls == ["_collect_stream", "_collect_tree"]
+
+    assert snapshot(streamed) == snapshot(from_tree)
+    assert sum(len(records) for records in streamed[0].containers.values()) == 2000
+
+
+def test_tag_caches_are_bounded():
+    # Каждый namespace дает новые теги - кэши не растут сверх TAG_CACHE_SIZE
+    size = unified_compare.TAG_CACHE_SIZE
+    items = "".join(f'<GoodsItemDetails xmlns="urn:x:{n}"><CommodityCode>870810</CommodityCode></GoodsItemDetails>'
+                    for n in range(size + 10))
+    parse_declaration(f"<Decl>{items}</Decl>".encode("utf-8"))
+
+    for cached in (unified_compare._declaration_kinds, unified_compare._goods_fields):
+        assert cached.cache_info().currsize <= size
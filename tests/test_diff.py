@@ -0,0 +1,86 @@
+"""Режим расхождений (src/compare/diff.py): сопоставление по контейнерам и допуски."""
+from src.compare.diff import DiffTolerances, diff_containers
+
+
+def record(container, code, places, weight, amount, description="Запчасти"):
+    return {
+        "Номер контейнера": container, "Код ТН ВЭД": code, "Коммерческое описание товара": description,
+        "Количество грузовых мест": places, "Вес брутто": weight, "Сумма": amount,
+    }
+
+
+def pairs(diff):
+    return [(entry["type"], entry.get("declaration", {}).get("row"), entry.get("invoice", {}).get("row"))
+            for entry in diff["mismatches"]]
+
+
+def test_lines_are_matched_within_their_container():
+    declaration = {
+        "AAAU0000001": [record("AAAU0000001", "8708100000", 1, 10.0, 100.0)],
+        "BBBU0000002": [record("BBBU0000002", "8708100000", 2, 20.0, 200.0)],
+    }
+    # Строки поменялись контейнерами: по ключу они совпадают с чужим контейнером
+    invoice = {
+        "AAAU0000001": [record("AAAU0000001", "8708100000", 2, 20.0, 200.0)],
+        "BBBU0000002": [record("BBBU0000002", "8708100000", 1, 10.0, 100.0)],
+    }
+
+    diff = diff_containers(declaration, invoice, DiffTolerances())
+
+    assert diff["summary"]["matched"] == 0 and diff["summary"]["mismatched"] == 2
+    for entry in diff["mismatches"]:
+        assert entry["declaration"]["container"] == entry["invoice"]["container"]
+
+
+def test_declaration_is_scoped_to_invoice_containers():
+    declaration = {
+        "AAAU0000001": [record("AAAU0000001", "8708100000", 1, 10.0, 100.0)],
+        "BBBU0000002": [record("BBBU0000002", "8708100000", 2, 20.0, 200.0),
+                        record("BBBU0000002", "8708200000", 3, 30.0, 300.0)],
+    }
+    invoice = {"AAAU0000001": [record("AAAU0000001", "8708100000", 1, 10.0, 100.0)]}
+
+    diff = diff_containers(declaration, invoice, DiffTolerances())
+
+    assert diff["mismatches"] == []
+    assert diff["summary"]["declaration_lines"] == 1 and diff["summary"]["out_of_scope_lines"] == 2
+    assert list(diff["containers"]) == ["AAAU0000001"] and diff["totals"]["equal"]
+
+
+def test_without_invoice_every_declaration_line_is_missing():
+    declaration = {"AAAU0000001": [record("AAAU0000001", "8708100000", 1, 10.0, 100.0)]}
+
+    diff = diff_containers(declaration, {}, DiffTolerances())
+
+    assert pairs(diff) == [("missing_in_invoice", 0, None)]
+    assert diff["summary"]["out_of_scope_lines"] == 0
+
+
+def test_values_across_bucket_boundary_match_within_tolerance():
+    container = "AAAU0000001"
+    declaration = {container: [
+        record(container, "8708100000", 1, 0.99999, 10.0),
+        record(container, "8708100000", 1, 2.6, 99.0),
+    ]}
+    invoice = {container: [
+        record(container, "8708100000", 1, 1.00001, 10.0),
+        record(container, "8708100000", 1, 0.5, 99.0),
+    ]}
+
+    diff = diff_containers(declaration, invoice, DiffTolerances(weight=1))
+
+    # 0.99999 и 1.00001 - в соседних интервалах шириной 1, но в пределах допуска
+    assert diff["summary"]["matched"] == 1
+    assert pairs(diff) == [("mismatch", 1, 1)]
+    assert list(diff["mismatches"][0]["fields"]) == ["Вес брутто"]
+
+
+def test_nearby_bucket_beyond_tolerance_is_not_a_full_match():
+    container = "AAAU0000001"
+    declaration = {container: [record(container, "8708100000", 1, 0.5, 10.0)]}
+    invoice = {container: [record(container, "8708100000", 1, 1.9, 10.0)]}
+
+    diff = diff_containers(declaration, invoice, DiffTolerances(weight=1))
+
+    assert pairs(diff) == [("mismatch", 0, 0)]
+    assert diff["mismatches"][0]["fields"]["Вес брутто"]["delta"] == 1.4
@@ -0,0 +1,47 @@
+"""Пул исполнителей: перегрузка, таймаут и падение воркера."""
+import asyncio
+import os
+import time
+
+import pytest
+
+from src.executor import ExecutorSaturatedError, ExecutorTimeoutError, JobExecutor
+
+
+def test_broken_pool_is_replaced_and_reported_as_busy():
+    executor = JobExecutor(kind="process", max_workers=1, retry_after=7)
+
+    async def scenario():
+        broken = executor._pool
+        # os._exit в воркере ломает пул, пока задача ожидается
+        with pytest.raises(ExecutorSaturatedError) as error:
+            await executor.run(os._exit, 1)
+        assert error.value.retry_after == 7
+        assert executor._pool is not broken
+        assert await executor.run(pow, 2, 10) == 1024
+
+    executor.start()
+    try:
+        asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+    assert executor.stats()["broken"] == 1
+
+
+def test_saturated_and_timeout():
+    executor = JobExecutor(kind="thread", max_workers=1, max_queue=0, timeout=0.2, retry_after=3)
+
+    async def scenario():
+        slow = asyncio.ensure_future(executor.run(time.sleep, 0.5))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ExecutorSaturatedError):
+            await executor.run(pow, 2, 2)
+        with pytest.raises(ExecutorTimeoutError):
+            await slow
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+    assert executor.stats()["rejected"] == 1
+    assert executor.stats()["timed_out"] == 1
@@ -0,0 +1,107 @@
+"""Хранилище экспортов: несколько воркеров на одной папке и очистка."""
+import asyncio
+import os
+import time
+
+from src.exports import TMP_MAX_AGE, ExportStore, cleanup_periodically
+
+
+def write(store, content=b'{"a": 1}', compress=False):
+    return store.write(lambda f: f.write(content), compress=compress)
+
+
+def age(path, seconds):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_export_of_another_worker_is_found_on_disk(tmp_path):
+    first = ExportStore(str(tmp_path))
+    second = ExportStore(str(tmp_path))
+    plain = write(first)
+    packed = write(first, compress=True)
+
+    found = second.get(plain.name)
+    assert found is not None and found.path == plain.path and found.encoding is None
+    found = second.get(packed.name)
+    assert found is not None and found.path == packed.path and found.encoding == "gzip"
+    assert second.stats()["entries"] == 2
+    assert second.stats()["size_bytes"] == plain.size + packed.size
+
+
+def test_disk_lookup_rejects_foreign_names(tmp_path):
+    store = ExportStore(str(tmp_path / "downloads"))
+    (tmp_path / "secret.json").write_text("{}")
+
+    assert store.get("../secret.json") is None
+    assert store.get("missing.json") is None
+    assert store.get("notes.txt") is None
+
+
+def test_expired_export_of_another_worker_is_removed(tmp_path):
+    first = ExportStore(str(tmp_path))
+    second = ExportStore(str(tmp_path), max_age=60)
+    entry = write(first)
+    age(entry.path, 120)
+
+    assert second.get(entry.name) is None
+    assert not os.path.exists(entry.path)
+
+
+def test_cleanup_syncs_index_with_directory(tmp_path):
+    first = ExportStore(str(tmp_path), max_age=60)
+    second = ExportStore(str(tmp_path), max_age=60)
+    old = write(first)
+    fresh = write(second)
+    age(old.path, 120)
+
+    second.cleanup()  # удаляет чужой просроченный экспорт
+    assert not os.path.exists(old.path) and os.path.exists(fresh.path)
+
+    first.cleanup()  # снимает с учета удаленный и находит чужой
+    assert first.get(old.name) is None
+    assert first.stats()["entries"] == 1
+    assert first.stats()["size_bytes"] == fresh.size
+
+
+def test_cleanup_keeps_budget_across_workers(tmp_path):
+    first = ExportStore(str(tmp_path), max_bytes=100)
+    second = ExportStore(str(tmp_path), max_bytes=100)
+    old = write(first, b"x" * 60)
+    age(old.path, 10)
+    new = write(second, b"y" * 60)
+
+    second.cleanup()
+
+    assert not os.path.exists(old.path) and os.path.exists(new.path)
+
+
+def test_only_stale_tmp_files_are_removed(tmp_path):
+    fresh = tmp_path / "mapping_data_fresh.json.tmp"
+    stale = tmp_path / "mapping_data_stale.json.tmp"
+    fresh.write_bytes(b"{")
+    stale.write_bytes(b"{")
+    age(stale, TMP_MAX_AGE + 60)
+
+    ExportStore(str(tmp_path)).cleanup()
+
+    assert fresh.exists() and not stale.exists()
+
+
+def test_periodic_cleanup(tmp_path):
+    store = ExportStore(str(tmp_path), max_age=60, cleanup_interval=0.01)
+    entry = write(store)
+    age(entry.path, 120)
+    store._entries[entry.name].created -= 120
+
+    async def scenario():
+        task = asyncio.create_task(cleanup_periodically(store))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if not os.path.exists(entry.path):
+                break
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert not os.path.exists(entry.path)
+    assert store.stats()["entries"] == 0
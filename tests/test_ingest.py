@@ -0,0 +1,71 @@
+"""Прием загрузок (src/ingest.py): источник без копии, копия только для пула процессов."""
+import asyncio
+import hashlib
+import os
+from tempfile import SpooledTemporaryFile
+
+import pytest
+from starlette.datastructures import UploadFile
+
+from src.ingest import UploadTooLargeError, open_source, source_size, spool_upload
+
+SPOOL_MAX_SIZE = 1024 * 1024  # как у MultiPartParser Starlette
+
+
+def make_upload(content: bytes) -> UploadFile:
+    file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    file.write(content)
+    file.seek(0)
+    return UploadFile(file, size=len(content), filename="invoice.xlsx")
+
+
+def read(source) -> bytes:
+    with open_source(source) as f:
+        return f.read()
+
+
+def test_small_upload_is_passed_as_bytes():
+    content = b"small file"
+    upload = asyncio.run(spool_upload(make_upload(content), processes=True))
+
+    assert upload.source == content and not upload.owned
+    assert upload.size == len(content) and upload.sha256 == hashlib.sha256(content).hexdigest()
+
+
+def test_rolled_over_upload_is_shared_with_threads():
+    content = os.urandom(SPOOL_MAX_SIZE + 1000)
+    upload_file = make_upload(content)
+    upload = asyncio.run(spool_upload(upload_file, processes=False))
+
+    assert isinstance(upload.source, str) and not upload.owned
+    assert upload.sha256 == hashlib.sha256(content).hexdigest()
+    # Отдельное открытие - своя позиция чтения, файл Starlette не сдвигается
+    upload_file.file.seek(10)
+    assert read(upload.source) == content and source_size(upload.source) == len(content)
+    assert upload_file.file.tell() == 10
+
+    upload.cleanup()
+    assert read(upload.source) == content
+
+
+def test_rolled_over_upload_is_copied_for_processes():
+    content = os.urandom(SPOOL_MAX_SIZE + 1000)
+    upload = asyncio.run(spool_upload(make_upload(content), processes=True))
+
+    assert upload.owned and os.path.isfile(upload.source)
+    assert read(upload.source) == content
+    assert upload.sha256 == hashlib.sha256(content).hexdigest()
+
+    upload.cleanup()
+    assert not os.path.exists(upload.source)
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_too_large_upload_is_rejected_while_reading(processes, tmp_path, monkeypatch):
+    monkeypatch.setenv("UPLOAD_SPOOL_DIR", str(tmp_path))
+    upload_file = make_upload(os.urandom(SPOOL_MAX_SIZE + 1000))
+    upload_file.size = None  # размер заранее неизвестен
+
+    with pytest.raises(UploadTooLargeError):
+        asyncio.run(spool_upload(upload_file, SPOOL_MAX_SIZE, processes=processes))
+    assert not os.listdir(tmp_path)
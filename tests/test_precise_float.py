@@ -0,0 +1,138 @@
+"""Быстрые пути очистки чисел дают тот же результат, что исходный get_precise_float_from_excel."""
+import math
+import random
+import struct
+from datetime import datetime
+from decimal import Decimal
+
+from openpyxl import Workbook
+
+from src.processors.unified import _is_clean_float, get_precise_float_from_excel, precise_float, precise_floats
+
+
+def legacy_precise_float(value):
+    """Исходный алгоритм get_precise_float_from_excel (до быстрых путей) для значения ячейки."""
+    try:
+        if value is None:
+            return 0.0
+        if isinstance(value, (int, float)):
+            original_float = float(value)
+            decimal_value = Decimal(str(original_float))
+            if decimal_value == decimal_value.to_integral_value():
+                return float(decimal_value)
+            sign, digits, exponent = decimal_value.as_tuple()
+            if exponent < 0:
+                decimal_places = abs(exponent)
+                str_decimal = str(decimal_value)
+                if '.' in str_decimal:
+                    fractional = str_decimal.split('.')[1]
+                    if len(fractional) > 10:
+                        best_result = original_float
+                        for test_places in range(10, 0, -1):
+                            test_rounded = round(original_float, test_places)
+                            test_str = str(Decimal(str(test_rounded)))
+                            if '.' in test_str:
+                                test_fractional = test_str.split('.')[1]
+                                if not (test_fractional.endswith('999') or test_fractional.endswith('000')
+                                        or len(test_fractional) > test_places + 2):
+                                    best_result = test_rounded
+                                    break
+                        return best_result
+                    else:
+                        if decimal_places > 15:
+                            decimal_places = 15
+                        return round(original_float, decimal_places)
+            return float(decimal_value)
+        if isinstance(value, str):
+            try:
+                decimal_value = Decimal(value)
+                if '.' in value:
+                    decimal_places = len(value.split('.')[1])
+                    if decimal_places > 15:
+                        decimal_places = 15
+                    return round(float(decimal_value), decimal_places)
+                return float(decimal_value)
+            except Exception:
+                return 0.0
+        return 0.0
+    except Exception:
+        return 0.0
+
+
+def random_value(rnd):
+    kind = rnd.randrange(12)
+    if kind == 0:
+        return round(rnd.uniform(-1e6, 1e6), rnd.randint(0, 12))
+    if kind == 1:
+        # Артефакты сложения и умножения
+        return rnd.choice([0.1, 0.2, 0.3, 1.1, 2.675, 1.005]) * rnd.randint(1, 1000) + rnd.choice([0.1, 0.2, 0.7])
+    if kind == 2:
+        return rnd.uniform(-10, 10) * 10.0 ** rnd.randint(-30, 30)
+    if kind == 3:
+        # Произвольные биты double: длинный хвост, субнормальные, inf и nan
+        return struct.unpack("<d", struct.pack("<Q", rnd.getrandbits(64)))[0]
+    if kind == 4:
+        return rnd.choice([0.0, -0.0, math.inf, -math.inf, math.nan, 5e-324, 1e16, 2.0 ** 53 + 2, 1e308])
+    if kind == 5:
+        return rnd.randint(-1000, 1000)
+    if kind == 6:
+        return rnd.choice([2 ** 53, 2 ** 53 + 1, -2 ** 53 - 1, 2 ** 70, -2 ** 64, 10 ** 400])
+    if kind == 7:
+        return rnd.choice([True, False, None, datetime(2024, 1, 2)])
+    if kind == 8:
+        return f"{rnd.uniform(-1e4, 1e4):.{rnd.randint(0, 20)}f}"
+    if kind == 9:
+        return rnd.choice(["", " 12 ", "abc", "1e5", "1,5", "nan", "inf", "-0", "12.", ".5", "1.2345678901234567890123"])
+    if kind == 10:
+        return repr(random_value(rnd))
+    return float(rnd.randint(-10 ** 6, 10 ** 6)) / rnd.choice([1, 3, 7, 10, 100, 1000])
+
+
+def same(actual, expected):
+    return type(actual) is type(expected) and repr(actual) == repr(expected)
+
+
+def test_precise_float_matches_legacy():
+    rnd = random.Random(8)
+    values = [random_value(rnd) for _ in range(20000)]
+
+    for value in values:
+        assert same(precise_float(value), legacy_precise_float(value)), value
+
+
+def test_precise_floats_matches_legacy():
+    rnd = random.Random(80)
+    # Повторы проверяют кэш медленного пути внутри колонки
+    values = [random_value(rnd) for _ in range(5000)]
+    values += rnd.sample(values, 2000)
+
+    actual = precise_floats(values)
+
+    assert len(actual) == len(values)
+    for value, cleaned in zip(values, actual):
+        assert same(cleaned, legacy_precise_float(value)), value
+
+
+def test_clean_float_is_returned_unchanged():
+    rnd = random.Random(800)
+    for _ in range(20000):
+        value = random_value(rnd)
+        if isinstance(value, float) and _is_clean_float(value):
+            assert same(legacy_precise_float(value), value), value
+
+
+def test_get_precise_float_from_excel_reads_cells():
+    rnd = random.Random(8000)
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "PL"
+    values = [random_value(rnd) for _ in range(300)]
+    values = [value for value in values
+              if not (isinstance(value, str) and value.startswith("=")) and value != 10 ** 400]
+    for row, value in enumerate(values):
+        sheet.cell(row=row + 1, column=1, value=value)
+
+    for row, value in enumerate(values):
+        cell_value = sheet.cell(row=row + 1, column=1).value
+        assert same(get_precise_float_from_excel(workbook, "PL", row, 0), legacy_precise_float(cell_value))
+    assert get_precise_float_from_excel(workbook, "missing", 0, 0) == 0.0
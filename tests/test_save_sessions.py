@@ -0,0 +1,48 @@
+"""Поэтапное сохранение (src/save_sessions.py): параллельные пачки одной сессии."""
+import threading
+
+from src import save_sessions
+from src.save_sessions import SaveSessionStore
+
+
+def record(container):
+    return {
+        "Код ТН ВЭД": "8708100000", "Коммерческое описание товара": "Запчасти",
+        "Количество грузовых мест": 1, "Вес брутто": 2.5, "Сумма": 10, "Номер контейнера": container,
+        "Валюта": "USD", "Вид упаковки ": "CT", "Количество упаковок": 1,
+    }
+
+
+def test_parallel_batches_are_all_counted(tmp_path, monkeypatch):
+    store = SaveSessionStore(str(tmp_path))
+    session_id = store.open({"client_name": "Клиент", "order_number": "ORDER-1"})["session_id"]
+    batches = 8
+
+    # Все пачки подготовлены до того, как первая из них записана
+    barrier = threading.Barrier(batches)
+    prepare_data = save_sessions.DataHandler.prepare_data
+
+    def prepare_together(handler, request):
+        result = prepare_data(handler, request)
+        barrier.wait(timeout=10)
+        return result
+
+    monkeypatch.setattr(save_sessions.DataHandler, "prepare_data", prepare_together)
+    threads = [
+        threading.Thread(target=store.stage, args=(session_id, {f"C{n}": [record(f"C{n}")]}, {}))
+        for n in range(batches)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    session = store.get(session_id)
+    assert session["batches"] == batches
+    assert sorted(session["received"]) == sorted(f"C{n}" for n in range(batches))
+
+
+def test_stage_of_unknown_session(tmp_path):
+    store = SaveSessionStore(str(tmp_path))
+
+    assert store.stage("0" * 32, {"C1": [record("C1")]}, {}) is None
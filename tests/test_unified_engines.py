@@ -0,0 +1,152 @@
+"""Потоковая обработка листа "PL" и обработка через pandas дают одинаковый результат."""
+import io
+import random
+from datetime import datetime
+
+import pytest
+from openpyxl import Workbook
+
+from src import metrics
+from src.processors.unified import process_unified
+
+TITLES = ["№", "Код", "Описание", "Шт", "Мест", "Уп", "Нетто", "Брутто", "Вал", "Сумма",
+          "Контейнер", "Инвойс", "Дата", "Отправитель", "Адрес", "Продавец", "Получатель",
+          "Адрес получателя", "Покупатель"]
+
+
+def make_workbook(rows, titles=TITLES, header=()):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = "PL"
+    for col, value in enumerate(header):
+        sheet.cell(row=1, column=col + 1, value=value)
+    for col, value in enumerate(titles):
+        sheet.cell(row=2, column=col + 1, value=value)
+    for row, values in enumerate(rows):
+        for col, value in enumerate(values):
+            sheet.cell(row=row + 3, column=col + 1, value=value)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def make_row(container, invoice, **columns):
+    row = [1, 8471300000, "Товар", 1, 2, "CT", 1.5, 2.5, "USD", 10, container, invoice,
+           "01.02.2024", "Отправитель", "Адрес", None, "Получатель", "Адрес получателя", None]
+    for col, value in columns.items():
+        row[int(col[1:])] = value
+    return row
+
+
+def snapshot(result):
+    if "error" in result:
+        return {"error": result["error"]}
+    storage = result["storage"]
+    return {
+        "containers": storage.containers,
+        "container_info": storage.container_info,
+        "info": (storage.sender_name, storage.sender_address, storage.recipient_name,
+                 storage.recipient_address, storage.invoice, storage.date_invoice),
+        "totals": (storage.totals.total_quantity, storage.totals.total_weight, storage.totals.total_amount),
+        "index": {number: (part.keys, part.quantity, part.weight, part.amount, part.info)
+                  for number, part in result["index"].items()},
+    }
+
+
+def assert_same(content, CON_NUMBER=None):
+    streaming = snapshot(process_unified(content, CON_NUMBER, engine="streaming"))
+    expected = snapshot(process_unified(content, CON_NUMBER, engine="pandas"))
+    assert repr(streaming) == repr(expected)
+    return streaming
+
+
+def test_untitled_numeric_column_is_float():
+    # Колонка без заголовка только с числами у pandas - float64
+    titles = list(TITLES)
+    titles[11] = None
+    content = make_workbook([make_row("C1", 12345), make_row("C1", 12345)], titles)
+
+    result = assert_same(content)
+
+    assert result["info"][4] == "12345.0"
+    assert result["container_info"]["C1"]["invoice"] == "12345.0"
+
+
+def test_titled_numeric_column_is_text():
+    content = make_workbook([make_row("C1", 12345), make_row("C2", 777)])
+
+    result = assert_same(content)
+
+    assert result["container_info"]["C1"]["invoice"] == "12345"
+
+
+def test_untitled_column_with_text_stays_object():
+    titles = list(TITLES)
+    titles[11] = None
+    content = make_workbook([make_row("C1", 12345), make_row("C1", "INV-1")], titles)
+
+    result = assert_same(content)
+
+    assert set(result["containers"]) == {"C1_12345", "C1_INV-1"}
+
+
+def test_untitled_numeric_container_and_filter():
+    titles = list(TITLES)
+    titles[10] = None
+    rows = [make_row(55, "A"), make_row(" 56 ", "B"), make_row(None, "C")]
+    content = make_workbook(rows, titles)
+
+    result = assert_same(content)
+    assert set(result["containers"]) == {"55.0", "56.0"}
+    assert assert_same(content, "55.0")["containers"]
+    assert not assert_same(content, "55")["containers"]
+
+
+def test_untitled_date_column_with_blanks():
+    titles = list(TITLES)
+    titles[12] = titles[14] = None
+    rows = [make_row("C1", "A", c12=datetime(2024, 1, 2), c14=datetime(2024, 1, 3)),
+            make_row("C1", "A", c12=None, c14=None)]
+    content = make_workbook(rows, titles)
+
+    result = assert_same(content)
+
+    assert result["index"]["C1"][4]["sender_address"] == "NaT"
+
+
+def stages(content):
+    with metrics.capture() as samples:
+        process_unified(content, engine="streaming")
+    return {dict(labels)["stage"] for _, labels, _ in samples}
+
+
+def test_type_scan_runs_only_for_untitled_text_columns(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", True)
+    titles = list(TITLES)
+    titles[11] = None
+    rows = [make_row("C1", 12345), make_row("C1", 12345)]
+
+    assert "invoice.type_scan" in stages(make_workbook(rows, titles))
+    assert "invoice.type_scan" not in stages(make_workbook(rows))
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_random_sheets(seed):
+    rng = random.Random(seed)
+    pool = [None, "", "NA", 12345, 7, 1.5, "00077", " 12", "1e3", "текст", True,
+            datetime(2024, 1, 2), "inf", "-", 2 ** 70]
+    for _ in range(25):
+        titles = [rng.choice([None, None, "Заголовок", 7, "NA"]) for _ in range(19)]
+        header = [rng.choice([None] * 19 + ["Шапка"]) for _ in range(19)]
+        rows = []
+        for _ in range(rng.randint(0, 8)):
+            row = make_row(rng.choice(["C1", "C2", 55, None, 3.5]), rng.choice(pool))
+            for col in (1, 2, 8, 12, 13, 14, 15, 16, 17, 18):
+                if rng.random() < 0.5:
+                    row[col] = rng.choice(pool)
+            if rng.random() < 0.2:
+                row[5] = rng.choice(["PP", 5, None])
+            rows.append(row if rng.random() > 0.1 else [])
+        content = make_workbook(rows, titles, header)
+        for CON_NUMBER in (None, "C1", "55.0"):
+            assert_same(content, CON_NUMBER)